@@ -2,61 +2,299 @@
 ## (i.e. reads with multiple alignments are counted once)
 ## stat --> filter (use --filter_before_stat set to False) 
 ## filter --> stat (use --filter_before_stat set to True) 
+## the statistics before and after filtering (MAPQ, FLAG bits, contigs, see filters.py) are computed in the same pass, see --unfiltered_outf/--filtered_outf 
+## the same counts can also be written as JSON, TSV or Parquet (see report.py) 
+## --profile times the stages of the run (see profiling.py) 
+## --read_ahead_mb reads the input in a background thread while the main thread parses (see prefetch.py) 
+## compressed SAM input (gzip, BGZF, bz2) is decompressed on the fly, BGZF blocks by several threads (see compressed.py) 
+## long runs can save checkpoints and resume from the last one (--checkpoint/--resume, see checkpoint.py) 
+import io 
+import os 
 import sys 
+import time 
 import argparse 
+from itertools import islice
+from .flagmask import mask_table, mask_index, num_read_slots, initialize_mask_counts, mask_counts_to_flagstat, initialize_alignment_counts, alignment_counts_to_flagstat
+from .sortstatfilter import sort_stat_filter
+from .complexity import sam_complexity
+from .coordinate_complexity import bam_coordinate_complexity
+from .filters import initialize_alignment_filter, filter_is_empty, mitochondrial_contigs
+from .checkpoint import default_checkpoint_alignments, default_checkpoint_seconds
+from .progress import initialize_progress, update_progress, finish_progress, input_size, default_progress_interval
+from .compressed import file_compression
+from .report import percent_stats, flagstat_rows, write_json_report, write_tsv_report, write_parquet_report
+
+
+#13 stats that flagstats reports
+# the order of the stat in the global_flagstat and cur_flagstat arrays matches the order of the stats list 
+stats=['total',
+       'secondary',
+       'supplementary',
+       'duplicates',
+       'mapped',
+       'paired in sequencing',
+       'read1',
+       'read2',
+       'properly paired',
+       'with itself and mate mapped',
+       'singletons',
+       'with mate mapped to a different chr',
+       'with mate mapped to a different chr q5']
+#number of alignments from the BAM/CRAM readers between progress updates
+progress_batch_size=65536
 
 
 def parse_args(): 
     parser=argparse.ArgumentParser(description="Compute SAM file mapping statistics for a SAM file sorted by read name")
-    parser.add_argument("--sorted_sam_file",help="Input SAM file. Use '-' if input is being piped from stdin. File must be sorted by read name.",required=True)
+    parser.add_argument("--sorted_sam_file",help="Input SAM/BAM/CRAM file (SAM may be gzip, BGZF or bz2 compressed). Use '-' if input is being piped from stdin. File must be sorted by read name, unless --coordinate_sorted is used.",required=True)
     parser.add_argument("--outf",default=None,help="Output file name to store alignment statistics. The statistics will be printed to stdout if no file is provided") 
-    parser.add_argument("--chunk_size",type=int,default=100000,help="Number of lines to read a time from sortedSamFile")
-    return parser.parse_args()
+    parser.add_argument("--chunk_size",type=int,default=100000,help="Number of lines to read a time from sortedSamFile (number of bytes for the bytes and numpy engines)")
+    parser.add_argument("--engine",choices=["python","bytes","numpy"],default="python",help="python: parse the SAM file one line at a time; bytes: scan the raw bytes of each line in a reusable buffer without splitting it into strings; numpy: parse whole chunks with vectorized numpy operations (requires numpy, use a --chunk_size of several MB)")
+    parser.add_argument("--mmap",action="store_true",default=False,help="Memory-map sorted_sam_file and scan it in place with the bytes engine instead of streaming it through read buffers (SAM files on disk only)")
+    parser.add_argument("--coordinate_sorted",action="store_true",default=False,help="Input is not sorted by read name (i.e. SO:coordinate): keep the reads in a table until all their alignments are seen, based on the NH and SA tags, instead of running samtools sort -n first")
+    parser.add_argument("--max_pending_reads",type=int,default=2000000,help="With --coordinate_sorted, maximum number of unfinished reads kept in memory; the oldest half is spilled to disk when the table grows past it")
+    parser.add_argument("--spill_dir",default=None,help="With --coordinate_sorted, directory for the spill files (defaults to the system temporary directory)")
+    parser.add_argument("--per_alignment",action="store_true",default=False,help="Also count alignments with the samtools view filters of flagstat.sh in the same pass; the per-alignment statistics are written in a second tab-separated column next to the per-read statistics")
+    parser.add_argument("--input_format",choices=["auto","sam","bam","cram"],default="auto",help="Format of sorted_sam_file. auto: bam/cram based on the file extension, sam otherwise (including stdin)")
+    parser.add_argument("--reference",default=None,help="FASTA reference for CRAM input (requires pysam)")
+    parser.add_argument("--filter_before_stat",action="store_true",default=False,help="filter --> stat: --outf has the statistics of the alignments that pass the filters. By default (stat --> filter) --outf has the statistics of all alignments")
+    parser.add_argument("--min_mapq",type=int,default=0,help="Filter: keep alignments with at least this MAPQ")
+    parser.add_argument("--required_flag",type=lambda value: int(value,0),default=0,help="Filter: keep alignments with all of these FLAG bits (like samtools view -f)")
+    parser.add_argument("--excluded_flag",type=lambda value: int(value,0),default=0,help="Filter: keep alignments with none of these FLAG bits (like samtools view -F)")
+    parser.add_argument("--exclude_contigs",default=None,help="Filter: comma separated RNAMEs to drop, i.e. chrM,chrUn_gl000220")
+    parser.add_argument("--exclude_mitochondrial",action="store_true",default=False,help="Filter: drop alignments to the mitochondrial genome ("+",".join(mitochondrial_contigs)+")")
+    parser.add_argument("--unfiltered_outf",default=None,help="Also write the statistics of all alignments to this file (computed in the same pass)")
+    parser.add_argument("--filtered_outf",default=None,help="Also write the statistics of the alignments that pass the filters to this file (computed in the same pass)")
+    parser.add_argument("--filtered_output",default=None,help="Write the alignments that pass the filters to this SAM/BAM file (BAM output requires pysam)")
+    parser.add_argument("--filtered_output_format",choices=["auto","sam","bam"],default="auto",help="Format of --filtered_output. auto: bam if the file name ends with .bam, sam otherwise")
+    parser.add_argument("--group_by",default=None,help="Also compute the statistics per group of reads: RG for the read group of the first alignment of each read name, or a regular expression matched at the start of the QNAME (its first capture group, if any, is the group), i.e. '([^:]+:[^:]+:[^:]+):' for the instrument:run:flowcell of Illumina read names")
+    parser.add_argument("--group_outf",default=None,help="Output file for the per-group statistics (group name in the first tab-separated column of each line). Defaults to --outf with a .groups.txt suffix, or stdout")
+    parser.add_argument("--json_outf",default=None,help="Also write the statistics as JSON (see report.py)")
+    parser.add_argument("--tsv_outf",default=None,help="Also write the statistics as a TSV table with one line per statistic")
+    parser.add_argument("--parquet_outf",default=None,help="Also write the statistics as a Parquet table with the columns of the TSV table (requires pyarrow)")
+    parser.add_argument("--sample_name",default=None,help="Sample name in the JSON/TSV/Parquet output. Defaults to the file name of sorted_sam_file")
+    parser.add_argument("--partial_outf",default=None,help="Also write the counters to this partial-result file; the partial files of the shards of a sample are added up with SAMstats merge (see partial.py)")
+    parser.add_argument("--checkpoint",default=None,help="Save a checkpoint (counts of the completed read names + byte offset, see checkpoint.py) to this file periodically, and at the end of the input")
+    parser.add_argument("--checkpoint_alignments",type=int,default=default_checkpoint_alignments,help="With --checkpoint, number of SAM lines between checkpoints")
+    parser.add_argument("--checkpoint_seconds",type=float,default=default_checkpoint_seconds,help="With --checkpoint, number of seconds between checkpoints")
+    parser.add_argument("--resume",action="store_true",default=False,help="With --checkpoint, continue from the checkpoint file if it exists (sorted_sam_file must be a file, not stdin)")
+    parser.add_argument("--progress_interval",type=float,default=default_progress_interval,help="Seconds between progress reports (alignments/s, reads/s, MB/s, ETA for files on disk) on stderr; 0 to only report at the end")
+    parser.add_argument("--quiet",action="store_true",default=False,help="Do not report progress on stderr")
+    parser.add_argument("--metrics_file",default=None,help="Also write the progress metrics in the Prometheus text format to this file at every report (i.e. for the node_exporter textfile collector)")
+    parser.add_argument("--decompress_threads",type=int,default=None,help="Number of threads that decompress BGZF (bgzip) compressed SAM input, see compressed.py. Defaults to the number of CPUs; gzip and bz2 input is decompressed in the reading thread")
+    parser.add_argument("--read_ahead_mb",type=float,default=0,help="Read the input in a background thread, up to this many MB ahead of the parser (see prefetch.py), i.e. on network filesystems; 0 to read in the main thread")
+    parser.add_argument("--profile",action="store_true",default=False,help="Time the stages of the run (read, parse, classify, reduce, output; see profiling.py) and write the breakdown to stderr. The per-line stages are only broken down for the python engine on SAM input")
+    parser.add_argument("--profile_outf",default=None,help="With --profile, write the timing breakdown to this file instead of stderr")
+    parser.add_argument("--profile_dump",default=None,help="Also run cProfile and write the pstats file to this file")
+    args=parser.parse_args()
+    args.input_format=get_input_format(args.sorted_sam_file,args.input_format)
+    if args.engine!="python" and args.input_format!="sam":
+        parser.error("--engine "+args.engine+" is only available for SAM input")
+    if args.mmap and (args.input_format!="sam" or args.sorted_sam_file=="-" or args.engine=="numpy"):
+        parser.error("--mmap requires a SAM file on disk and the python or bytes engine")
+    if args.coordinate_sorted and (args.engine!="python" or args.mmap):
+        parser.error("--coordinate_sorted is only available with the python engine")
+    if args.per_alignment and (args.engine!="python" or args.mmap):
+        parser.error("--per_alignment is only available with the python engine")
+    excluded_contigs=[] if args.exclude_contigs is None else [contig for contig in args.exclude_contigs.split(',') if len(contig)>0]
+    if args.exclude_mitochondrial:
+        excluded_contigs+=mitochondrial_contigs
+    args.alignment_filter=initialize_alignment_filter(args.min_mapq,args.required_flag,args.excluded_flag,excluded_contigs)
+    args.filtering=(not filter_is_empty(args.alignment_filter) or args.filter_before_stat or
+                    args.unfiltered_outf is not None or args.filtered_outf is not None or args.filtered_output is not None)
+    if args.filtering and (args.engine!="python" or args.mmap or args.coordinate_sorted or args.per_alignment):
+        parser.error("the filters are only available with the python engine on name-sorted input, without --per_alignment")
+    if args.group_by is not None and (args.engine!="python" or args.mmap or args.coordinate_sorted or args.per_alignment or args.filtering):
+        parser.error("--group_by is only available with the python engine on name-sorted input, without --per_alignment and the filters")
+    if args.group_by is not None and args.group_outf is None and args.outf is not None:
+        args.group_outf=args.outf+'.groups.txt'
+    if args.checkpoint is not None and (args.engine!="python" or args.mmap or args.input_format!="sam" or args.coordinate_sorted or args.per_alignment or args.filtering or args.group_by is not None):
+        parser.error("--checkpoint is only available with the python engine on name-sorted SAM input, without --per_alignment, the filters and --group_by")
+    if args.resume and (args.checkpoint is None or args.sorted_sam_file=="-"):
+        parser.error("--resume requires --checkpoint and a SAM file, not stdin")
+    if (args.mmap or args.checkpoint is not None) and args.input_format=="sam" and file_compression(args.sorted_sam_file) is not None: 
+        parser.error("--mmap and --checkpoint require uncompressed SAM input")
+    if args.read_ahead_mb>0 and (args.mmap or args.checkpoint is not None or args.input_format=="cram" or args.filtering or args.group_by is not None): 
+        parser.error("--read_ahead_mb is not available with --mmap, --checkpoint, CRAM input, the filters and --group_by")
+    if args.filtered_output=="-":
+        parser.error("--filtered_output must be a file, stdout is used for the statistics")
+    return args
+
+
+def get_input_format(input_file,input_format): 
+    '''
+    resolves --input_format auto from the file extension 
+    '''
+    if input_format!="auto": 
+        return input_format
+    if input_file.endswith('.bam'): 
+        return "bam"
+    if input_file.endswith('.cram'): 
+        return "cram"
+    return "sam"
+
+
+def open_input(input_file,binary,read_ahead_mb=0,decompress=False,decompress_threads=None): 
+    '''
+    input_file -- file name, or '-' for stdin 
+    binary -- open in binary mode instead of text mode 
+    read_ahead_mb -- read the input in a background thread with this many MB of read-ahead (see prefetch.py), 0 to read it directly 
+    decompress -- decompress gzip, BGZF and bz2 input, recognized from its first bytes (see compressed.py), i.e. for SAM input 
+    decompress_threads -- number of threads that decompress BGZF input (defaults to the number of CPUs) 
+    returns the file handle 
+    '''
+    if read_ahead_mb<=0 and not decompress: 
+        if input_file=="-":
+            return sys.stdin.buffer if binary else sys.stdin
+        return open(input_file,'rb' if binary else 'r') 
+    if input_file=="-":
+        f=sys.stdin.buffer
+    else:
+        f=open(input_file,'rb') 
+    if read_ahead_mb>0: 
+        from .prefetch import open_prefetched
+        f=open_prefetched(f,read_ahead_mb) 
+    if decompress: 
+        from .compressed import input_compression, open_decompressed
+        compression=input_compression(f) 
+        if compression is not None: 
+            f=open_decompressed(f,compression,decompress_threads) 
+        elif read_ahead_mb<=0 and not binary and input_file=="-": 
+            #uncompressed text from stdin is read directly 
+            return sys.stdin
+    if binary: 
+        return f
+    return io.TextIOWrapper(f) 
+
+
+def format_stat(row): 
+    '''
+    returns the flagstat line for a single statistic 
+    row -- qc_passed, qc_failed and percentages of the statistic (see report.flagstat_rows) 
+    '''
+    outstring=' '.join([str(row['qc_passed']),"+",str(row['qc_failed']),row['stat']])
+    percent_string=""
+    if row['stat'] in percent_stats: 
+        percent_string="".join(["(",str(row['percent_qc_passed']),":",str(row['percent_qc_failed']),")"])
+    return ' '.join([outstring,percent_string])
 
 
 def write_output_file(outf,
-                      stats,
-                      global_flagstat,
-                      percent_mapped,
-                      percent_properly_paired,
-                      percent_singletons):
+                      rows,
+                      alignment_rows=None):
+    '''
+    rows -- per-read statistics (see report.flagstat_rows) 
+    alignment_rows -- optional per-alignment statistics, written in a second tab-separated column 
+    '''
     if outf!=None: 
         outf=open(outf,'w') 
-    num_fields=len(stats) 
-    for i in range(len(stats)): 
-        outstring=' '.join([str(global_flagstat[0][i]),"+",str(global_flagstat[1][i]),stats[i]])
-        percent_string=""
-        if stats[i]=="mapped": 
-            percent_string="".join(["(",
-                            str(percent_mapped[0]),
-                            ":",
-                            str(percent_mapped[1]),
-                            ")"])
-        elif stats[i]=="properly paired": 
-            percent_string="".join(["(",
-                            str(percent_properly_paired[0]),
-                            ":",
-                            str(percent_properly_paired[1]),
-                            ")"])
-        elif stats[i]=="singletons": 
-            percent_string="".join(["(",
-                            str(percent_singletons[0]),
-                            ":",
-                            str(percent_singletons[1]),
-                            ")"])
-        outstring=' '.join([outstring,percent_string])
+    for i in range(len(rows)): 
+        outstring=format_stat(rows[i])
+        if alignment_rows!=None: 
+            outstring='\t'.join([outstring,format_stat(alignment_rows[i])])
         if outf==None: 
             print(outstring) 
         else: 
             outf.write(outstring+'\n') 
+    if outf!=None: 
+        outf.close() 
+
+
+def mask_count_rows(stats,global_mask_counts): 
+    '''
+    returns the per-read statistics (see report.flagstat_rows) for global_mask_counts (see flagmask.initialize_mask_counts) 
+    '''
+    global_flagstat=mask_counts_to_flagstat(global_mask_counts) 
+    return flagstat_rows(stats,
+                         global_flagstat,
+                         (calculate_percent(4,global_flagstat),
+                          calculate_percent(8,global_flagstat),
+                          calculate_percent(10,global_flagstat)))
+
+
+def write_group_output_file(outf,group_rows): 
+    '''
+    writes the flagstat report of every group to outf (stdout if None), with the group name in the first tab-separated column 
+    group_rows -- list of (group, statistics of the group) (see mask_count_rows) 
+    '''
+    if outf!=None: 
+        outf=open(outf,'w') 
+    for group,rows in group_rows: 
+        for row in rows: 
+            outstring='\t'.join([group,format_stat(row)])
+            if outf==None: 
+                print(outstring) 
+            else: 
+                outf.write(outstring+'\n') 
+    if outf!=None: 
+        outf.close() 
+
+
+def write_structured_output(args,sample,sections): 
+    '''
+    writes the JSON/TSV/Parquet reports requested with --json_outf/--tsv_outf/--parquet_outf 
+    sections -- list of (section name, statistics) (see report.flagstat_rows) 
+    '''
+    if args.json_outf is not None: 
+        write_json_report(args.json_outf,sample,sections) 
+    if args.tsv_outf is not None: 
+        write_tsv_report(args.tsv_outf,sample,sections) 
+    if args.parquet_outf is not None: 
+        write_parquet_report(args.parquet_outf,sample,sections) 
+
+
+def write_flagstat_reports(args,
+                           sample,
+                           global_mask_counts,
+                           alignment_counts=None,
+                           group_counts=None,
+                           unfiltered_mask_counts=None,
+                           filtered_counts=None): 
+    '''
+    writes all the reports requested in args (--outf, --group_outf, --unfiltered_outf/--filtered_outf, JSON/TSV/Parquet) from the counters of a run 
+    or of merged partial files (see partial.merge_main); the optional counters are None when they were not computed 
+    '''
+    #calculate % mapped, properly paired, singletons from total primary reads 
+    rows=mask_count_rows(stats,global_mask_counts) 
+    sections=[('per_read',rows)]
+    
+    alignment_rows=None
+    if alignment_counts is not None: 
+        alignment_flagstat=alignment_counts_to_flagstat(alignment_counts) 
+        #as in flagstat.sh, % mapped is relative to all alignments and the other percentages to primary alignments 
+        #note: 4, 8, 10 are the indices in alignment_flagstat where the counts for these fields are stored 
+        alignment_rows=flagstat_rows(stats,
+                                     alignment_flagstat,
+                                     (calculate_percent(4,alignment_flagstat,0),
+                                      calculate_percent(8,alignment_flagstat),
+                                      calculate_percent(10,alignment_flagstat)))
+        sections.append(('per_alignment',alignment_rows))
+    if unfiltered_mask_counts is not None: 
+        unfiltered_rows=mask_count_rows(stats,unfiltered_mask_counts) 
+        filtered_rows=mask_count_rows(stats,filtered_counts) 
+        if args.unfiltered_outf is not None: 
+            write_output_file(args.unfiltered_outf,unfiltered_rows) 
+        if args.filtered_outf is not None: 
+            write_output_file(args.filtered_outf,filtered_rows) 
+        sections+=[('unfiltered',unfiltered_rows),('filtered',filtered_rows)]
+    
+    #write the output file 
+    write_output_file(args.outf,rows,alignment_rows)
+    if group_counts is not None: 
+        group_rows=[(group,mask_count_rows(stats,mask_counts)) for group,mask_counts in group_counts.items()]
+        write_group_output_file(args.group_outf,group_rows) 
+        sections+=[('group:'+group,rows_of_group) for group,rows_of_group in group_rows]
+    write_structured_output(args,sample,sections) 
 
-def calculate_percent(field_index,global_flagstat):
+
+def calculate_percent(field_index,global_flagstat,denominator_index=13):
     '''
     field_index = index (0 - 12) in the global_flagstat array indicating the number of reads for the field of interest. Refer to http://www.htslib.org/doc/samtools.html for field index ordering 
+    denominator_index = index of the count the percentage is relative to (primary reads by default) 
     returns % of reads meeting the criteria for the specified field among the reads that pass qc and among the reads that fail qc 
     '''
-    qc_passed_primary=global_flagstat[0][13] 
-    qc_failed_primary=global_flagstat[1][13]
+    qc_passed_primary=global_flagstat[0][denominator_index] 
+    qc_failed_primary=global_flagstat[1][denominator_index]
     qc_passed_field=global_flagstat[0][field_index] 
     qc_failed_field=global_flagstat[1][field_index] 
     field_percent_qc_passed="NA" 
@@ -68,98 +306,63 @@ def calculate_percent(field_index,global_flagstat):
     return field_percent_qc_passed, field_percent_qc_failed 
 
 
-def add_read_stats(flag,mapq,rnext,cur_flagstat): 
+def add_read_stats(flag,mapq,rnext,cur_masks,alignment_counts=None): 
     '''
     implements flagstat logic from http://www.htslib.org/doc/samtools.html to calculate each of the 13 flags
     also keep track of number of primary reads for calculating fraction of mapped reads in the global summary stats 
+    the per-alignment logic is precomputed in flagmask.mask_table, so the read state is kept as 14-bit masks 
+    cur_masks -- [qc_passed, qc_failed] masks of the unpaired, read1, read2 and middle segment reads of the current read name (see initialize_read_masks) 
+    alignment_counts -- optional per-alignment counts (see flagmask.initialize_alignment_counts), incremented for the alignment 
     '''
-    temp_flagstat=[]
-    qc_passed=flag & 0x200 == 0
-    temp_flagstat.append(qc_passed) #qc_passed
-    temp_flagstat.append(flag & 0x100 == 0x100) #secondary 
-    temp_flagstat.append(flag & 0x800 == 0x800) #supplementary 
-    temp_flagstat.append(flag & 0x400 == 0x400) #duplicates
-    temp_flagstat.append(flag & 0x4 == 0) #mapped
-
-    #note: it is not stated in the samtools documentation, but the paired read statistics are *only* computed for primary reads, so we add a check that primary==1 for all remaining stats
-    primary= flag & 0x800 ==0  #primary
-    paired_in_sequencing= (flag & 0x1 == 0x1) & (primary==1)
-    temp_flagstat.append(paired_in_sequencing) #paired_in_sequencing 
-    temp_flagstat.append(paired_in_sequencing & (flag & 0x40 == 0x40)) #read1
-    temp_flagstat.append(paired_in_sequencing & (flag & 0x80 == 0x80)) #read2
-    temp_flagstat.append(paired_in_sequencing & (flag & 0x2==0x2) & (flag & 0x4==0)) #properly aligned 
-    with_itself_and_mate_mapped=(paired_in_sequencing & (flag & 0x4==0) & (flag & 0x8==0)) #with_itself_and_mate_mapped
-    temp_flagstat.append(with_itself_and_mate_mapped)
-    temp_flagstat.append(paired_in_sequencing & (flag & 0x8==0x8) & (flag & 0x4==0)) #singleton
-    with_mate_mapped_to_different_chrom=(with_itself_and_mate_mapped & (rnext !="="))
-    temp_flagstat.append(with_mate_mapped_to_different_chrom) #with_mate_mapped_to_different_chrom
-    temp_flagstat.append(with_mate_mapped_to_different_chrom & (mapq>=5)) #with_mate_mapped_to_different_chrom_q5
-    temp_flagstat.append(primary)
-    #compute bitwise or of cur_flagstat and temp_flagstat to see if a flag is set for any of the alignments for the given read 
-    #the first entry in cur_flagstat is the numpy array with stats for reads that pass qc; the second entry is the numpy array with stats for reads that fail qc 
-    if qc_passed==True:
-        cur_flagstat[0]=[i|j for i,j in zip(cur_flagstat[0],temp_flagstat)]
-    else:
-        cur_flagstat[1]=[i|j for i,j in zip(cur_flagstat[1],temp_flagstat)]
-    return cur_flagstat
+    index=mask_index(flag,mapq,rnext)
+    #compute bitwise or of the current mask and the alignment mask to see if a flag is set for any of the alignments for the given read 
+    #the read slot is selected by the segment bits (0x40/0x80) and the qc fail bit (0x200), see flagmask.read_slot 
+    cur_masks[((flag & 0xc0)>>5) | ((flag & 0x200)>>9)]|=mask_table[index]
+    if alignment_counts is not None: 
+        alignment_counts[index]+=1
+    return cur_masks
 
 
-def initialize_flagstat(): 
+def initialize_read_masks(): 
     '''
-    numpy array of length 14 (for the 13 metrics in flagstat + one entry to keep track of primary reads) keeps track of number of reads that meet the criteria for each of the 13 statistics 
-    numpy array initialized for qc_passed and qc_failed read subsets 
-    returns [qc_passed, qc_failed] list ofnumpy arrays 
-    initial read counts for each stat are set to 0 
+    per read name state: one slot per segment (unpaired, read1, read2, middle segments, selected by FLAG & 0xc0), each holding a [qc_passed, qc_failed] 
+    pair of flagstat masks (see flagmask.read_slot); single-end and paired-end alignments that share a QNAME are counted as separate reads 
+    returns the 8 masks, allocated once and reset in place by update_flagstat_for_readname 
     '''
-    qc_passed=[0]*14
-    qc_failed=[0]*14
-    flagstat=[qc_passed,qc_failed] 
-    return flagstat
+    return [0]*num_read_slots
 
 
-def update_flagstat_for_readname(global_flagstat, cur_flagstat_dict): 
+def update_flagstat_for_readname(global_mask_counts, cur_masks): 
     '''
-    global_flagstat -- flagstat statistics for the full dataset 
-    cur_flagstat -- flagstat statistics for a fixed QNAME+read1/read2 -- this is a dictionary of QNAME+read1/read2 for reads with same QNAME 
-    This function  updates the global_flagstat arrays with the count of flag stats for a given QNAME +SEQ 
+    global_mask_counts -- number of reads with each flagstat mask for the full dataset (see flagmask.initialize_mask_counts) 
+    cur_masks -- flagstat masks of the read slots for a fixed QNAME (see initialize_read_masks) 
+    This function  updates the global_mask_counts with the flag stats for a given QNAME, and resets cur_masks for the next QNAME 
     '''
-    for qname in cur_flagstat_dict:
-        cur_flagstat=cur_flagstat_dict[qname]
-        global_flagstat[0]=[i+j for i,j in zip(global_flagstat[0],cur_flagstat[0])]
-        global_flagstat[1]=[i+j for i,j in zip(global_flagstat[1],cur_flagstat[1])]
-    return global_flagstat
+    for slot in (0,2,4,6): 
+        #every alignment sets the primary or the supplementary bit, so an empty slot has no alignments 
+        if cur_masks[slot] or cur_masks[slot+1]: 
+            global_mask_counts[0][cur_masks[slot]]+=1
+            global_mask_counts[1][cur_masks[slot+1]]+=1
+            cur_masks[slot]=0
+            cur_masks[slot+1]=0
+    return global_mask_counts
 
 
-def main(): 
-    #read in the arguments 
-    args=parse_args() 
-    outf=args.outf
-    if args.sorted_sam_file=="-":
-        sam=sys.stdin
-    else:
-        sam=open(args.sorted_sam_file,'r') 
-    #13 stats that flagstats reports
-    # the order of the stat in the global_flagstat and cur_flagstat arrays matches the order of the stats list 
-    stats=['total',
-           'secondary',
-           'supplementary',
-           'duplicates',
-           'mapped',
-           'paired in sequencing',
-           'read1',
-           'read2',
-           'properly paired',
-           'with itself and mate mapped',
-           'singletons',
-           'with mate mapped to a different chr',
-           'with mate mapped to a different chr q5']
-
-    global_flagstat=initialize_flagstat() 
-
-    #since sorted_sam_file is sorted with SO=queryname, we keep track of statistics for a given read name and merge with the larger dict when no further reads 
+def count_read_masks(sam,chunk_size,alignment_counts=None,progress=None): 
+    '''
+    sam -- binary file handle for a SAM file sorted by read name 
+    chunk_size -- number of bytes to read at a time from sam (complete lines) 
+    alignment_counts -- optional per-alignment counts, updated in place (see flagmask.initialize_alignment_counts) 
+    progress -- optional progress state (see progress.initialize_progress), updated once per chunk 
+    returns the number of reads with each flagstat mask (see flagmask.initialize_mask_counts) 
+    '''
+    #reads are counted per flagstat mask while parsing, and expanded to the flagstat arrays once all reads are seen 
+    global_mask_counts=initialize_mask_counts() 
+
+    #since sorted_sam_file is sorted with SO=queryname, we keep track of statistics for a given read name and merge with the global counts when no further reads 
     #with that name are encountered 
     cur_seq_id=None
-    cur_seq_tokens=dict() 
+    cur_masks=initialize_read_masks() 
     #we read the input SAM file in chunks of size chunksize, iterating one line at a time 
     #skip comment lines in the header that start with @ 
     # use columns : 
@@ -168,55 +371,218 @@ def main():
     #    4 = MAPQ, 
     #    6 = RNEXT (reference name of the mate/next read) 
     # ignore all other columns 
-    print("starting flag calculation...") 
-    line_number=0
     while True:
-        cur_lines=sam.readlines(args.chunk_size)
+        cur_lines=sam.readlines(chunk_size)
         if len(cur_lines)==0:
             break 
+        if progress is not None: 
+            update_progress(progress,len(cur_lines),sum(map(len,cur_lines)),global_mask_counts) 
         for line in cur_lines: 
-            if line_number % args.chunk_size==0:
-                print(line_number)
-            line_number+=1
-            if line.startswith('@'):
-                #this is a comment, we skip
+            if line[0]==64:
+                #this is a comment starting with @, we skip
                 continue
-            tokens=line.split('\t')
+            #the columns after RNEXT are left unsplit in tokens[7] 
+            tokens=line.split(b'\t',7)
             flag=int(tokens[1]) 
-            mapq=int(tokens[4])
-            rnext=tokens[6] 
-            new_seq_id=tokens[0]
-            read2=str(flag & 0x80==0x80)
-            new_seq_id_expanded=tokens[0]+read2    
 
-            if new_seq_id!=cur_seq_id: 
+            #the read name boundary is found by comparing the raw QNAME bytes with the previous line 
+            if tokens[0]!=cur_seq_id: 
                 #we are finished processing the readname "cur_ID", updated the global flag statistics for full dataset with statistics for this read 
-                global_flagstat=update_flagstat_for_readname(global_flagstat,cur_seq_tokens) 
-                #reinitialize read-specific flagstat for current read name 
-                cur_seq_tokens=dict()
-            if new_seq_id_expanded not in cur_seq_tokens:
-                cur_seq_tokens[new_seq_id_expanded]=initialize_flagstat()
-            cur_seq_tokens[new_seq_id_expanded]=add_read_stats(flag,mapq,rnext,cur_seq_tokens[new_seq_id_expanded])
-            #update cur_seq_id to reflect the new_seq_id we have observed 
-            cur_seq_id=new_seq_id
+                #this also resets cur_masks for the current read name 
+                update_flagstat_for_readname(global_mask_counts,cur_masks) 
+                #update cur_seq_id to reflect the new_seq_id we have observed 
+                cur_seq_id=tokens[0]
+            #add_read_stats, inlined: the mask of the alignment is added to the slot of its segment and qc subset 
+            index=((flag & 0xfff)<<2) | ((tokens[6]!=b'=')<<1) | (int(tokens[4])>=5)
+            cur_masks[((flag & 0xc0)>>5) | ((flag & 0x200)>>9)]|=mask_table[index]
+            if alignment_counts is not None: 
+                alignment_counts[index]+=1
         
         
     #we have parsed all the reads in the file
-    global_flagstat=update_flagstat_for_readname(global_flagstat,cur_seq_tokens) 
-    #calculate % mapped, properly paired, singletons from total primary reads 
-    #note: 4, 8, 10 are the numpy array indices in global_flagstat where the counts for these fields are stored 
-    print("finished parsing lines, summarizing...") 
-    percent_mapped=calculate_percent(4,global_flagstat)
-    percent_properly_paired=calculate_percent(8,global_flagstat) 
-    percent_singletons=calculate_percent(10,global_flagstat) 
-    
-    #write the output file 
-    write_output_file(args.outf,
-                      stats,
-                      global_flagstat,
-                      percent_mapped,
-                      percent_properly_paired,
-                      percent_singletons)
+    update_flagstat_for_readname(global_mask_counts,cur_masks) 
+    return global_mask_counts
+
+
+def count_alignment_masks(alignments,alignment_counts=None,progress=None): 
+    '''
+    alignments -- iterator of (QNAME, FLAG, MAPQ, RNEXT) tuples for a file sorted by read name, i.e. from the BAM/CRAM readers in bam.py 
+    alignment_counts -- optional per-alignment counts, updated in place (see flagmask.initialize_alignment_counts) 
+    progress -- optional progress state (see progress.initialize_progress), updated every progress_batch_size alignments (the number of 
+    compressed bytes read is not known here) 
+    returns the number of reads with each flagstat mask (see flagmask.initialize_mask_counts) 
+    '''
+    global_mask_counts=initialize_mask_counts() 
+    cur_seq_id=None
+    cur_masks=initialize_read_masks() 
+    if progress is not None: 
+        alignments=counted_alignments(alignments,progress,global_mask_counts) 
+    for new_seq_id,flag,mapq,rnext in alignments: 
+        if new_seq_id!=cur_seq_id: 
+            #we are finished processing the readname "cur_ID", updated the global flag statistics for full dataset with statistics for this read 
+            update_flagstat_for_readname(global_mask_counts,cur_masks) 
+            cur_seq_id=new_seq_id
+        add_read_stats(flag,mapq,rnext,cur_masks,alignment_counts)
+    update_flagstat_for_readname(global_mask_counts,cur_masks) 
+    return global_mask_counts
+
+
+def counted_alignments(alignments,progress,global_mask_counts): 
+    '''
+    yields the alignments unchanged, updating progress once per progress_batch_size alignments 
+    '''
+    for batch in iter(lambda: list(islice(alignments,progress_batch_size)),[]): 
+        update_progress(progress,len(batch),0,global_mask_counts) 
+        for alignment in batch: 
+            yield alignment
+
+
+def main(): 
+    #SAMstats merge <partial files> adds up the partial-result files of --partial_outf 
+    if len(sys.argv)>1 and sys.argv[1]=="merge": 
+        from .partial import merge_main
+        merge_main(sys.argv[2:]) 
+        return 
+    #read in the arguments 
+    args=parse_args() 
+    if args.profile_dump is not None: 
+        from .profiling import profiled_call, dump_profilers
+        profilers=[]
+        profiled_call(profilers,run,args) 
+        dump_profilers(profilers,args.profile_dump) 
+    else: 
+        run(args) 
+
+
+def run(args): 
+    '''
+    computes and writes the statistics for the parsed arguments of main 
+    '''
+    profile=None
+    if args.profile: 
+        from .profiling import initialize_profile, add_time, finish_profile, write_profiles
+        profile=initialize_profile() 
+
+    sample=args.sample_name
+    if sample is None: 
+        sample=os.path.basename(args.sorted_sam_file)
+    #progress is reported on stderr, stdout only has the statistics when --outf is not given 
+    progress=None
+    total_bytes=input_size(args.sorted_sam_file) 
+    if total_bytes is not None and args.input_format=="sam" and file_compression(args.sorted_sam_file) is not None: 
+        #the progress counts decompressed bytes, the size of a compressed file gives no ETA 
+        total_bytes=None
+    if not args.quiet: 
+        print("starting flag calculation...",file=sys.stderr) 
+        progress=initialize_progress(total_bytes,args.progress_interval,args.metrics_file,sample)
+    elif args.metrics_file is not None: 
+        progress=initialize_progress(total_bytes,args.progress_interval,args.metrics_file,sample,open(os.devnull,'w'))
+    #per-alignment counts are only kept with --per_alignment 
+    alignment_counts=None
+    if args.per_alignment: 
+        alignment_counts=initialize_alignment_counts() 
+    group_counts=None
+    unfiltered_mask_counts=None
+    filtered_counts=None
+    if args.group_by is not None: 
+        from .groups import group_mask_counts, sum_mask_counts
+        group_counts=group_mask_counts(args.sorted_sam_file,args.group_by,args.input_format,args.reference,args.chunk_size) 
+        global_mask_counts=sum_mask_counts(group_counts) 
+    elif args.filtering: 
+        from .filters import filtered_mask_counts
+        writer=None
+        if args.filtered_output is not None: 
+            from .alignment_writer import initialize_alignment_writer
+            output_format=args.filtered_output_format
+            if output_format=="auto": 
+                output_format="bam" if args.filtered_output.endswith('.bam') else "sam"
+            writer=initialize_alignment_writer(args.filtered_output,output_format)
+        unfiltered_mask_counts,filtered_counts=filtered_mask_counts(args.sorted_sam_file,
+                                                                    args.alignment_filter,
+                                                                    args.input_format,
+                                                                    args.reference,
+                                                                    args.chunk_size,
+                                                                    writer)
+        global_mask_counts=filtered_counts if args.filter_before_stat else unfiltered_mask_counts
+    elif args.checkpoint is not None: 
+        from .checkpoint import checkpoint_mask_counts
+        global_mask_counts=checkpoint_mask_counts(args.sorted_sam_file,
+                                                  args.chunk_size,
+                                                  args.checkpoint,
+                                                  sample,
+                                                  args.checkpoint_alignments,
+                                                  args.checkpoint_seconds,
+                                                  args.resume,
+                                                  progress,
+                                                  args.quiet)
+    elif args.coordinate_sorted: 
+        from .coordinate import coordinate_mask_counts, iter_sam_alignment_tags
+        if args.input_format=="bam": 
+            from .bam import iter_bam_alignment_tags
+            bam=open_input(args.sorted_sam_file,True,args.read_ahead_mb) 
+            alignments=iter_bam_alignment_tags(bam,args.chunk_size)
+        elif args.input_format=="cram": 
+            from .bam import iter_cram_alignments
+            alignments=iter_cram_alignments(args.sorted_sam_file,args.reference,tags=True)
+        else: 
+            sam=open_input(args.sorted_sam_file,False,args.read_ahead_mb,True,args.decompress_threads) 
+            alignments=iter_sam_alignment_tags(sam,args.chunk_size)
+        if progress is not None: 
+            alignments=counted_alignments(alignments,progress,None) 
+        global_mask_counts=coordinate_mask_counts(alignments,args.max_pending_reads,args.spill_dir,alignment_counts,args.quiet) 
+    elif args.mmap: 
+        from .scanner import mmap_mask_counts
+        global_mask_counts=mmap_mask_counts(args.sorted_sam_file,args.chunk_size,progress=progress) 
+    elif args.engine=="numpy": 
+        #numpy is only needed for the vectorized engine 
+        from .batch import batch_mask_counts
+        sam=open_input(args.sorted_sam_file,True,args.read_ahead_mb,True,args.decompress_threads) 
+        global_mask_counts=batch_mask_counts(sam,args.chunk_size,progress) 
+    elif args.engine=="bytes": 
+        from .scanner import scan_mask_counts
+        sam=open_input(args.sorted_sam_file,True,args.read_ahead_mb,True,args.decompress_threads) 
+        global_mask_counts=scan_mask_counts(sam,args.chunk_size,progress) 
+    elif args.input_format=="bam": 
+        from .bam import iter_bam_alignments
+        bam=open_input(args.sorted_sam_file,True,args.read_ahead_mb) 
+        global_mask_counts=count_alignment_masks(iter_bam_alignments(bam,args.chunk_size),alignment_counts,progress) 
+    elif args.input_format=="cram": 
+        from .bam import iter_cram_alignments
+        global_mask_counts=count_alignment_masks(iter_cram_alignments(args.sorted_sam_file,args.reference),alignment_counts,progress) 
+    else: 
+        sam=open_input(args.sorted_sam_file,True,args.read_ahead_mb,True,args.decompress_threads) 
+        if profile is not None: 
+            from .profiling import profiled_count_read_masks
+            global_mask_counts=profiled_count_read_masks(sam,args.chunk_size,profile,alignment_counts,progress) 
+        else: 
+            global_mask_counts=count_read_masks(sam,args.chunk_size,alignment_counts,progress) 
+    if profile is not None and sum([calls for seconds,calls in profile['stages'].values()])==0: 
+        #engines without the instrumented loop are timed as a whole 
+        add_time(profile,'count',time.perf_counter()-profile['start']) 
+    #the filter and group passes do not report progress 
+    if progress is not None and progress['alignments']>0: 
+        finish_progress(progress,global_mask_counts) 
+    if not args.quiet: 
+        print("finished parsing lines, summarizing...",file=sys.stderr) 
+    if args.partial_outf is not None: 
+        from .partial import write_partial, flagstat_counters
+        write_partial(args.partial_outf,"flagstat",sample,flagstat_counters(global_mask_counts,
+                                                                            alignment_counts,
+                                                                            group_counts,
+                                                                            unfiltered_mask_counts,
+                                                                            filtered_counts))
+    if profile is not None: 
+        output_start=time.perf_counter() 
+    write_flagstat_reports(args,
+                           sample,
+                           global_mask_counts,
+                           alignment_counts,
+                           group_counts,
+                           unfiltered_mask_counts,
+                           filtered_counts)
+    if profile is not None: 
+        add_time(profile,'output',time.perf_counter()-output_start) 
+        write_profiles([('SAMstats',finish_profile(profile))],args.profile_outf) 
 
 if __name__=="__main__": 
     main() 
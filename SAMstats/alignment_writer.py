@@ -0,0 +1,109 @@
+## Buffered writer for the alignments that pass through SAMstats (NH tagging, MAPQ/FLAG/contig filters, see filters.py).
+## SAM lines are collected in a list and written with a single write call once buffer_size bytes are pending, instead of one print per line.
+## BAM output is BGZF compressed by pysam (htslib), which buffers the records itself; SAM lines are converted with the header of the input.
+## The header is collected by the input iterators while they read it (see complexity.iter_sam_alignments), so the output is opened at the first record.
+import sys
+from .filters import passes_filter
+
+#default number of pending output bytes that triggers a write
+default_buffer_size=1<<22
+
+
+def initialize_alignment_writer(output,output_format="sam",buffer_size=default_buffer_size,alignment_filter=None):
+    '''
+    output -- file name for the alignments, '-' for stdout
+    output_format -- sam or bam (requires pysam)
+    alignment_filter -- optional filter, only the alignments that pass it are written (see filters.initialize_alignment_filter)
+    returns the writer state; the header lines (or a pysam header) are appended to writer['header'] by the input iterator
+    '''
+    return {'output':output,
+            'format':output_format,
+            'buffer_size':buffer_size,
+            'filter':alignment_filter,
+            'header':[],
+            'out':None,
+            'pysam_header':None,
+            'buffer':[],
+            'buffered':0,
+            'written':0,
+            'filtered':0}
+
+
+def open_output(writer):
+    '''
+    opens the output once the header is known, and writes the header of SAM output
+    '''
+    header_text=''.join([str(header) for header in writer['header']])
+    if writer['format']=="bam":
+        #pysam is only needed for BAM output
+        import pysam
+        writer['pysam_header']=pysam.AlignmentHeader.from_text(header_text)
+        writer['out']=pysam.AlignmentFile(writer['output'],'wb',header=writer['pysam_header'])
+    else:
+        writer['out']=sys.stdout if writer['output']=="-" else open(writer['output'],'w')
+        if len(header_text)>0:
+            add_to_buffer(writer,header_text)
+
+
+def add_to_buffer(writer,text):
+    writer['buffer'].append(text)
+    writer['buffered']+=len(text)
+    if writer['buffered']>=writer['buffer_size']:
+        flush_alignment_writer(writer)
+
+
+def flush_alignment_writer(writer):
+    '''
+    writes the pending SAM lines with one write call
+    '''
+    if len(writer['buffer'])>0:
+        writer['out'].write(''.join(writer['buffer']))
+        writer['buffer']=[]
+        writer['buffered']=0
+
+
+def write_alignment(writer,record,nh=None):
+    '''
+    record -- SAM line (with or without the newline) or pysam AlignedSegment
+    nh -- NH tag value to add to the alignment, unless it already has an NH tag
+    '''
+    if writer['out'] is None:
+        open_output(writer)
+    if isinstance(record,str):
+        if writer['filter'] is not None:
+            tokens=record.split('\t',5)
+            if not passes_filter(writer['filter'],int(tokens[1]),int(tokens[4]),tokens[2]):
+                writer['filtered']+=1
+                return
+        line=record.rstrip('\n')
+        if nh is not None and '\tNH:i:' not in line:
+            line+='\tNH:i:'+str(nh)
+        if writer['format']=="bam":
+            import pysam
+            writer['out'].write(pysam.AlignedSegment.fromstring(line,writer['pysam_header']))
+        else:
+            add_to_buffer(writer,line+'\n')
+    else:
+        if writer['filter'] is not None and not passes_filter(writer['filter'],record.flag,record.mapping_quality,record.reference_name or '*'):
+            writer['filtered']+=1
+            return
+        if nh is not None and not record.has_tag('NH'):
+            record.set_tag('NH',nh,'i')
+        if writer['format']=="bam":
+            writer['out'].write(record)
+        else:
+            add_to_buffer(writer,record.to_string()+'\n')
+    writer['written']+=1
+
+
+def close_alignment_writer(writer):
+    '''
+    writes the pending lines and closes the output (the header is written even if there were no alignments)
+    '''
+    if writer['out'] is None:
+        open_output(writer)
+    flush_alignment_writer(writer)
+    if writer['format']=="bam" or writer['out'] is not sys.stdout:
+        writer['out'].close()
+    else:
+        writer['out'].flush()
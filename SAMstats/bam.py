@@ -0,0 +1,259 @@
+## Reads the alignment fields needed for flagstat (QNAME, FLAG, MAPQ, RNEXT) directly from BAM and CRAM files.
+## BAM records are decoded from the BGZF blocks with struct: only the fixed-length core of each record and the read name are
+## unpacked, CIGAR/SEQ/QUAL/tags are skipped using the record's block_size.
+## CRAM decoding is delegated to pysam (optional dependency), restricted to the fields that are used.
+import struct
+from .bgzf import decompressed_chunks
+
+#block_size, refID, (pos), l_read_name, mapq, (bin, n_cigar_op), flag, (l_seq), next_refID
+bam_core=struct.Struct('<ii4xBB4xH4xi')
+#block_size, refID, (pos), l_read_name, mapq, (bin), n_cigar_op, flag, l_seq, next_refID
+bam_core_lengths=struct.Struct('<ii4xBB2xHHii')
+#the read name starts after the 36 bytes of block_size and the fixed-length fields
+read_name_offset=36
+#size in bytes of the fixed-size optional field types
+aux_type_sizes={ord('A'):1,ord('c'):1,ord('C'):1,ord('s'):2,ord('S'):2,ord('i'):4,ord('I'):4,ord('f'):4}
+#struct formats of the integer optional field types
+aux_int_formats={ord('c'):'<b',ord('C'):'<B',ord('s'):'<h',ord('S'):'<H',ord('i'):'<i',ord('I'):'<I'}
+
+
+def rnext_name(ref_id,next_ref_id,references):
+    '''
+    returns the RNEXT column as samtools view would print it
+    '''
+    if next_ref_id<0:
+        return "*"
+    if next_ref_id==ref_id:
+        return "="
+    return references[next_ref_id]
+
+
+def read_bam_header(buf,chunks):
+    '''
+    buf -- decompressed bytes at the start of the BAM file
+    chunks -- iterator of the remaining decompressed bytes
+    returns (header_text, reference names, buf, offset) where buf[offset:] holds the first alignment records
+    '''
+    def ensure(buf,offset,size):
+        while len(buf)-offset<size:
+            chunk=next(chunks,None)
+            if chunk is None:
+                raise ValueError("truncated BAM header")
+            buf=buf[offset:]+chunk
+            offset=0
+        return buf,offset
+
+    buf,offset=ensure(buf,0,8)
+    if buf[offset:offset+4]!=b'BAM\1':
+        raise ValueError("input is not a BAM file")
+    l_text=struct.unpack_from('<i',buf,offset+4)[0]
+    offset+=8
+    buf,offset=ensure(buf,offset,l_text+4)
+    header_text=buf[offset:offset+l_text].rstrip(b'\0').decode()
+    n_ref=struct.unpack_from('<i',buf,offset+l_text)[0]
+    offset+=l_text+4
+    references=[]
+    for i in range(n_ref):
+        buf,offset=ensure(buf,offset,4)
+        l_name=struct.unpack_from('<i',buf,offset)[0]
+        buf,offset=ensure(buf,offset,l_name+8)
+        references.append(buf[offset+4:offset+3+l_name].decode())
+        offset+=l_name+8
+    return header_text,references,buf,offset
+
+
+def iter_bam_records(bam,chunk_size,record_fields):
+    '''
+    bam -- binary file handle for a BAM file
+    chunk_size -- number of compressed bytes to decompress at a time
+    record_fields -- function(buf, offset, record_end, references) returning the fields of the record at buf[offset:record_end]
+    yields record_fields for every alignment record, including the records decompressed together with the header
+    '''
+    chunks=decompressed_chunks(bam,chunk_size)
+    header_text,references,buf,offset=read_bam_header(next(chunks,b''),chunks)
+    unpack_from=struct.Struct('<i').unpack_from
+    while True:
+        end=len(buf)
+        while offset+read_name_offset<=end:
+            record_end=offset+4+unpack_from(buf,offset)[0]
+            if record_end>end:
+                #the record continues in the next chunk
+                break
+            yield record_fields(buf,offset,record_end,references)
+            offset=record_end
+        chunk=next(chunks,None)
+        if chunk is None:
+            break
+        buf=buf[offset:]+chunk
+        offset=0
+    if offset!=len(buf):
+        raise ValueError("truncated BAM record at the end of the file")
+
+
+def alignment_fields(buf,offset,record_end,references):
+    '''
+    returns (QNAME, FLAG, MAPQ, RNEXT) for the record at buf[offset:record_end]; QNAME is returned as bytes
+    '''
+    block_size,ref_id,l_read_name,mapq,flag,next_ref_id=bam_core.unpack_from(buf,offset)
+    qname=buf[offset+read_name_offset:offset+read_name_offset+l_read_name-1]
+    if next_ref_id==ref_id and next_ref_id>=0:
+        rnext="="
+    else:
+        rnext=rnext_name(ref_id,next_ref_id,references)
+    return qname,flag,mapq,rnext
+
+
+def iter_bam_alignments(bam,chunk_size):
+    '''
+    bam -- binary file handle for a BAM file
+    chunk_size -- number of compressed bytes to decompress at a time
+    yields (QNAME, FLAG, MAPQ, RNEXT) for every alignment record; QNAME is returned as bytes
+    '''
+    return iter_bam_records(bam,chunk_size,alignment_fields)
+
+
+def read_nh_sa(buf,offset,end):
+    '''
+    buf -- decompressed BAM data
+    offset, end -- position of the optional fields of a record in buf
+    returns (NH, number of SA entries); NH is None if the record has no NH tag and the count is 0 without an SA tag
+    '''
+    nh=None
+    num_sa=0
+    while offset+3<=end:
+        tag=buf[offset:offset+2]
+        val_type=buf[offset+2]
+        offset+=3
+        if val_type in aux_type_sizes:
+            if tag==b'NH' and val_type in aux_int_formats:
+                nh=struct.unpack_from(aux_int_formats[val_type],buf,offset)[0]
+            offset+=aux_type_sizes[val_type]
+        elif val_type==90 or val_type==72:
+            #Z or H, NUL terminated string
+            value_end=buf.index(b'\0',offset,end)
+            if tag==b'SA':
+                num_sa=len([entry for entry in buf[offset:value_end].split(b';') if len(entry)>0])
+            offset=value_end+1
+        elif val_type==66:
+            #B, typed array
+            sub_type=buf[offset]
+            count=struct.unpack_from('<i',buf,offset+1)[0]
+            offset+=5+count*aux_type_sizes[sub_type]
+        else:
+            raise ValueError("invalid optional field type in BAM record")
+    return nh,num_sa
+
+
+def read_string_tag(buf,offset,end,name):
+    '''
+    buf -- decompressed BAM data
+    offset, end -- position of the optional fields of a record in buf
+    name -- two-letter tag as bytes, i.e. b'RG'
+    returns the value of the Z (string) tag name, or None if the record does not have it
+    '''
+    while offset+3<=end:
+        tag=buf[offset:offset+2]
+        val_type=buf[offset+2]
+        offset+=3
+        if val_type in aux_type_sizes:
+            offset+=aux_type_sizes[val_type]
+        elif val_type==90 or val_type==72:
+            #Z or H, NUL terminated string
+            value_end=buf.index(b'\0',offset,end)
+            if tag==name and val_type==90:
+                return buf[offset:value_end].decode()
+            offset=value_end+1
+        elif val_type==66:
+            #B, typed array
+            sub_type=buf[offset]
+            count=struct.unpack_from('<i',buf,offset+1)[0]
+            offset+=5+count*aux_type_sizes[sub_type]
+        else:
+            raise ValueError("invalid optional field type in BAM record")
+    return None
+
+
+def alignment_aux_fields(buf,offset,references):
+    '''
+    returns (QNAME, FLAG, MAPQ, RNEXT, offset of the optional fields) for the record starting at buf[offset]
+    '''
+    block_size,ref_id,l_read_name,mapq,n_cigar_op,flag,l_seq,next_ref_id=bam_core_lengths.unpack_from(buf,offset)
+    qname=buf[offset+read_name_offset:offset+read_name_offset+l_read_name-1]
+    if next_ref_id==ref_id and next_ref_id>=0:
+        rnext="="
+    else:
+        rnext=rnext_name(ref_id,next_ref_id,references)
+    #the optional fields follow the read name, CIGAR, SEQ and QUAL
+    aux_offset=offset+read_name_offset+l_read_name+4*n_cigar_op+(l_seq+1)//2+l_seq
+    return qname,flag,mapq,rnext,aux_offset
+
+
+def read_group_fields(buf,offset,record_end,references):
+    '''
+    returns (QNAME, FLAG, MAPQ, RNEXT, RG) for the record at buf[offset:record_end]
+    '''
+    qname,flag,mapq,rnext,aux_offset=alignment_aux_fields(buf,offset,references)
+    return qname,flag,mapq,rnext,read_string_tag(buf,aux_offset,record_end,b'RG')
+
+
+def iter_bam_alignment_read_groups(bam,chunk_size):
+    '''
+    bam -- binary file handle for a BAM file
+    chunk_size -- number of compressed bytes to decompress at a time
+    yields (QNAME, FLAG, MAPQ, RNEXT, RG) for every alignment record; RG is None if the record has no RG tag
+    '''
+    return iter_bam_records(bam,chunk_size,read_group_fields)
+
+
+def tag_fields(buf,offset,record_end,references):
+    '''
+    returns (QNAME, FLAG, MAPQ, RNEXT, NH, number of SA entries) for the record at buf[offset:record_end]
+    '''
+    qname,flag,mapq,rnext,aux_offset=alignment_aux_fields(buf,offset,references)
+    nh,num_sa=read_nh_sa(buf,aux_offset,record_end)
+    return qname,flag,mapq,rnext,nh,num_sa
+
+
+def iter_bam_alignment_tags(bam,chunk_size):
+    '''
+    bam -- binary file handle for a BAM file
+    chunk_size -- number of compressed bytes to decompress at a time
+    yields (QNAME, FLAG, MAPQ, RNEXT, NH, number of SA entries) for every alignment record (see read_nh_sa)
+    '''
+    return iter_bam_records(bam,chunk_size,tag_fields)
+
+
+def iter_cram_alignments(cram_file,reference=None,tags=False,read_group=False):
+    '''
+    cram_file -- path to a CRAM file ('-' for stdin)
+    reference -- FASTA file the CRAM file was compressed against
+    tags -- also decode the optional fields and add NH and the number of SA entries to each tuple (see read_nh_sa)
+    read_group -- also decode the optional fields and add RG (None if missing) to each tuple
+    yields (QNAME, FLAG, MAPQ, RNEXT) for every alignment record using pysam
+    '''
+    #pysam is only needed for CRAM input
+    import pysam
+    #only decode QNAME (0x1), FLAG (0x2), RNAME (0x4), MAPQ (0x10) and RNEXT (0x40), skipping SEQ/QUAL/tags
+    required_fields=0x57
+    if tags or read_group:
+        #AUX (0x800)
+        required_fields|=0x800
+    cram=pysam.AlignmentFile(cram_file,'rc',
+                             reference_filename=reference,
+                             format_options=[("required_fields=%#x" % required_fields).encode()])
+    references=cram.references
+    for alignment in cram:
+        fields=(alignment.query_name,
+                alignment.flag,
+                alignment.mapping_quality,
+                rnext_name(alignment.reference_id,alignment.next_reference_id,references))
+        if tags:
+            nh=alignment.get_tag('NH') if alignment.has_tag('NH') else None
+            num_sa=0
+            if alignment.has_tag('SA'):
+                num_sa=len([entry for entry in alignment.get_tag('SA').split(';') if len(entry)>0])
+            fields+=(nh,num_sa)
+        if read_group:
+            fields+=(alignment.get_tag('RG') if alignment.has_tag('RG') else None,)
+        yield fields
+    cram.close()
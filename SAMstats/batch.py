@@ -0,0 +1,145 @@
+## Vectorized flagstat counting for name-sorted SAM input.
+## Each chunk of the file is parsed into column arrays (QNAME run codes, FLAG, MAPQ, RNEXT=="=") with numpy,
+## alignments are OR-reduced per read with np.bitwise_or.reduceat over QNAME run boundaries,
+## and the resulting per-read masks are summed into the global mask counts with np.bincount.
+## The last read name of every chunk is carried over to the next chunk, since its alignments may continue there.
+import numpy as np
+from .flagmask import mask_table, num_masks
+from .progress import update_progress
+
+mask_table_array=np.array(mask_table,dtype=np.int64)
+
+
+def parse_int_field(buf,starts,ends,max_digits):
+    '''
+    parses the unsigned integer fields buf[starts[i]:ends[i]] for all rows at once
+    '''
+    values=np.zeros(len(starts),dtype=np.int64)
+    last=len(buf)-1
+    for k in range(max_digits):
+        pos=starts+k
+        digits=buf[np.minimum(pos,last)].astype(np.int64)-48
+        values=np.where(pos<ends,values*10+digits,values)
+    return values
+
+
+def qname_run_starts(buf,starts,ends):
+    '''
+    returns a boolean array that is True for every row whose QNAME differs from the QNAME of the previous row
+    '''
+    lengths=ends-starts
+    new_run=np.ones(len(starts),dtype=bool)
+    if len(starts)<2:
+        return new_run
+    #pad the QNAMEs into a 2D byte array so that neighbouring rows can be compared column-wise
+    columns=np.arange(lengths.max())
+    padded=buf[np.minimum(starts[:,None]+columns,len(buf)-1)]
+    padded[columns>=lengths[:,None]]=0
+    new_run[1:]=(lengths[1:]!=lengths[:-1]) | np.any(padded[1:]!=padded[:-1],axis=1)
+    return new_run
+
+
+def parse_chunk(data):
+    '''
+    data -- bytes holding complete SAM lines
+    returns (line_starts, run_starts, flag, mapq, rnext_is_same) arrays for the alignment lines in data; header lines are skipped
+    '''
+    buf=np.frombuffer(data,dtype=np.uint8)
+    line_ends=np.flatnonzero(buf==10)
+    line_starts=np.empty(len(line_ends),dtype=np.int64)
+    line_starts[0:1]=0
+    line_starts[1:]=line_ends[:-1]+1
+    #skip comment lines in the header that start with @ and empty lines
+    keep=(line_ends>line_starts)
+    keep[keep]=buf[line_starts[keep]]!=64
+    line_starts=line_starts[keep]
+    #tab k of a line is the k-th tab at or after the start of the line
+    # use columns :
+    #    0 = QNAME,
+    #    1 = FLAG,
+    #    4 = MAPQ,
+    #    6 = RNEXT (reference name of the mate/next read)
+    tabs=np.flatnonzero(buf==9)
+    first_tab=np.searchsorted(tabs,line_starts)
+    qname_ends=tabs[first_tab]
+    flag=parse_int_field(buf,qname_ends+1,tabs[first_tab+1],5)
+    mapq=parse_int_field(buf,tabs[first_tab+3]+1,tabs[first_tab+4],3)
+    rnext_starts=tabs[first_tab+5]+1
+    rnext_is_same=(tabs[first_tab+6]-rnext_starts==1) & (buf[rnext_starts]==61)
+    run_starts=qname_run_starts(buf,line_starts,qname_ends)
+    return line_starts,run_starts,flag,mapq,rnext_is_same
+
+
+def add_chunk_mask_counts(run_starts,flag,mapq,rnext_is_same,mask_counts):
+    '''
+    OR-reduces the alignment masks for each QNAME+segment group (unpaired, read1, read2, middle, see flagmask.read_slot) and adds the per-read masks to mask_counts
+    '''
+    masks=mask_table_array[((flag & 0xfff)<<2) | ((~rnext_is_same).astype(np.int64)<<1) | (mapq>=5)]
+    qc_failed=(flag & 0x200)!=0
+    masks_per_qc=[np.where(qc_failed,0,masks),np.where(qc_failed,masks,0)]
+    run_ids=np.cumsum(run_starts)
+    segment=(flag & 0xc0)>>6
+    #within a read name, the alignments of the segments may be interleaved; the alignments for each segment are contiguous in run_ids once the segments are selected separately
+    for cur_segment in range(4):
+        rows=np.flatnonzero(segment==cur_segment)
+        if len(rows)==0:
+            continue
+        mate_run_ids=run_ids[rows]
+        boundaries=np.flatnonzero(np.concatenate(([True],mate_run_ids[1:]!=mate_run_ids[:-1])))
+        for qc in range(2):
+            read_masks=np.bitwise_or.reduceat(masks_per_qc[qc][rows],boundaries)
+            mask_counts[qc]+=np.bincount(read_masks,minlength=num_masks)
+    return mask_counts
+
+
+def count_chunk(data,mask_counts,final):
+    '''
+    adds the reads in data to mask_counts
+    unless this is the final chunk, the alignments for the last read name are left out since they may continue in the next chunk
+    returns the number of bytes of data that were consumed
+    '''
+    if len(data)==0:
+        return 0
+    line_starts,run_starts,flag,mapq,rnext_is_same=parse_chunk(data)
+    if len(line_starts)==0:
+        return len(data)
+    if final:
+        num_rows=len(line_starts)
+        consumed=len(data)
+    else:
+        num_rows=np.flatnonzero(run_starts)[-1]
+        consumed=int(line_starts[num_rows])
+    if num_rows>0:
+        add_chunk_mask_counts(run_starts[:num_rows],flag[:num_rows],mapq[:num_rows],rnext_is_same[:num_rows],mask_counts)
+    return consumed
+
+
+def batch_mask_counts(sam,chunk_size,progress=None):
+    '''
+    sam -- binary file handle for a SAM file sorted by read name
+    chunk_size -- number of bytes to read at a time
+    progress -- optional progress state (see progress.initialize_progress), updated once per chunk
+    returns the number of reads with each flagstat mask as [qc_passed, qc_failed] lists (see flagmask.initialize_mask_counts)
+    '''
+    mask_counts=[np.zeros(num_masks,dtype=np.int64),np.zeros(num_masks,dtype=np.int64)]
+    pending=b''
+    while True:
+        data=sam.read(chunk_size)
+        final=len(data)==0
+        buf=pending+data
+        if final:
+            if len(buf)>0 and not buf.endswith(b'\n'):
+                buf+=b'\n'
+            rest=b''
+        else:
+            #only complete lines are parsed, the partial last line is kept for the next chunk
+            cut=buf.rfind(b'\n')+1
+            rest=buf[cut:]
+            buf=buf[:cut]
+        consumed=count_chunk(buf,mask_counts,final)
+        pending=buf[consumed:]+rest
+        if progress is not None:
+            update_progress(progress,data.count(b'\n'),len(data),mask_counts)
+        if final:
+            break
+    return [mask_counts[0].tolist(),mask_counts[1].tolist()]
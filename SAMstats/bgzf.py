@@ -0,0 +1,116 @@
+## Minimal reader for BGZF, the blocked gzip format used by BAM files (https://samtools.github.io/hts-specs/SAMv1.pdf, section 4.1).
+## Every BGZF block is an independent gzip member of at most 64 KB whose total size is stored in the BC extra subfield,
+## so blocks can be located without decompressing them and each block can be inflated on its own.
+import struct
+import zlib
+
+#ID1, ID2, CM, FLG, MTIME, XFL, OS, XLEN
+gzip_header=struct.Struct('<BBBBIBBH')
+#SI1, SI2, SLEN
+extra_subfield_header=struct.Struct('<BBH')
+#CRC32, ISIZE
+gzip_footer=struct.Struct('<II')
+
+
+def block_size_from_header(header,extra):
+    '''
+    header -- the fixed 12 byte gzip member header
+    extra -- the XLEN bytes of extra subfields that follow it
+    returns the total size in bytes of the BGZF block (BSIZE+1)
+    '''
+    id1,id2,cm,flg,mtime,xfl,os_id,xlen=gzip_header.unpack(header)
+    if id1!=31 or id2!=139 or cm!=8 or not flg & 0x4:
+        raise ValueError("input is not BGZF compressed")
+    offset=0
+    while offset+4<=len(extra):
+        si1,si2,slen=extra_subfield_header.unpack_from(extra,offset)
+        if si1==66 and si2==67 and slen==2:
+            return struct.unpack_from('<H',extra,offset+4)[0]+1
+        offset+=4+slen
+    raise ValueError("gzip member is missing the BGZF BC subfield")
+
+
+def read_block(f):
+    '''
+    reads the next compressed BGZF block from the binary file handle f
+    returns the raw block as bytes, or None at the end of the file
+    '''
+    header=f.read(gzip_header.size)
+    if len(header)==0:
+        return None
+    if len(header)<gzip_header.size:
+        raise ValueError("truncated BGZF block header")
+    xlen=gzip_header.unpack(header)[-1]
+    extra=f.read(xlen)
+    block_size=block_size_from_header(header,extra)
+    rest=f.read(block_size-gzip_header.size-xlen)
+    if len(rest)!=block_size-gzip_header.size-xlen:
+        raise ValueError("truncated BGZF block")
+    return header+extra+rest
+
+
+def iter_blocks(f):
+    '''
+    yields the raw compressed BGZF blocks of the binary file handle f in order
+    '''
+    while True:
+        block=read_block(f)
+        if block is None:
+            return
+        yield block
+
+
+def decompress_block(block):
+    '''
+    inflates a single raw BGZF block, checking the uncompressed size stored in the block footer
+    '''
+    xlen=gzip_header.unpack_from(block)[-1]
+    data=zlib.decompress(block[gzip_header.size+xlen:-gzip_footer.size],-15)
+    crc,isize=gzip_footer.unpack_from(block,len(block)-gzip_footer.size)
+    if len(data)!=isize:
+        raise ValueError("BGZF block size does not match its footer")
+    return data
+
+
+def block_batches(f,chunk_size):
+    '''
+    yields lists of consecutive raw BGZF blocks of f, of roughly chunk_size compressed bytes each
+    '''
+    blocks=[]
+    compressed_size=0
+    for block in iter_blocks(f):
+        blocks.append(block)
+        compressed_size+=len(block)
+        if compressed_size>=chunk_size:
+            yield blocks
+            blocks=[]
+            compressed_size=0
+    if len(blocks)>0:
+        yield blocks
+
+
+def decompress_blocks(blocks):
+    return b''.join(map(decompress_block,blocks))
+
+
+def decompressed_chunks(f,chunk_size,threads=1):
+    '''
+    yields the decompressed contents of the BGZF file handle f, decompressing roughly chunk_size compressed bytes at a time
+    threads -- number of threads that decompress the batches of blocks; zlib releases the GIL while inflating, so the batches are decompressed
+    in parallel while the caller parses the previous ones, and they are still yielded in file order
+    '''
+    if threads<=1:
+        for blocks in block_batches(f,chunk_size):
+            yield decompress_blocks(blocks)
+        return
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(threads) as pool:
+        #at most two batches per thread are decompressed ahead of the caller
+        pending=deque()
+        for blocks in block_batches(f,chunk_size):
+            pending.append(pool.submit(decompress_blocks,blocks))
+            if len(pending)>=2*threads:
+                yield pending.popleft().result()
+        while len(pending)>0:
+            yield pending.popleft().result()
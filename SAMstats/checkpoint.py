@@ -0,0 +1,158 @@
+## Checkpoint and resume for long runs on name-sorted SAM input.
+## The counting loop saves a checkpoint every checkpoint_alignments lines or checkpoint_seconds seconds, whichever comes first. A checkpoint holds
+## the mask counts of all completed read names, the byte offset of the first line of the read name that is still open, and the last completed
+## QNAME. The position of the open read name is found once per chunk by walking back over its lines, so the per-line loop is unchanged. The open read name is not part of the saved counts, so a run
+## can resume exactly: the file is opened at the saved offset and the counting restarts at that read-name boundary.
+## Checkpoints are partial-result files (see partial.py) with an extra "checkpoint" entry, written to a temporary file and renamed, so an
+## interrupted write never leaves a truncated checkpoint; a checkpoint can also be merged like any partial file.
+## The input is read as bytes, so the offsets are exact byte positions. Checkpoints can be written for stdin, but resuming needs a seekable file.
+import os
+import sys
+import time
+from .flagmask import mask_table, initialize_mask_counts
+from .progress import update_progress
+
+#default number of lines between checkpoints
+default_checkpoint_alignments=10000000
+#default number of seconds between checkpoints
+default_checkpoint_seconds=300
+
+
+def save_checkpoint(checkpoint_file,sample,global_mask_counts,offset,last_qname,alignments,complete=False):
+    '''
+    offset -- byte offset of the first line that is not included in global_mask_counts (a read-name boundary)
+    last_qname -- QNAME of the last read included in global_mask_counts (None if there is none)
+    alignments -- number of lines counted before offset
+    complete -- True for the final checkpoint at the end of the input
+    '''
+    from .partial import write_partial, flagstat_counters
+    write_partial(checkpoint_file,"flagstat",sample,flagstat_counters(global_mask_counts),
+                  checkpoint={'offset':offset,
+                              'last_qname':None if last_qname is None else last_qname.decode('latin-1'),
+                              'alignments':alignments,
+                              'complete':complete})
+
+
+def load_checkpoint(checkpoint_file):
+    '''
+    returns (mask counts, checkpoint entry) of a checkpoint written by save_checkpoint, raises ValueError for a partial file without a checkpoint
+    '''
+    from .partial import read_partial, merge_flagstat_counters
+    partial=read_partial(checkpoint_file)
+    if 'checkpoint' not in partial or partial['kind']!="flagstat":
+        raise ValueError(checkpoint_file+" is not a SAMstats checkpoint")
+    return merge_flagstat_counters([partial])['mask_counts'],partial['checkpoint']
+
+
+def open_read_start(lines,cur_seq_id,prev_seq_id):
+    '''
+    lines -- the SAM lines (bytes) of the last chunk, ending with the alignments of the read name cur_seq_id that is still open
+    prev_seq_id -- read name that was open before this chunk
+    returns (number of bytes, number of lines of the open read name at the end of lines, QNAME of the read before it, None after the header),
+    or None if the open read name started before this chunk
+    '''
+    size=0
+    for i in range(len(lines)-1,-1,-1):
+        line=lines[i]
+        if line[0]==64:
+            return size,len(lines)-1-i,None
+        qname=line.split(b'\t',1)[0]
+        if qname!=cur_seq_id:
+            return size,len(lines)-1-i,qname
+        size+=len(line)
+    if prev_seq_id!=cur_seq_id:
+        #the read name starts with the first line of the chunk
+        return size,len(lines),prev_seq_id
+    return None
+
+
+def checkpoint_mask_counts(sam_file,
+                           chunk_size,
+                           checkpoint_file,
+                           sample,
+                           checkpoint_alignments=default_checkpoint_alignments,
+                           checkpoint_seconds=default_checkpoint_seconds,
+                           resume=False,
+                           progress=None,
+                           quiet=False):
+    '''
+    counts the reads of a name-sorted SAM file (see count_read_masks), saving a checkpoint to checkpoint_file every checkpoint_alignments lines
+    or checkpoint_seconds seconds
+    resume -- continue from checkpoint_file if it exists (sam_file must be a seekable file)
+    progress -- optional progress state (see progress.initialize_progress), updated once per chunk
+    quiet -- do not report the resumed offset on stderr
+    returns the number of reads with each flagstat mask (see flagmask.initialize_mask_counts)
+    '''
+    from . import initialize_read_masks, update_flagstat_for_readname
+    global_mask_counts=initialize_mask_counts()
+    offset=0
+    alignments=0
+    last_qname=None
+    if sam_file=="-":
+        sam=sys.stdin.buffer
+    else:
+        sam=open(sam_file,'rb')
+    if resume and os.path.exists(checkpoint_file):
+        if sam_file=="-":
+            raise ValueError("resuming from a checkpoint requires a seekable file, not stdin")
+        global_mask_counts,checkpoint=load_checkpoint(checkpoint_file)
+        offset=checkpoint['offset']
+        alignments=checkpoint['alignments']
+        last_qname=checkpoint['last_qname']
+        if last_qname is not None:
+            last_qname=last_qname.encode('latin-1')
+        if offset>os.path.getsize(sam_file):
+            raise ValueError(sam_file+" is shorter than the checkpoint offset "+str(offset)+", the checkpoint belongs to another file")
+        sam.seek(offset)
+        #the first line after the offset must start a new read name
+        first_line=sam.readline()
+        if len(first_line)>0 and first_line.split(b'\t',1)[0]==last_qname:
+            raise ValueError("the line at the checkpoint offset "+str(offset)+" does not start a new read name, the checkpoint belongs to another file")
+        sam.seek(offset)
+        if progress is not None and progress['total_bytes'] is not None:
+            #the ETA only covers the rest of the file
+            progress['total_bytes']-=offset
+        if not quiet:
+            print("resuming from the checkpoint at byte "+str(offset)+" (line "+str(alignments)+")",file=sys.stderr)
+    checkpoint_time=time.monotonic()
+    checkpoint_lines=alignments
+    read_offset=offset
+    read_alignments=alignments
+    #after resuming, the first line starts a read name that differs from last_qname
+    cur_seq_id=last_qname
+    cur_masks=initialize_read_masks()
+    while True:
+        cur_lines=sam.readlines(chunk_size)
+        if len(cur_lines)==0:
+            break
+        prev_seq_id=cur_seq_id
+        for line in cur_lines:
+            if line[0]==64:
+                #this is a comment, we skip
+                continue
+            tokens=line.split(b'\t',7)
+            flag=int(tokens[1])
+            if tokens[0]!=cur_seq_id:
+                #we are finished processing the read name cur_seq_id, this also resets cur_masks for the next read name
+                update_flagstat_for_readname(global_mask_counts,cur_masks)
+                cur_seq_id=tokens[0]
+            cur_masks[((flag & 0xc0)>>5) | ((flag & 0x200)>>9)]|=mask_table[((flag & 0xfff)<<2) | ((tokens[6]!=b'=')<<1) | (int(tokens[4])>=5)]
+        chunk_bytes=sum(map(len,cur_lines))
+        offset+=chunk_bytes
+        alignments+=len(cur_lines)
+        if progress is not None:
+            update_progress(progress,len(cur_lines),chunk_bytes,global_mask_counts)
+        #position of the read name that is still open; it is kept from an earlier chunk when its alignments fill the whole chunk
+        open_read=open_read_start(cur_lines,cur_seq_id,prev_seq_id)
+        if open_read is not None:
+            open_size,open_lines,last_qname=open_read
+            read_offset=offset-open_size
+            read_alignments=alignments-open_lines
+        if alignments-checkpoint_lines>=checkpoint_alignments or time.monotonic()-checkpoint_time>=checkpoint_seconds:
+            save_checkpoint(checkpoint_file,sample,global_mask_counts,read_offset,last_qname,read_alignments)
+            checkpoint_time=time.monotonic()
+            checkpoint_lines=alignments
+    #we have parsed all the reads in the file
+    update_flagstat_for_readname(global_mask_counts,cur_masks)
+    save_checkpoint(checkpoint_file,sample,global_mask_counts,offset,cur_seq_id,alignments,True)
+    return global_mask_counts
@@ -0,0 +1,565 @@
+## Read-level alignment statistics and PBC/NRF library complexity, ported from original/SAMstats-V2.py to a streaming Python 3 module.
+## The alignments of each read name are processed as soon as the next read name starts (name-sorted input, or the unsorted output of an aligner,
+## which keeps the alignments of a read together), instead of holding batches of read names in a dictionary.
+## Every fragment of a unique read/pair is identified by (chromosome, signed 5' position of read1, signed 5' position of read2); the two positions
+## are packed into one 64-bit key per chromosome, and the keys are kept in sorted numpy arrays with one uint32 count per key (12 bytes per unique
+## fragment). New keys are appended to a per-chromosome array('q') buffer and merged into the sorted arrays in bulk (run-length counting of the
+## sorted buffer + searchsorted/insert), so memory stays close to 12-16 bytes per unique fragment instead of the three levels of dictionaries of the
+## original. Without numpy a dictionary of packed key -> count per chromosome is used.
+## The report reproduces the original output, including its quirks:
+##    the chromosome of a pair is the RNAME of the last alignment of the read name
+##    an unmapped read1/read2 alignment seen while NH is 1 replaces the position of the mate
+##    a read length is reported for unmapped pairs (length 1 for SEQ "*") even though they are not counted in the average
+##    unpaired multireads are counted once per alignment
+##    floats are formatted like Python 2 str (12 significant digits)
+## The fractional 1/NH counts of the original are kept as integer alignment counts per NH and divided at the end, so the numbers do not depend
+## on the order the reads are processed in. The spliced/unspliced counts are then rebuilt the way the original accumulates them, by adding the float
+## 1./NH once per alignment and truncating the sum, since the exact fractions can be one higher (i.e. 1489 instead of 1488) once truncated; only
+## multireads with both paired and unpaired alignments under the same NH can still differ, as the order of their additions is not kept.
+## The alignments can be written to a SAM/BAM file in the same pass (see alignment_writer), with NH tags added like the -addNH option of the
+## original and MAPQ/FLAG filters applied to the output only; unlike the original, unmapped alignments and alignments that already have an NH tag
+## are written unchanged.
+## The counters can be saved to a partial-result file (--partial_outf) and the files of the shards of a sample added up with SAMstats merge.
+import os
+import sys
+import argparse
+from array import array
+from fractions import Fraction
+from .alignment_writer import initialize_alignment_writer, write_alignment, close_alignment_writer
+from .filters import initialize_alignment_filter, filter_is_empty
+from .alignment_writer import default_buffer_size as default_output_buffer_size
+
+#number of buffered fragment keys that triggers a merge into the sorted arrays
+default_buffer_size=1<<20
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Read-level alignment statistics and PBC/NRF library complexity metrics (port of SAMstats-V2.py)")
+    parser.add_argument("--sam_file",help="Input SAM/BAM/CRAM file (SAM may be .gz/.bz2 compressed). Use '-' if input is being piped from stdin. The alignments of each read name must be consecutive, i.e. sorted by read name or straight from the aligner.",required=True)
+    parser.add_argument("--outf",default=None,help="Output file name to store the statistics. The statistics will be printed to stdout if no file is provided")
+    parser.add_argument("--chunk_size",type=int,default=100000,help="Number of lines to read at a time from a SAM file")
+    parser.add_argument("--input_format",choices=["auto","sam","bam","cram"],default="auto",help="Format of sam_file. auto: bam/cram based on the file extension, sam otherwise (including stdin)")
+    parser.add_argument("--reference",default=None,help="Reference FASTA file for CRAM input")
+    parser.add_argument("--buffer_size",type=int,default=default_buffer_size,help="Number of fragment keys to buffer before merging them into the sorted complexity arrays")
+    parser.add_argument("--output",default=None,help="Also write the alignments to this file ('-' for stdout, requires --outf) in the same pass")
+    parser.add_argument("--output_format",choices=["auto","sam","bam"],default="auto",help="Format of --output. auto: bam if the file name ends with .bam, sam otherwise. BAM output requires pysam")
+    parser.add_argument("--add_nh",action="store_true",default=False,help="Add NH tags (number of alignments of the read, or of the mate for paired reads) to the mapped alignments written to --output that do not have one")
+    parser.add_argument("--min_mapq",type=int,default=0,help="Only write alignments with at least this MAPQ to --output")
+    parser.add_argument("--required_flag",type=lambda value: int(value,0),default=0,help="Only write alignments with all of these FLAG bits to --output (like samtools view -f)")
+    parser.add_argument("--excluded_flag",type=lambda value: int(value,0),default=0,help="Only write alignments with none of these FLAG bits to --output (like samtools view -F)")
+    parser.add_argument("--output_buffer_size",type=int,default=default_output_buffer_size,help="Number of bytes of SAM output to collect before writing them")
+    parser.add_argument("--partial_outf",default=None,help="Also write the counters, including the fragment counts, to this partial-result file; the partial files of the shards of a sample are added up with SAMstats merge (see partial.py)")
+    args=parser.parse_args()
+    if args.output=="-" and args.outf is None:
+        parser.error("--output - requires --outf, the statistics are printed to stdout otherwise")
+    return args
+
+
+def pack_positions(pos1,pos2):
+    '''
+    packs the signed 5' positions of read1 and read2 into one signed 64-bit integer
+    '''
+    return (pos1<<32)+(pos2+0x80000000)
+
+
+def initialize_complexity(buffer_size=default_buffer_size,use_numpy=None):
+    '''
+    returns the complexity counters: {'chroms': chromosome -> fragment counts, 'buffered': number of buffered keys, 'buffer_size', 'numpy'}
+    the fragment counts of a chromosome are [sorted keys, counts, array('q') buffer of new keys] with numpy, {key: count} without
+    use_numpy -- None to use numpy when it is installed
+    '''
+    if use_numpy is None:
+        try:
+            import numpy
+            use_numpy=True
+        except ImportError:
+            use_numpy=False
+    return {'chroms':dict(),'buffered':0,'buffer_size':buffer_size,'numpy':use_numpy}
+
+
+def add_fragment(complexity,chrom,pos1,pos2):
+    '''
+    counts one unique read (pos1==pos2) or unique pair at the signed 5' positions pos1, pos2 of chromosome chrom
+    '''
+    key=pack_positions(pos1,pos2)
+    fragments=complexity['chroms'].get(chrom)
+    if not complexity['numpy']:
+        if fragments is None:
+            fragments=complexity['chroms'][chrom]=dict()
+        fragments[key]=fragments.get(key,0)+1
+        return
+    if fragments is None:
+        fragments=complexity['chroms'][chrom]=[None,None,array('q')]
+    fragments[2].append(key)
+    complexity['buffered']+=1
+    if complexity['buffered']>=complexity['buffer_size']:
+        compact_complexity(complexity)
+
+
+def merge_sorted_counts(keys,counts,new_keys,new_counts):
+    '''
+    keys, counts -- sorted unique keys and their counts (None if empty)
+    new_keys, new_counts -- sorted unique keys and their counts to add
+    returns the merged (keys, counts)
+    '''
+    import numpy as np
+    new_counts=new_counts.astype(np.uint32)
+    if keys is None or len(keys)==0:
+        return new_keys,new_counts
+    index=np.searchsorted(keys,new_keys)
+    found=index<len(keys)
+    found[found]=keys[index[found]]==new_keys[found]
+    counts[index[found]]+=new_counts[found]
+    missing=~found
+    if missing.any():
+        keys=np.insert(keys,index[missing],new_keys[missing])
+        counts=np.insert(counts,index[missing],new_counts[missing])
+    return keys,counts
+
+
+def compact_complexity(complexity):
+    '''
+    merges the buffered keys of every chromosome into its sorted key and count arrays
+    '''
+    if not complexity['numpy'] or complexity['buffered']==0:
+        return
+    import numpy as np
+    for fragments in complexity['chroms'].values():
+        if len(fragments[2])==0:
+            continue
+        new_keys,new_counts=np.unique(np.frombuffer(fragments[2],dtype=np.int64),return_counts=True)
+        fragments[0],fragments[1]=merge_sorted_counts(fragments[0],fragments[1],new_keys,new_counts)
+        fragments[2]=array('q')
+    complexity['buffered']=0
+
+
+def merge_complexity(complexity,other):
+    '''
+    adds the fragment counts of other to complexity (both are compacted first)
+    '''
+    compact_complexity(complexity)
+    compact_complexity(other)
+    for chrom,fragments in other['chroms'].items():
+        if complexity['numpy']!=other['numpy']:
+            raise ValueError("complexity counters with and without numpy can not be merged")
+        if chrom not in complexity['chroms']:
+            complexity['chroms'][chrom]=fragments
+        elif not complexity['numpy']:
+            cur=complexity['chroms'][chrom]
+            for key,count in fragments.items():
+                cur[key]=cur.get(key,0)+count
+        elif fragments[0] is not None:
+            cur=complexity['chroms'][chrom]
+            cur[0],cur[1]=merge_sorted_counts(cur[0],cur[1],fragments[0],fragments[1])
+
+
+def complexity_metrics(complexity):
+    '''
+    returns (U_P, U_R, M_0, M_1, M_2): number of distinct fragments, number of reads/pairs, number of distinct fragments (as in the original),
+    number of fragments seen exactly once, number of fragments seen exactly twice
+    '''
+    compact_complexity(complexity)
+    up=0
+    ur=0
+    m1=0
+    m2=0
+    for fragments in complexity['chroms'].values():
+        if complexity['numpy']:
+            counts=fragments[1]
+            if counts is None:
+                continue
+            up+=len(counts)
+            ur+=int(counts.sum(dtype='uint64'))
+            m1+=int((counts==1).sum())
+            m2+=int((counts==2).sum())
+        else:
+            up+=len(fragments)
+            for count in fragments.values():
+                ur+=count
+                if count==1:
+                    m1+=1
+                elif count==2:
+                    m2+=1
+    return up,ur,up,m1,m2
+
+
+def initialize_read_stats():
+    '''
+    returns the read-level statistics of SAMstats-V2.py:
+    proper_pairs, not_proper_pairs, unpaired -- NH -> number of pairs/reads (unpaired counts every alignment of a multiread)
+    paired_unaligned, unpaired_unaligned -- number of unaligned pairs/reads
+    spliced_reads, unspliced_reads -- NH -> [number of alignments of paired reads (weighted 1/NH), number of alignments of unpaired reads]
+    read_lengths -- read length -> NH -> number of mapped alignments (weighted 1/NH); lengths of unmapped paired alignments have no entries
+    '''
+    return {'proper_pairs':{1:0},
+            'not_proper_pairs':{1:0},
+            'unpaired':{1:0},
+            'paired_unaligned':0,
+            'unpaired_unaligned':0,
+            'spliced_reads':{1:[0,0]},
+            'unspliced_reads':{1:[0,0]},
+            'read_lengths':dict()}
+
+
+def increment(counts,key,value=1):
+    counts[key]=counts.get(key,0)+value
+
+
+def add_splice_count(counts,nh,paired):
+    '''
+    counts one alignment of a read with NH alignments in the spliced_reads/unspliced_reads counts
+    '''
+    if nh not in counts:
+        counts[nh]=[0,0]
+    counts[nh][0 if paired else 1]+=1
+
+
+def add_read_length(read_lengths,read_length,nh):
+    '''
+    adds the read length to read_lengths, and counts one mapped alignment of a read with NH alignments unless nh is None
+    '''
+    lengths=read_lengths.get(read_length)
+    if lengths is None:
+        lengths=read_lengths[read_length]=dict()
+    if nh is not None:
+        lengths[nh]=lengths.get(nh,0)+1
+
+
+def process_read(alignments,read_stats,complexity):
+    '''
+    alignments -- list of (FLAG, RNAME, POS, CIGAR contains N, length of SEQ, record) of all alignments of a read name, in file order
+    updates read_stats (see initialize_read_stats) and complexity (see initialize_complexity) like SAMstats-V2.py
+    '''
+    if alignments[0][0] & 0xc0:
+        nh1=0
+        nh2=0
+        pos1=None
+        pos2=None
+        proper_pairs=True
+        for flag,chrom,pos,spliced,seq_length,record in alignments:
+            if flag & 0x40:
+                if not flag & 0x4:
+                    nh1+=1
+                if nh1==1:
+                    pos1=-(pos+seq_length) if flag & 0x10 else pos
+            elif flag & 0x80:
+                if not flag & 0x4:
+                    nh2+=1
+                if nh2==1:
+                    pos2=-(pos+seq_length) if flag & 0x10 else pos
+            if flag & 0x8 and not flag & 0x4:
+                proper_pairs=False
+        if nh1!=nh2:
+            proper_pairs=False
+        if proper_pairs:
+            if nh1==0:
+                read_stats['paired_unaligned']+=1
+            else:
+                increment(read_stats['proper_pairs'],nh1)
+            if nh1==1:
+                #the original uses the RNAME of the last alignment
+                add_fragment(complexity,alignments[-1][1],pos1,pos2)
+        else:
+            increment(read_stats['not_proper_pairs'],max(nh1,nh2))
+        for flag,chrom,pos,spliced,seq_length,record in alignments:
+            if flag & 0x40 and nh1>0:
+                add_splice_count(read_stats['spliced_reads' if spliced else 'unspliced_reads'],nh1,True)
+            if flag & 0x80 and nh2>0:
+                add_splice_count(read_stats['spliced_reads' if spliced else 'unspliced_reads'],nh2,True)
+            nh=None
+            if not flag & 0x4:
+                if flag & 0x40:
+                    if nh1!=0:
+                        nh=nh1
+                elif flag & 0x80:
+                    if nh2!=0:
+                        nh=nh2
+            add_read_length(read_stats['read_lengths'],seq_length,nh)
+    else:
+        nh=len(alignments)
+        for flag,chrom,pos,spliced,seq_length,record in alignments:
+            if flag & 0x4:
+                if nh>1:
+                    raise ValueError("read is unmapped but multiple alignments are detected for the read ID")
+                read_stats['unpaired_unaligned']+=1
+                continue
+            if nh==1:
+                pos1=-(pos+seq_length) if flag & 0x10 else pos
+                add_fragment(complexity,chrom,pos1,pos1)
+            add_read_length(read_stats['read_lengths'],seq_length,nh)
+            increment(read_stats['unpaired'],nh)
+            add_splice_count(read_stats['spliced_reads' if spliced else 'unspliced_reads'],nh,False)
+
+
+def merge_read_stats(read_stats,other):
+    '''
+    adds the statistics of other to read_stats
+    '''
+    for name in ['proper_pairs','not_proper_pairs','unpaired']:
+        for nh,count in other[name].items():
+            increment(read_stats[name],nh,count)
+    for name in ['paired_unaligned','unpaired_unaligned']:
+        read_stats[name]+=other[name]
+    for name in ['spliced_reads','unspliced_reads']:
+        for nh,counts in other[name].items():
+            cur=read_stats[name].setdefault(nh,[0,0])
+            cur[0]+=counts[0]
+            cur[1]+=counts[1]
+    for read_length,lengths in other['read_lengths'].items():
+        cur=read_stats['read_lengths'].setdefault(read_length,dict())
+        for nh,count in lengths.items():
+            increment(cur,nh,count)
+
+
+def iter_sam_alignments(sam,chunk_size,header=None):
+    '''
+    sam -- text file handle for a SAM file
+    header -- optional list, the header lines are appended to it
+    yields (QNAME, FLAG, RNAME, POS, CIGAR contains N, length of SEQ, SAM line) for every alignment
+    '''
+    while True:
+        cur_lines=sam.readlines(chunk_size)
+        if len(cur_lines)==0:
+            break
+        for line in cur_lines:
+            if line.startswith('@'):
+                #this is a comment, we skip
+                if header is not None:
+                    header.append(line)
+                continue
+            tokens=line.split('\t',10)
+            yield tokens[0],int(tokens[1]),tokens[2],int(tokens[3]),'N' in tokens[5],len(tokens[9]),line
+
+
+def iter_pysam_alignments(sam_file,reference=None,header=None):
+    '''
+    yields (QNAME, FLAG, RNAME, POS, CIGAR contains N, length of SEQ, pysam AlignedSegment) for every alignment of a BAM/CRAM file read with pysam
+    a missing SEQ has length 1, like "*" in a SAM file
+    header -- optional list, the text of the header is appended to it
+    '''
+    #pysam is only needed for BAM/CRAM input
+    import pysam
+    samfile=pysam.AlignmentFile(sam_file,reference_filename=reference,check_sq=False)
+    if header is not None:
+        header.append(str(samfile.header))
+    for read in samfile.fetch(until_eof=True):
+        cigar=read.cigarstring
+        seq_length=read.query_length if read.query_sequence is not None else 1
+        yield read.query_name,read.flag,read.reference_name or '*',read.reference_start+1,cigar is not None and 'N' in cigar,seq_length,read
+    samfile.close()
+
+
+def write_read(alignments,writer,add_nh=False):
+    '''
+    writes the alignments of a read name (see process_read) to the alignment writer (see alignment_writer.initialize_alignment_writer)
+    add_nh -- add NH tags like SAMstats-V2.py -addNH: the number of mapped alignments of the mate (paired reads) or of the read name (unpaired reads)
+    '''
+    nh1=0
+    nh2=0
+    paired=alignments[0][0] & 0xc0
+    for alignment in alignments:
+        flag=alignment[0]
+        if not flag & 0x4:
+            if flag & 0x40:
+                nh1+=1
+            elif flag & 0x80:
+                nh2+=1
+    for alignment in alignments:
+        flag=alignment[0]
+        nh=None
+        if add_nh and not flag & 0x4:
+            if not paired:
+                nh=len(alignments)
+            elif flag & 0x40:
+                nh=nh1
+            elif flag & 0x80:
+                nh=nh2
+        write_alignment(writer,alignment[5],nh)
+
+
+def complexity_stats(alignments,buffer_size=default_buffer_size,writer=None,add_nh=False):
+    '''
+    alignments -- iterator of (QNAME, FLAG, RNAME, POS, CIGAR contains N, length of SEQ, record) with the alignments of each read name together
+    writer -- optional alignment writer (see alignment_writer.initialize_alignment_writer), every alignment is written to it (see write_read)
+    returns (read_stats, complexity) (see initialize_read_stats, initialize_complexity)
+    '''
+    read_stats=initialize_read_stats()
+    complexity=initialize_complexity(buffer_size)
+    cur_seq_id=None
+    cur_alignments=[]
+    for alignment in alignments:
+        if alignment[0]!=cur_seq_id:
+            if len(cur_alignments)>0:
+                process_read(cur_alignments,read_stats,complexity)
+                if writer is not None:
+                    write_read(cur_alignments,writer,add_nh)
+            cur_seq_id=alignment[0]
+            cur_alignments=[]
+        cur_alignments.append(alignment[1:])
+    if len(cur_alignments)>0:
+        process_read(cur_alignments,read_stats,complexity)
+        if writer is not None:
+            write_read(cur_alignments,writer,add_nh)
+    if writer is not None:
+        close_alignment_writer(writer)
+    compact_complexity(complexity)
+    return read_stats,complexity
+
+
+def format_float(value):
+    '''
+    formats value like str(float) in Python 2, which the original script used
+    '''
+    formatted='%.12g' % value
+    if '.' not in formatted and 'e' not in formatted and 'n' not in formatted:
+        formatted+='.0'
+    return formatted
+
+
+def divide(numerator,denominator):
+    '''
+    returns numerator/denominator formatted like the original, NA when the denominator is 0 (the original fails)
+    '''
+    if denominator==0:
+        return 'NA'
+    return format_float(numerator/denominator)
+
+
+def repeated_sum(value,count):
+    '''
+    returns the float sum of count times value, rounded after every addition like a float accumulated one alignment at a time
+    '''
+    if value==1.0:
+        #exact below 2**53
+        return float(count)
+    try:
+        import numpy as np
+    except ImportError:
+        np=None
+    total=0.0
+    if np is None or count<(1<<16):
+        for i in range(count):
+            total+=value
+        return total
+    #add.accumulate adds sequentially (unlike numpy.sum), one block of additions at a time
+    block=np.full((1<<20)+1,value)
+    while count>0:
+        num_values=min(count,1<<20)
+        block[0]=total
+        total=float(np.add.accumulate(block[:num_values+1])[-1])
+        count-=num_values
+    return total
+
+
+def splice_count(counts):
+    '''
+    counts -- NH -> [alignments of paired reads, alignments of unpaired reads]
+    returns the number of reads, counting the alignments of paired reads with weight 1./NH, summed in floats like the original
+    '''
+    total=0
+    for nh in sorted(counts):
+        total+=repeated_sum(1./nh,counts[nh][0])+counts[nh][1]
+    return total
+
+
+def report_lines(read_stats,complexity):
+    '''
+    returns the lines of the SAMstats-V2.py report
+    '''
+    multi=lambda counts: sum([counts[nh] for nh in counts if nh!=1])
+    spliced=read_stats['spliced_reads']
+    unspliced=read_stats['unspliced_reads']
+    lines=['unique pairs, proper:\t'+str(read_stats['proper_pairs'][1]),
+           'unique pairs, not proper:\t'+str(read_stats['not_proper_pairs'][1]),
+           'unique unpaired reads:\t'+str(read_stats['unpaired'][1]),
+           'multiread pairs, proper:\t'+str(multi(read_stats['proper_pairs'])),
+           'multiread pairs, not proper:\t'+str(multi(read_stats['not_proper_pairs'])),
+           'multiread unpaired:\t'+str(multi(read_stats['unpaired'])),
+           'unaligned pairs:\t'+str(read_stats['paired_unaligned']),
+           'unaligned unpaired reads:\t'+str(read_stats['unpaired_unaligned']),
+           'spliced unique reads:\t'+str(int(splice_count({1:spliced[1]}))),
+           'spliced multireads:\t'+str(int(splice_count({nh:spliced[nh] for nh in spliced if nh!=1}))),
+           'unspliced unique reads:\t'+str(int(splice_count({1:unspliced[1]}))),
+           'unspliced multireads:\t'+str(int(splice_count({nh:unspliced[nh] for nh in unspliced if nh!=1})))]
+    read_lengths=read_stats['read_lengths']
+    if len(read_lengths)==0:
+        lines+=['Read Length, Minimum:\tNA','Read Length, Maximum:\tNA']
+    else:
+        lines+=['Read Length, Minimum:\t'+str(min(read_lengths)),'Read Length, Maximum:\t'+str(max(read_lengths))]
+    total_reads=Fraction(0)
+    total_length=Fraction(0)
+    for read_length,lengths in read_lengths.items():
+        for nh,count in lengths.items():
+            total_reads+=Fraction(count,nh)
+            total_length+=Fraction(count*read_length,nh)
+    lines.append('Read Length, Average:\t'+divide(total_length,total_reads))
+    up,ur,m0,m1,m2=complexity_metrics(complexity)
+    lines+=['#Library complexity metrics (unique reads/pairs only):',
+            'U_P\t'+str(up),
+            'U_R\t'+str(ur),
+            'M_0\t'+str(m0),
+            'M_1\t'+str(m1),
+            'M_2\t'+str(m2),
+            'PBC1\t'+divide(m1,m0),
+            'PBC2\t'+divide(m1,m2),
+            'NRF\t'+divide(up,ur)]
+    return lines
+
+
+def write_report(outf,read_stats,complexity):
+    '''
+    writes the report to the file name outf (stdout if None)
+    '''
+    lines=report_lines(read_stats,complexity)
+    if outf is None:
+        out=sys.stdout
+    else:
+        out=open(outf,'w')
+    out.write('\n'.join(lines)+'\n')
+    if outf is not None:
+        out.close()
+
+
+def open_sam(sam_file):
+    '''
+    opens a SAM file for reading as text, decompressing gzip/BGZF and bz2 input like the original (see compressed.py)
+    '''
+    from . import open_input
+    return open_input(sam_file,False,decompress=True)
+
+
+def sam_complexity(sam_file,outf=None,input_format="auto",reference=None,chunk_size=100000,buffer_size=default_buffer_size,writer=None,add_nh=False):
+    '''
+    computes the SAMstats-V2.py statistics of a SAM/BAM/CRAM file and writes them to outf (stdout if None)
+    writer, add_nh -- optional alignment writer the alignments are written to in the same pass (see complexity_stats)
+    returns (read_stats, complexity)
+    '''
+    from . import get_input_format
+    input_format=get_input_format(sam_file,input_format)
+    header=writer['header'] if writer is not None else None
+    if input_format in ["bam","cram"]:
+        alignments=iter_pysam_alignments(sam_file if sam_file!="-" else sys.stdin.buffer,reference,header)
+    else:
+        alignments=iter_sam_alignments(open_sam(sam_file),chunk_size,header)
+    read_stats,complexity=complexity_stats(alignments,buffer_size,writer,add_nh)
+    write_report(outf,read_stats,complexity)
+    return read_stats,complexity
+
+
+def main():
+    args=parse_args()
+    writer=None
+    if args.output is not None:
+        output_format=args.output_format
+        if output_format=="auto":
+            output_format="bam" if args.output.endswith('.bam') else "sam"
+        alignment_filter=initialize_alignment_filter(args.min_mapq,args.required_flag,args.excluded_flag)
+        writer=initialize_alignment_writer(args.output,output_format,args.output_buffer_size,None if filter_is_empty(alignment_filter) else alignment_filter)
+    read_stats,complexity=sam_complexity(args.sam_file,args.outf,args.input_format,args.reference,args.chunk_size,args.buffer_size,writer,args.add_nh)
+    if args.partial_outf is not None:
+        from .partial import write_partial, complexity_counters
+        write_partial(args.partial_outf,"complexity",os.path.basename(args.sam_file),complexity_counters(read_stats,complexity))
+
+
+if __name__=="__main__":
+    main()
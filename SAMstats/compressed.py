@@ -0,0 +1,72 @@
+## Compressed SAM input: gzip, BGZF (bgzip/samtools, usually .gz or .bgz) and bz2 are recognized from the first bytes of the input, so compressed
+## stdin works as well as compressed files, whatever their names.
+## BGZF files are series of independent gzip blocks, which are decompressed in batches by a pool of threads (see bgzf.decompressed_chunks) and
+## handed to the parser in file order. zlib releases the GIL while inflating, so the threads use several cores without copying the blocks to
+## worker processes and back. Plain gzip and bz2 streams can not be split, they are decompressed while reading by the gzip and bz2 modules.
+import io
+import os
+import struct
+from .bgzf import gzip_header, block_size_from_header, decompressed_chunks
+
+gzip_magic=b'\x1f\x8b'
+bz2_magic=b'BZh'
+#after the block size digit, a bz2 stream starts with a block or, when it is empty, with the end of stream magic
+bz2_block_magics=(b'1AY&SY',b'\x17rE8P\x90')
+#compressed bytes per batch of BGZF blocks decompressed by one thread
+bgzf_batch_size=1<<20
+
+
+def input_compression(f):
+    '''
+    f -- buffered binary file handle (it must have peek, i.e. open(sam_file,'rb') or sys.stdin.buffer), nothing is consumed
+    returns "bgzf", "gzip", "bz2" or None for uncompressed input
+    '''
+    start=f.peek(gzip_header.size+64)
+    if start.startswith(bz2_magic) and len(start)>=10 and 49<=start[3]<=57 and start[4:10] in bz2_block_magics:
+        #the block size digit 1-9 and the block magic keep a SAM line whose QNAME starts with BZh from being read as bz2
+        return "bz2"
+    if not start.startswith(gzip_magic):
+        return None
+    try:
+        xlen=gzip_header.unpack_from(start)[-1]
+        block_size_from_header(start[:gzip_header.size],start[gzip_header.size:gzip_header.size+xlen])
+        return "bgzf"
+    except (ValueError,struct.error):
+        #not BGZF, or too few bytes were available to tell (i.e. from a pipe): read it as a gzip stream
+        return "gzip"
+
+
+def file_compression(input_file):
+    '''
+    returns the compression of the file input_file (see input_compression), None for stdin and other inputs that are not regular files
+    (i.e. FIFOs and process substitutions), whose first bytes would be consumed by the extra open
+    '''
+    if input_file=="-" or not os.path.isfile(input_file):
+        return None
+    with open(input_file,'rb') as f:
+        return input_compression(f)
+
+
+def default_decompress_threads():
+    return os.cpu_count() or 1
+
+
+def open_decompressed(f,compression,threads=None):
+    '''
+    f -- binary file handle of the compressed input
+    compression -- "bgzf", "gzip" or "bz2" (see input_compression)
+    threads -- number of threads that decompress BGZF input (defaults to the number of CPUs)
+    returns a binary file handle for the decompressed input
+    '''
+    if compression=="bgzf":
+        from .prefetch import ChunkedInput
+        if threads is None:
+            threads=default_decompress_threads()
+        return io.BufferedReader(ChunkedInput(decompressed_chunks(f,bgzf_batch_size,threads)),buffer_size=1<<20)
+    if compression=="gzip":
+        import gzip
+        return gzip.GzipFile(fileobj=f,mode='rb')
+    if compression=="bz2":
+        import bz2
+        return bz2.BZ2File(f,'rb')
+    raise ValueError("unknown compression: "+str(compression))
@@ -0,0 +1,149 @@
+## Per-read flagstat for coordinate-sorted input, without sorting the file by read name first.
+## The alignments of a read (QNAME + segment: unpaired, read1 or read2) are scattered over the file, so their masks are kept in a table of pending reads
+## keyed by (QNAME, FLAG & 0xc0) until all of the read's alignments have been seen:
+##    NH (number of primary + secondary alignments, 1 if the tag is missing) + number of supplementary alignments (entries of the SA tag
+##    of the primary or of a supplementary alignment).
+## Finished reads are counted and evicted right away. When the table grows past max_pending reads, the oldest half of it is
+## written to spill files on disk (partitioned by QNAME hash) and merged with the reads left at the end of the file, one partition at a time.
+## Since the masks of a read are combined with a bitwise or, the counts match the name-sorted path regardless of the order of the alignments.
+## Note: aligners that report secondary alignments need to set NH, otherwise a read is counted as soon as its primary (and supplementary)
+## alignments are seen and a later secondary alignment is counted as a separate read.
+import os
+import sys
+import shutil
+import tempfile
+import zlib
+from itertools import islice
+from .flagmask import mask_table, initialize_mask_counts
+
+#number of spill files the pending reads are partitioned into
+num_spill_files=64
+
+
+def iter_sam_alignment_tags(sam,chunk_size):
+    '''
+    sam -- text file handle for a SAM file
+    chunk_size -- number of lines to read at a time from sam
+    yields (QNAME, FLAG, MAPQ, RNEXT, NH, number of SA entries) for every alignment; NH is None when the tag is missing
+    '''
+    while True:
+        cur_lines=sam.readlines(chunk_size)
+        if len(cur_lines)==0:
+            break
+        for line in cur_lines:
+            if line.startswith('@'):
+                #this is a comment, we skip
+                continue
+            tokens=line.rstrip('\n').split('\t',11)
+            nh=None
+            num_sa=0
+            if len(tokens)>11:
+                #search the optional fields only, a tag can not be confused with SEQ or QUAL there
+                tags='\t'+tokens[11]
+                nh_start=tags.find('\tNH:i:')
+                if nh_start!=-1:
+                    nh_end=tags.find('\t',nh_start+1)
+                    nh=int(tags[nh_start+6:nh_end if nh_end!=-1 else len(tags)])
+                sa_start=tags.find('\tSA:Z:')
+                if sa_start!=-1:
+                    sa_end=tags.find('\t',sa_start+1)
+                    sa=tags[sa_start+6:sa_end if sa_end!=-1 else len(tags)]
+                    num_sa=len([entry for entry in sa.split(';') if len(entry)>0])
+            yield tokens[0],int(tokens[1]),int(tokens[4]),tokens[6],nh,num_sa
+
+
+def spill_reads(pending,num_reads,spill_files):
+    '''
+    removes the num_reads oldest reads from the pending table and appends their masks to the spill file of their partition
+    '''
+    for key in list(islice(pending,num_reads)):
+        state=pending.pop(key)
+        qname=key[0]
+        if isinstance(qname,str):
+            qname=qname.encode()
+        spill_files[zlib.crc32(qname) % len(spill_files)].write(b'\t'.join([qname,
+                                                                            str(int(key[1])).encode(),
+                                                                            str(state[0]).encode(),
+                                                                            str(state[1]).encode()])+b'\n')
+
+
+def merge_spill_file(spill_file,global_mask_counts):
+    '''
+    combines the partial masks of every read in spill_file and adds them to global_mask_counts
+    '''
+    reads=dict()
+    spill_file.seek(0)
+    for line in spill_file:
+        qname,segment,passed,failed=line.split(b'\t')
+        key=(qname,segment)
+        if key in reads:
+            reads[key][0]|=int(passed)
+            reads[key][1]|=int(failed)
+        else:
+            reads[key]=[int(passed),int(failed)]
+    for masks in reads.values():
+        global_mask_counts[0][masks[0]]+=1
+        global_mask_counts[1][masks[1]]+=1
+
+
+def coordinate_mask_counts(alignments,max_pending,spill_dir=None,alignment_counts=None,quiet=False):
+    '''
+    alignments -- iterator of (QNAME, FLAG, MAPQ, RNEXT, NH, number of SA entries) tuples in any order, i.e. from a coordinate-sorted file
+    max_pending -- maximum number of unfinished reads to keep in memory before spilling the oldest ones to disk
+    spill_dir -- directory for the spill files (system temporary directory by default)
+    alignment_counts -- optional per-alignment counts, updated in place (see flagmask.initialize_alignment_counts)
+    quiet -- do not report the spills on stderr
+    returns the number of reads with each flagstat mask (see flagmask.initialize_mask_counts)
+    '''
+    global_mask_counts=initialize_mask_counts()
+    passed_counts=global_mask_counts[0]
+    failed_counts=global_mask_counts[1]
+    #(QNAME, segment: FLAG & 0xc0, see flagmask.read_slot) -> [qc_passed mask, qc_failed mask, alignments seen, NH, number of supplementary alignments or None if not known yet]
+    pending=dict()
+    spill_tmpdir=None
+    spill_files=None
+    for qname,flag,mapq,rnext,nh,num_sa in alignments:
+        key=(qname,(flag & 0xc0)>>6)
+        state=pending.get(key)
+        if state is None:
+            state=pending[key]=[0,0,0,1,None]
+        index=((flag & 0xfff)<<2) | ((rnext!="=")<<1) | (mapq>=5)
+        state[(flag & 0x200)>>9]|=mask_table[index]
+        if alignment_counts is not None:
+            alignment_counts[index]+=1
+        state[2]+=1
+        if flag & 0x800:
+            #supplementary alignment, SA lists the primary and the other supplementary alignments
+            if num_sa>0:
+                state[4]=num_sa
+        else:
+            if nh is not None and nh>state[3]:
+                state[3]=nh
+            if flag & 0x100==0:
+                #primary alignment, SA lists the supplementary alignments
+                state[4]=num_sa
+        if state[4] is not None and state[2]==state[3]+state[4]:
+            #all the alignments of the read were seen
+            del pending[key]
+            passed_counts[state[0]]+=1
+            failed_counts[state[1]]+=1
+        elif len(pending)>max_pending:
+            if spill_files is None:
+                spill_tmpdir=tempfile.mkdtemp(prefix='SAMstats.',dir=spill_dir)
+                spill_files=[open(os.path.join(spill_tmpdir,str(i)),'w+b') for i in range(num_spill_files)]
+            if not quiet:
+                print("spilling "+str(len(pending)//2)+" pending reads to "+spill_tmpdir,file=sys.stderr)
+            spill_reads(pending,len(pending)//2,spill_files)
+
+    #the reads left in the table are incomplete in the file (i.e. filtered alignments, missing NH tags), they are counted with the alignments seen
+    if spill_files is None:
+        for state in pending.values():
+            passed_counts[state[0]]+=1
+            failed_counts[state[1]]+=1
+    else:
+        spill_reads(pending,len(pending),spill_files)
+        for spill_file in spill_files:
+            merge_spill_file(spill_file,global_mask_counts)
+            spill_file.close()
+        shutil.rmtree(spill_tmpdir)
+    return global_mask_counts
@@ -0,0 +1,297 @@
+## Read-level alignment statistics and PBC/NRF library complexity for coordinate-sorted, indexed BAM files, ported from
+## original/SAMstats-V2-coordinate-sorted.py.
+## Every alignment is counted on its own with the weight 1/NH (NH tags are required), so the file is walked one region at a time with the .bai index
+## and each region is independent: chromosomes (or tiles of large chromosomes) are counted in separate worker processes and the partial statistics
+## are added up at the end. The complexity keys (signed 5' positions of read1 and of its mate) include the chromosome, so the merged complexity
+## counts are exact; an alignment belongs to the tile its start position falls in.
+## The counting follows the original script:
+##    properly paired alignments count 0.5/NH, not properly paired (mate unmapped) alignments 1/NH, unaligned pairs 0.5 per alignment
+##    the read length is the number of M bases in the CIGAR, and it is counted for unmapped alignments too
+##    a pair contributes one complexity key (read1 position, mate position; the forward strand position is negated) when read1 has NH 1
+## with these differences:
+##    the paired/unpaired decision is made for every alignment (the original keeps it from the previous alignments), so single-end files work
+##    regions of the chrom.sizes file that are missing from the BAM header are skipped up front instead of probing them with fetch
+##    the fractional counts are kept as integer alignment counts per NH and divided exactly at the end
+import os
+import sys
+import argparse
+from fractions import Fraction
+from .complexity import initialize_complexity, add_fragment, compact_complexity, merge_complexity, complexity_metrics, divide, default_buffer_size
+
+#default size of the tiles large chromosomes are split into
+default_tile_size=50000000
+#(process id, file name) -> BAM file opened by that process, reused for all regions of a worker
+#the process id keeps forked workers from sharing the file offset of a handle opened by the parent
+open_bam_files=dict()
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Read-level alignment statistics and PBC/NRF library complexity metrics for a coordinate-sorted, indexed BAM file with NH tags (port of SAMstats-V2-coordinate-sorted.py)")
+    parser.add_argument("--bam_file",help="Input BAM file sorted by coordinate, with a .bai index",required=True)
+    parser.add_argument("--outf",default=None,help="Output file name to store the statistics. The statistics will be printed to stdout if no file is provided")
+    parser.add_argument("--chrom_sizes",default=None,help="Tab separated file of chromosome name and length; only these chromosomes are counted. All reference sequences of the BAM header by default")
+    parser.add_argument("--threads",type=int,default=1,help="Number of worker processes; each processes one chromosome or chromosome tile at a time")
+    parser.add_argument("--tile_size",type=int,default=default_tile_size,help="Chromosomes longer than this are split into tiles of this size (bp)")
+    parser.add_argument("--buffer_size",type=int,default=default_buffer_size,help="Number of fragment keys to buffer before merging them into the sorted complexity arrays")
+    parser.add_argument("--partial_outf",default=None,help="Also write the counters, including the fragment counts, to this partial-result file; the partial files of several runs (i.e. one per --chrom_sizes subset) are added up with SAMstats merge (see partial.py)")
+    return parser.parse_args()
+
+
+def initialize_coordinate_stats():
+    '''
+    returns the statistics of SAMstats-V2-coordinate-sorted.py as numbers of alignments:
+    proper_pairs, not_proper_pairs, unpaired, spliced_reads, unspliced_reads -- NH -> number of mapped alignments
+    paired_unaligned, unpaired_unaligned -- number of unmapped alignments with an unmapped mate, and of unmapped unpaired alignments
+    read_lengths -- number of M bases -> NH -> number of alignments
+    '''
+    return {'proper_pairs':{1:0},
+            'not_proper_pairs':{1:0},
+            'unpaired':{1:0},
+            'paired_unaligned':0,
+            'unpaired_unaligned':0,
+            'spliced_reads':{1:0},
+            'unspliced_reads':{1:0},
+            'read_lengths':dict()}
+
+
+def increment(counts,key,value=1):
+    counts[key]=counts.get(key,0)+value
+
+
+def add_alignment(read,chrom,stats,complexity):
+    '''
+    read -- pysam AlignedSegment
+    counts the alignment in stats (see initialize_coordinate_stats) and complexity (see complexity.initialize_complexity)
+    '''
+    if not read.has_tag('NH'):
+        raise ValueError("no NH: tag for read "+read.query_name+", the NH tags are required")
+    nh=read.get_tag('NH')
+    flag=read.flag
+    cigar=read.cigartuples or []
+    matched=0
+    spliced=False
+    for operation,length in cigar:
+        if operation==0:
+            matched+=length
+        elif operation==3:
+            spliced=True
+    lengths=stats['read_lengths'].get(matched)
+    if lengths is None:
+        lengths=stats['read_lengths'][matched]=dict()
+    increment(lengths,nh)
+    if flag & 0x4:
+        if flag & 0x1:
+            if flag & 0x8:
+                stats['paired_unaligned']+=1
+        else:
+            stats['unpaired_unaligned']+=1
+        return
+    increment(stats['spliced_reads' if spliced else 'unspliced_reads'],nh)
+    if flag & 0xc1:
+        if flag & 0x8:
+            increment(stats['not_proper_pairs'],nh)
+        else:
+            increment(stats['proper_pairs'],nh)
+            if nh==1 and flag & 0x40:
+                pos1=read.reference_start+1
+                pos2=read.next_reference_start+1
+                if flag & 0x10:
+                    pos1=-pos1
+                else:
+                    pos2=-pos2
+                add_fragment(complexity,chrom,pos1,pos2)
+    else:
+        if nh==1:
+            pos1=read.reference_start+1
+            if flag & 0x10:
+                #a missing SEQ counts as 1 base, like "*" in a SAM file
+                pos1=-(pos1+(read.query_length if read.query_sequence is not None else 1))
+            add_fragment(complexity,chrom,pos1,pos1)
+        increment(stats['unpaired'],nh)
+
+
+def region_stats(bam_file,chrom,start,end,buffer_size=default_buffer_size):
+    '''
+    counts the alignments of the coordinate-sorted, indexed bam_file that start in [start, end) of chrom
+    returns (stats, complexity)
+    '''
+    #pysam is only needed for BAM input
+    import pysam
+    stats=initialize_coordinate_stats()
+    complexity=initialize_complexity(buffer_size)
+    samfile=open_bam_files.get((os.getpid(),bam_file))
+    if samfile is None:
+        samfile=open_bam_files[(os.getpid(),bam_file)]=pysam.AlignmentFile(bam_file,'rb')
+    for read in samfile.fetch(chrom,start,end):
+        #fetch also returns the alignments that start in a previous tile and overlap this one
+        if read.reference_start<start:
+            continue
+        add_alignment(read,chrom,stats,complexity)
+    compact_complexity(complexity)
+    return stats,complexity
+
+
+def merge_coordinate_stats(stats,other):
+    '''
+    adds the statistics of other to stats
+    '''
+    for name in ['proper_pairs','not_proper_pairs','unpaired','spliced_reads','unspliced_reads']:
+        for nh,count in other[name].items():
+            increment(stats[name],nh,count)
+    for name in ['paired_unaligned','unpaired_unaligned']:
+        stats[name]+=other[name]
+    for matched,lengths in other['read_lengths'].items():
+        cur=stats['read_lengths'].setdefault(matched,dict())
+        for nh,count in lengths.items():
+            increment(cur,nh,count)
+
+
+def read_chrom_sizes(chrom_sizes):
+    '''
+    returns the list of (chromosome, length) in the chrom.sizes file
+    '''
+    chroms=[]
+    for line in open(chrom_sizes):
+        fields=line.strip().split('\t')
+        if len(fields)<2:
+            continue
+        chroms.append((fields[0],int(fields[1])))
+    return chroms
+
+
+def chrom_tiles(bam_file,chrom_sizes=None,tile_size=default_tile_size):
+    '''
+    returns the list of (chromosome, start, end) regions to count, in the order of chrom_sizes (or of the BAM header)
+    '''
+    import pysam
+    samfile=pysam.AlignmentFile(bam_file,'rb')
+    if not samfile.has_index():
+        raise ValueError(bam_file+" has no index, run samtools index first")
+    header_chroms=dict(zip(samfile.references,samfile.lengths))
+    samfile.close()
+    if chrom_sizes is None:
+        chroms=list(header_chroms.items())
+    else:
+        chroms=[]
+        for chrom,length in read_chrom_sizes(chrom_sizes):
+            if chrom not in header_chroms:
+                print('problem with region: '+chrom+' 0 '+str(length)+' skipping',file=sys.stderr)
+                continue
+            chroms.append((chrom,length))
+    tiles=[]
+    for chrom,length in chroms:
+        for start in range(0,max(length,1),tile_size):
+            tiles.append((chrom,start,min(start+tile_size,length)))
+    return tiles
+
+
+def coordinate_complexity_stats(bam_file,chrom_sizes=None,threads=1,tile_size=default_tile_size,buffer_size=default_buffer_size):
+    '''
+    counts all regions of bam_file, in a pool of threads worker processes if threads>1
+    returns (stats, complexity)
+    '''
+    tasks=[(bam_file,chrom,start,end,buffer_size) for chrom,start,end in chrom_tiles(bam_file,chrom_sizes,tile_size)]
+    stats=initialize_coordinate_stats()
+    complexity=initialize_complexity(buffer_size)
+    if threads>1:
+        import multiprocess as mp
+        pool=mp.Pool(threads)
+        results=pool.imap(lambda task: region_stats(*task),tasks)
+    else:
+        pool=None
+        results=(region_stats(*task) for task in tasks)
+    for region_result in results:
+        merge_coordinate_stats(stats,region_result[0])
+        merge_complexity(complexity,region_result[1])
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return stats,complexity
+
+
+def weighted_count(counts,weight):
+    '''
+    counts -- NH -> number of alignments
+    returns the sum of the alignment counts weighted by weight/NH
+    '''
+    return sum([Fraction(counts[nh])*weight/nh for nh in counts],Fraction(0))
+
+
+def report_lines(stats,complexity):
+    '''
+    returns the lines of the SAMstats-V2-coordinate-sorted.py report
+    '''
+    half=Fraction(1,2)
+    unique=lambda counts: {1:counts.get(1,0)}
+    multi=lambda counts: {nh:counts[nh] for nh in counts if nh!=1}
+    lines=['unique pairs, proper:\t'+str(int(weighted_count(unique(stats['proper_pairs']),half))),
+           'unique pairs, not proper:\t'+str(int(weighted_count(unique(stats['not_proper_pairs']),1))),
+           'unique unpaired reads:\t'+str(int(weighted_count(unique(stats['unpaired']),1))),
+           'multiread pairs, proper:\t'+str(int(weighted_count(multi(stats['proper_pairs']),half))),
+           'multiread pairs, not proper:\t'+str(int(weighted_count(multi(stats['not_proper_pairs']),1))),
+           'multiread unpaired:\t'+str(int(weighted_count(multi(stats['unpaired']),1))),
+           'unaligned pairs:\t'+str(int(stats['paired_unaligned']*half)),
+           'unaligned unpaired reads:\t'+str(stats['unpaired_unaligned']),
+           'spliced unique reads:\t'+str(int(weighted_count(unique(stats['spliced_reads']),1))),
+           'spliced multireads:\t'+str(int(weighted_count(multi(stats['spliced_reads']),1))),
+           'unspliced unique reads:\t'+str(int(weighted_count(unique(stats['unspliced_reads']),1))),
+           'unspliced multireads:\t'+str(int(weighted_count(multi(stats['unspliced_reads']),1)))]
+    read_lengths=stats['read_lengths']
+    if len(read_lengths)==0:
+        lines+=['Read Length, Minimum:\tNA','Read Length, Maximum:\tNA']
+    else:
+        lines+=['Read Length, Minimum:\t'+str(min(read_lengths)),'Read Length, Maximum:\t'+str(max(read_lengths))]
+    total_reads=Fraction(0)
+    total_length=Fraction(0)
+    for matched,lengths in read_lengths.items():
+        reads=weighted_count(lengths,1)
+        total_reads+=reads
+        total_length+=matched*reads
+    lines.append('Read Length, Average:\t'+divide(total_length,total_reads))
+    up,ur,m0,m1,m2=complexity_metrics(complexity)
+    lines+=['#Library complexity metrics (unique reads/pairs only):',
+            'U_P\t'+str(up),
+            'U_R\t'+str(ur),
+            'M_0\t'+str(m0),
+            'M_1\t'+str(m1),
+            'M_2\t'+str(m2),
+            'PBC1\t'+divide(m1,m0),
+            'PBC2\t'+divide(m1,m2),
+            'NRF\t'+divide(up,ur)]
+    return lines
+
+
+def write_report(outf,stats,complexity):
+    '''
+    writes the report to the file name outf (stdout if None)
+    '''
+    lines=report_lines(stats,complexity)
+    if outf is None:
+        out=sys.stdout
+    else:
+        out=open(outf,'w')
+    out.write('\n'.join(lines)+'\n')
+    if outf is not None:
+        out.close()
+
+
+def bam_coordinate_complexity(bam_file,outf=None,chrom_sizes=None,threads=1,tile_size=default_tile_size,buffer_size=default_buffer_size):
+    '''
+    computes the SAMstats-V2-coordinate-sorted.py statistics of a coordinate-sorted, indexed BAM file and writes them to outf (stdout if None)
+    returns (stats, complexity)
+    '''
+    stats,complexity=coordinate_complexity_stats(bam_file,chrom_sizes,threads,tile_size,buffer_size)
+    write_report(outf,stats,complexity)
+    return stats,complexity
+
+
+def main():
+    args=parse_args()
+    stats,complexity=bam_coordinate_complexity(args.bam_file,args.outf,args.chrom_sizes,args.threads,args.tile_size,args.buffer_size)
+    if args.partial_outf is not None:
+        from .partial import write_partial, complexity_counters
+        write_partial(args.partial_outf,"coordinate_complexity",os.path.basename(args.bam_file),complexity_counters(stats,complexity))
+
+
+if __name__=="__main__":
+    main()
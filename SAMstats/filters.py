@@ -0,0 +1,125 @@
+## Alignment filters (MAPQ threshold, required/excluded FLAG bits, excluded contigs such as chrM) and per-read flagstat before and after filtering.
+## Both sets of statistics are computed in the same pass: every alignment is added to the masks of its read, and the alignments that pass
+## the filter are also added to a second set of masks, so a read is counted after filtering only if at least one of its alignments passes.
+## The alignments that pass the filter can be written out at the same time (see alignment_writer).
+## filter --> stat (--filter_before_stat) reports the statistics after filtering, stat --> filter the statistics of all alignments.
+import sys
+from .flagmask import mask_table, initialize_mask_counts
+
+#RNAMEs of the mitochondrial genome in the common reference builds
+mitochondrial_contigs=['chrM','MT','chrMT','M']
+
+
+def initialize_alignment_filter(min_mapq=0,required_flag=0,excluded_flag=0,excluded_contigs=None):
+    '''
+    returns the filter state: alignments pass when MAPQ>=min_mapq, all required_flag bits and none of the excluded_flag bits are set (samtools view -q/-f/-F)
+    and RNAME is not in excluded_contigs
+    '''
+    return {'min_mapq':min_mapq,
+            'required_flag':required_flag,
+            'excluded_flag':excluded_flag,
+            'excluded_contigs':set(excluded_contigs or [])}
+
+
+def filter_is_empty(alignment_filter):
+    return alignment_filter['min_mapq']<=0 and alignment_filter['required_flag']==0 and alignment_filter['excluded_flag']==0 and len(alignment_filter['excluded_contigs'])==0
+
+
+def passes_filter(alignment_filter,flag,mapq,rname):
+    '''
+    returns True if the alignment passes alignment_filter (see initialize_alignment_filter)
+    '''
+    return (mapq>=alignment_filter['min_mapq'] and
+            flag & alignment_filter['required_flag']==alignment_filter['required_flag'] and
+            not flag & alignment_filter['excluded_flag'] and
+            rname not in alignment_filter['excluded_contigs'])
+
+
+def iter_sam_filter_alignments(sam,chunk_size,header=None):
+    '''
+    sam -- text file handle for a SAM file
+    header -- optional list, the header lines are appended to it
+    yields (QNAME, FLAG, MAPQ, RNEXT, RNAME, SAM line) for every alignment
+    '''
+    while True:
+        cur_lines=sam.readlines(chunk_size)
+        if len(cur_lines)==0:
+            break
+        for line in cur_lines:
+            if line.startswith('@'):
+                #this is a comment, we skip
+                if header is not None:
+                    header.append(line)
+                continue
+            tokens=line.split('\t',7)
+            yield tokens[0],int(tokens[1]),int(tokens[4]),tokens[6],tokens[2],line
+
+
+def iter_pysam_filter_alignments(sam_file,reference=None,header=None):
+    '''
+    yields (QNAME, FLAG, MAPQ, RNEXT, RNAME, pysam AlignedSegment) for every alignment of a BAM/CRAM file read with pysam
+    header -- optional list, the text of the header is appended to it
+    '''
+    #pysam is only needed for BAM/CRAM input
+    import pysam
+    from .bam import rnext_name
+    samfile=pysam.AlignmentFile(sam_file,reference_filename=reference,check_sq=False)
+    if header is not None:
+        header.append(str(samfile.header))
+    references=samfile.references
+    for read in samfile.fetch(until_eof=True):
+        rname=references[read.reference_id] if read.reference_id>=0 else '*'
+        yield read.query_name,read.flag,read.mapping_quality,rnext_name(read.reference_id,read.next_reference_id,references),rname,read
+    samfile.close()
+
+
+def count_filtered_read_masks(alignments,alignment_filter,writer=None):
+    '''
+    alignments -- iterator of (QNAME, FLAG, MAPQ, RNEXT, RNAME, record) for a file sorted by read name
+    alignment_filter -- see initialize_alignment_filter
+    writer -- optional alignment writer (see alignment_writer.initialize_alignment_writer) for the alignments that pass the filter
+    returns (mask counts of all alignments, mask counts of the alignments that pass the filter) (see flagmask.initialize_mask_counts)
+    '''
+    from . import initialize_read_masks, update_flagstat_for_readname
+    from .alignment_writer import write_alignment, close_alignment_writer
+    all_mask_counts=initialize_mask_counts()
+    filtered_mask_counts=initialize_mask_counts()
+    all_masks=initialize_read_masks()
+    filtered_masks=initialize_read_masks()
+    min_mapq=alignment_filter['min_mapq']
+    required_flag=alignment_filter['required_flag']
+    excluded_flag=alignment_filter['excluded_flag']
+    excluded_contigs=alignment_filter['excluded_contigs']
+    cur_seq_id=None
+    for qname,flag,mapq,rnext,rname,record in alignments:
+        if qname!=cur_seq_id:
+            update_flagstat_for_readname(all_mask_counts,all_masks)
+            update_flagstat_for_readname(filtered_mask_counts,filtered_masks)
+            cur_seq_id=qname
+        mask=mask_table[((flag & 0xfff)<<2) | ((rnext!="=")<<1) | (mapq>=5)]
+        slot=((flag & 0xc0)>>5) | ((flag & 0x200)>>9)
+        all_masks[slot]|=mask
+        if mapq>=min_mapq and flag & required_flag==required_flag and not flag & excluded_flag and rname not in excluded_contigs:
+            filtered_masks[slot]|=mask
+            if writer is not None:
+                write_alignment(writer,record)
+    update_flagstat_for_readname(all_mask_counts,all_masks)
+    update_flagstat_for_readname(filtered_mask_counts,filtered_masks)
+    if writer is not None:
+        close_alignment_writer(writer)
+    return all_mask_counts,filtered_mask_counts
+
+
+def filtered_mask_counts(sorted_sam_file,alignment_filter,input_format="sam",reference=None,chunk_size=100000,writer=None):
+    '''
+    computes the per-read mask counts of a name-sorted SAM/BAM/CRAM file before and after filtering (BAM/CRAM input requires pysam)
+    returns (mask counts of all alignments, mask counts of the alignments that pass the filter)
+    '''
+    header=writer['header'] if writer is not None else None
+    if input_format in ["bam","cram"]:
+        alignments=iter_pysam_filter_alignments(sorted_sam_file if sorted_sam_file!="-" else sys.stdin.buffer,reference,header)
+    else:
+        from . import open_input
+        sam=open_input(sorted_sam_file,False,decompress=True)
+        alignments=iter_sam_filter_alignments(sam,chunk_size,header)
+    return count_filtered_read_masks(alignments,alignment_filter,writer)
@@ -0,0 +1,166 @@
+## Lookup-table implementation of the per-alignment flagstat logic.
+## The FLAG field only has 4096 possible values, so the 14 flagstat criteria are precomputed once for every
+## (FLAG, RNEXT!="=", MAPQ>=5) combination and stored as a 14-bit mask.
+## Bit i of a mask is set when the alignment meets the criteria for entry i of the flagstat arrays
+## (same ordering as the stats list, with bit 13 keeping track of primary reads).
+from array import array
+
+#number of entries in a flagstat array (13 flagstat metrics + primary reads)
+num_fields=14
+#number of distinct masks a read can accumulate
+num_masks=1<<num_fields
+
+
+def flag_mask(flag,mate_on_different_chrom,mapq_ge5):
+    '''
+    implements flagstat logic from http://www.htslib.org/doc/samtools.html to calculate each of the 13 flags for a single alignment
+    returns the result as a 14-bit integer mask rather than a list of booleans
+    '''
+    qc_passed=flag & 0x200 == 0
+    secondary=flag & 0x100 == 0x100
+    supplementary=flag & 0x800 == 0x800
+    duplicate=flag & 0x400 == 0x400
+    mapped=flag & 0x4 == 0
+    #note: it is not stated in the samtools documentation, but the paired read statistics are *only* computed for primary reads, so we add a check that primary==1 for all remaining stats
+    primary=flag & 0x800 == 0
+    paired_in_sequencing=(flag & 0x1 == 0x1) and primary
+    read1=paired_in_sequencing and (flag & 0x40 == 0x40)
+    read2=paired_in_sequencing and (flag & 0x80 == 0x80)
+    properly_paired=paired_in_sequencing and (flag & 0x2 == 0x2) and mapped
+    with_itself_and_mate_mapped=paired_in_sequencing and mapped and (flag & 0x8 == 0)
+    singleton=paired_in_sequencing and (flag & 0x8 == 0x8) and mapped
+    with_mate_mapped_to_different_chrom=with_itself_and_mate_mapped and mate_on_different_chrom
+    with_mate_mapped_to_different_chrom_q5=with_mate_mapped_to_different_chrom and mapq_ge5
+    fields=[qc_passed,
+            secondary,
+            supplementary,
+            duplicate,
+            mapped,
+            paired_in_sequencing,
+            read1,
+            read2,
+            properly_paired,
+            with_itself_and_mate_mapped,
+            singleton,
+            with_mate_mapped_to_different_chrom,
+            with_mate_mapped_to_different_chrom_q5,
+            primary]
+    mask=0
+    for i in range(num_fields):
+        if fields[i]:
+            mask|=1<<i
+    return mask
+
+
+def build_mask_table():
+    '''
+    returns a list with one mask for every (FLAG, RNEXT!="=", MAPQ>=5) combination, addressed with mask_index
+    '''
+    mask_table=[]
+    for flag in range(4096):
+        for mate_on_different_chrom in (False,True):
+            for mapq_ge5 in (False,True):
+                mask_table.append(flag_mask(flag,mate_on_different_chrom,mapq_ge5))
+    return mask_table
+
+
+def mask_index(flag,mapq,rnext):
+    '''
+    position of the mask for an alignment in the table returned by build_mask_table
+    '''
+    return ((flag & 0xfff)<<2) | ((rnext!="=")<<1) | (mapq>=5)
+
+
+#the table is small (16384 entries), so it is built once at import time
+mask_table=build_mask_table()
+
+
+#the alignments of a read name are split into reads by their segment bits (FLAG & 0xc0): 0 = unpaired (single-end), 1 = read1 (0x40),
+#2 = read2 (0x80), 3 = middle segments (both bits, templates with more than two segments). Single-end and paired-end alignments sharing a
+#QNAME are different reads, so they never share a slot. With the qc fail bit (0x200) this gives 8 mask slots per read name, the hot loops
+#compute the slot inline as ((flag & 0xc0)>>5) | ((flag & 0x200)>>9)
+num_read_slots=8
+
+
+def read_slot(flag):
+    '''
+    slot of an alignment in the masks of its read name (see SAMstats.initialize_read_masks): segment (FLAG & 0xc0) and qc subset (FLAG & 0x200)
+    '''
+    return ((flag & 0xc0)>>5) | ((flag & 0x200)>>9)
+
+
+#per-alignment filters of flagstat.sh for each entry of the flagstat arrays: (required FLAG bits (samtools view -f), excluded FLAG bits (-F), MAPQ>=5 (-q5), RNEXT!="=" (awk '$7 != "="'))
+#the QC-passed/QC-failed split (-F/-f 0x200) is applied on top of these
+alignment_filters=[(0,0,False,False),
+                   (0x100,0,False,False),
+                   (0x800,0,False,False),
+                   (0x400,0,False,False),
+                   (0,0x4,False,False),
+                   (0x1,0x800,False,False),
+                   (0x1|0x40,0x800,False,False),
+                   (0x1|0x80,0x800,False,False),
+                   (0x1|0x2,0x4|0x800,False,False),
+                   (0x1,0x4|0x8|0x800,False,False),
+                   (0x1|0x8,0x4|0x800,False,False),
+                   (0x1,0x4|0x8|0x800,False,True),
+                   (0,0x4|0x800,True,True),
+                   (0,0x800,False,False)]
+
+
+def initialize_mask_counts():
+    '''
+    number of reads that accumulated each of the possible masks, for the qc_passed and qc_failed read subsets
+    returns [qc_passed, qc_failed] list of unsigned 64-bit arrays indexed by mask
+    '''
+    return [array('Q',[0])*num_masks,array('Q',[0])*num_masks]
+
+
+def mask_counts_to_flagstat(mask_counts):
+    '''
+    expands the per-mask read counts into the [qc_passed, qc_failed] flagstat arrays of length 14
+    the counts for each qc subset can be a list or array indexed by mask or a dictionary of mask:count for sparse counts
+    '''
+    flagstat=[[0]*num_fields,[0]*num_fields]
+    for qc in range(2):
+        if isinstance(mask_counts[qc],dict):
+            counts=mask_counts[qc].items()
+        else:
+            counts=enumerate(mask_counts[qc])
+        for mask,count in counts:
+            if count==0 or mask==0:
+                continue
+            for i in range(num_fields):
+                if mask>>i & 1:
+                    flagstat[qc][i]+=count
+    return flagstat
+
+
+def initialize_alignment_counts():
+    '''
+    number of alignments with each (FLAG, RNEXT!="=", MAPQ>=5) combination, addressed with mask_index
+    '''
+    return array('Q',[0])*num_masks
+
+
+def alignment_counts_to_flagstat(alignment_counts):
+    '''
+    applies the per-alignment filters of flagstat.sh to the alignment counts (see initialize_alignment_counts)
+    returns the [qc_passed, qc_failed] flagstat arrays of length 14 counting alignments rather than reads
+    '''
+    flagstat=[[0]*num_fields,[0]*num_fields]
+    for index in range(len(alignment_counts)):
+        count=alignment_counts[index]
+        if count==0:
+            continue
+        flag=index>>2
+        rnext_differs=index & 0x2
+        mapq_ge5=index & 0x1
+        qc=(flag & 0x200)>>9
+        for i in range(num_fields):
+            required,excluded,q5,rnext_filter=alignment_filters[i]
+            if flag & required!=required or flag & excluded:
+                continue
+            if (q5 and not mapq_ge5) or (rnext_filter and not rnext_differs):
+                continue
+            flagstat[qc][i]+=count
+    return flagstat
@@ -0,0 +1,114 @@
+## Per-group flagstat (i.e. per read group / lane of a merged file) computed in the same pass as the totals.
+## A read name belongs to the group of its first alignment: the value of its RG tag, or the part of its QNAME matched by a regular expression
+## (the first capture group if the expression has one). Each group keeps its own mask counts (see flagmask.initialize_mask_counts), and the
+## totals are the sum of the groups, so they are identical to the report without grouping.
+import re
+import sys
+from .flagmask import mask_table, initialize_mask_counts
+
+#group of the reads without an RG tag, or whose QNAME does not match the expression
+unassigned_group='unassigned'
+
+
+def iter_sam_alignment_read_groups(sam,chunk_size):
+    '''
+    sam -- text file handle for a SAM file
+    yields (QNAME, FLAG, MAPQ, RNEXT, RG) for every alignment; RG is None if the alignment has no RG tag
+    '''
+    while True:
+        cur_lines=sam.readlines(chunk_size)
+        if len(cur_lines)==0:
+            break
+        for line in cur_lines:
+            if line.startswith('@'):
+                #this is a comment, we skip
+                continue
+            tokens=line.rstrip('\n').split('\t',11)
+            rg=None
+            if len(tokens)>11:
+                #search the optional fields only
+                tags='\t'+tokens[11]
+                rg_start=tags.find('\tRG:Z:')
+                if rg_start!=-1:
+                    rg_end=tags.find('\t',rg_start+1)
+                    rg=tags[rg_start+6:rg_end if rg_end!=-1 else len(tags)]
+            yield tokens[0],int(tokens[1]),int(tokens[4]),tokens[6],rg
+
+
+def qname_group_function(qname_regex):
+    '''
+    returns a function that maps a QNAME (str or bytes) to its group: the first capture group of qname_regex (or the whole match)
+    found at the start of the QNAME
+    '''
+    expression=re.compile(qname_regex)
+    def qname_group(qname):
+        if isinstance(qname,bytes):
+            qname=qname.decode()
+        match=expression.match(qname)
+        if match is None:
+            return unassigned_group
+        if expression.groups>0:
+            return match.group(1)
+        return match.group(0)
+    return qname_group
+
+
+def count_group_read_masks(alignments,qname_group=None):
+    '''
+    alignments -- iterator of (QNAME, FLAG, MAPQ, RNEXT, RG) for a file sorted by read name
+    qname_group -- optional function of the QNAME that returns the group (see qname_group_function); the RG tag is used otherwise
+    returns the dictionary of group -> mask counts (see flagmask.initialize_mask_counts), in order of first appearance
+    '''
+    from . import initialize_read_masks, update_flagstat_for_readname
+    group_mask_counts=dict()
+    cur_seq_id=None
+    cur_mask_counts=None
+    cur_masks=initialize_read_masks()
+    for qname,flag,mapq,rnext,rg in alignments:
+        if qname!=cur_seq_id:
+            if cur_mask_counts is not None:
+                update_flagstat_for_readname(cur_mask_counts,cur_masks)
+            cur_seq_id=qname
+            group=qname_group(qname) if qname_group is not None else rg
+            if group is None:
+                group=unassigned_group
+            cur_mask_counts=group_mask_counts.get(group)
+            if cur_mask_counts is None:
+                cur_mask_counts=group_mask_counts[group]=initialize_mask_counts()
+        cur_masks[((flag & 0xc0)>>5) | ((flag & 0x200)>>9)]|=mask_table[((flag & 0xfff)<<2) | ((rnext!="=")<<1) | (mapq>=5)]
+    if cur_mask_counts is not None:
+        update_flagstat_for_readname(cur_mask_counts,cur_masks)
+    return group_mask_counts
+
+
+def sum_mask_counts(group_mask_counts):
+    '''
+    returns the mask counts of all groups added up
+    '''
+    total=initialize_mask_counts()
+    for mask_counts in group_mask_counts.values():
+        for qc in range(2):
+            total_qc=total[qc]
+            for mask,count in enumerate(mask_counts[qc]):
+                if count:
+                    total_qc[mask]+=count
+    return total
+
+
+def group_mask_counts(sorted_sam_file,group_by,input_format="sam",reference=None,chunk_size=100000):
+    '''
+    group_by -- "RG" to group the reads by read group, or a regular expression for the QNAME
+    returns the dictionary of group -> mask counts for a name-sorted SAM/BAM/CRAM file
+    '''
+    if input_format=="bam":
+        from .bam import iter_bam_alignment_read_groups
+        bam=sys.stdin.buffer if sorted_sam_file=="-" else open(sorted_sam_file,'rb')
+        alignments=iter_bam_alignment_read_groups(bam,chunk_size)
+    elif input_format=="cram":
+        from .bam import iter_cram_alignments
+        alignments=iter_cram_alignments(sorted_sam_file,reference,read_group=True)
+    else:
+        from . import open_input
+        sam=open_input(sorted_sam_file,False,decompress=True)
+        alignments=iter_sam_alignment_read_groups(sam,chunk_size)
+    return count_group_read_masks(alignments,None if group_by=="RG" else qname_group_function(group_by))
@@ -0,0 +1,277 @@
+## Partial-result files: the counters of a run are saved to a small versioned file, and `SAMstats merge` adds up any number of them and writes
+## the reports as if the whole input had been processed in one run. The shards of a name-sorted file must be split at read-name boundaries
+## (every read name in exactly one shard), then the merged counts are identical to a single run.
+## A partial file is gzip compressed JSON:
+##    {"format": "SAMstats-partial", "version": 1, "kind": "flagstat" | "complexity" | "coordinate_complexity", "sample": ..., "counters": {...}}
+## flagstat counters are the per-read mask counts (see flagmask.initialize_mask_counts) as sparse [mask, count] pairs, with the optional
+## per-alignment counts, per-group mask counts and the mask counts before/after filtering; the percentages are computed after merging.
+## complexity counters are the read statistics and the fragment counts of every chromosome (sorted 64-bit keys + 32-bit counts, base64 encoded),
+## so fragments seen in several shards are counted once and M_1/M_2/PBC/NRF are exact after merging.
+import os
+import sys
+import gzip
+import json
+import base64
+import argparse
+from array import array
+from .flagmask import initialize_mask_counts, initialize_alignment_counts
+
+partial_format="SAMstats-partial"
+#version of the partial file layout; files with another version are rejected
+partial_version=1
+#optional flagstat counters that are sums of mask counts
+flagstat_mask_sections=['unfiltered','filtered']
+
+
+def parse_merge_args(argv):
+    parser=argparse.ArgumentParser(prog="SAMstats merge",description="Add up SAMstats partial-result files (--partial_outf) of the shards of a sample and write the reports")
+    parser.add_argument("partial_files",nargs='+',help="Partial-result files, all written by the same tool with the same options")
+    parser.add_argument("--outf",default=None,help="Output file name for the merged statistics. The statistics will be printed to stdout if no file is provided")
+    parser.add_argument("--partial_outf",default=None,help="Also write the merged counters as a partial-result file, i.e. for a merge in several steps")
+    parser.add_argument("--group_outf",default=None,help="Output file for the per-group statistics. Defaults to --outf with a .groups.txt suffix, or stdout")
+    parser.add_argument("--unfiltered_outf",default=None,help="Also write the statistics of all alignments to this file")
+    parser.add_argument("--filtered_outf",default=None,help="Also write the statistics of the alignments that pass the filters to this file")
+    parser.add_argument("--json_outf",default=None,help="Also write the statistics as JSON (see report.py)")
+    parser.add_argument("--tsv_outf",default=None,help="Also write the statistics as a TSV table with one line per statistic")
+    parser.add_argument("--parquet_outf",default=None,help="Also write the statistics as a Parquet table with the columns of the TSV table (requires pyarrow)")
+    parser.add_argument("--sample_name",default=None,help="Sample name in the JSON/TSV/Parquet output. Defaults to the sample of the partial files")
+    return parser.parse_args(argv)
+
+
+def sparse_counts(counts):
+    '''
+    returns the non-zero entries of an array of counts as [index, count] pairs
+    '''
+    return [[index,count] for index,count in enumerate(counts) if count]
+
+
+def add_sparse_counts(counts,pairs):
+    '''
+    adds [index, count] pairs (see sparse_counts) to the array counts
+    '''
+    for index,count in pairs:
+        counts[index]+=count
+    return counts
+
+
+def encode_mask_counts(mask_counts):
+    return [sparse_counts(mask_counts[0]),sparse_counts(mask_counts[1])]
+
+
+def add_encoded_mask_counts(mask_counts,encoded):
+    add_sparse_counts(mask_counts[0],encoded[0])
+    add_sparse_counts(mask_counts[1],encoded[1])
+    return mask_counts
+
+
+def encode_array(values,typecode):
+    '''
+    returns the values as a base64 string of little-endian machine integers
+    '''
+    values=array(typecode,values)
+    if sys.byteorder!="little":
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode('ascii')
+
+
+def decode_array(encoded,typecode):
+    values=array(typecode)
+    values.frombytes(base64.b64decode(encoded))
+    if sys.byteorder!="little":
+        values.byteswap()
+    return values
+
+
+def encode_complexity(complexity):
+    '''
+    returns chromosome -> [base64 sorted keys, base64 counts] for the complexity counters (see complexity.initialize_complexity)
+    '''
+    from .complexity import compact_complexity
+    compact_complexity(complexity)
+    encoded=dict()
+    for chrom,fragments in complexity['chroms'].items():
+        if complexity['numpy']:
+            if fragments[0] is None:
+                continue
+            encoded[chrom]=[base64.b64encode(fragments[0].astype('<i8').tobytes()).decode('ascii'),
+                            base64.b64encode(fragments[1].astype('<u4').tobytes()).decode('ascii')]
+        else:
+            keys=sorted(fragments)
+            encoded[chrom]=[encode_array(keys,'q'),encode_array([fragments[key] for key in keys],'I')]
+    return encoded
+
+
+def decode_complexity(encoded):
+    '''
+    returns complexity counters (see complexity.initialize_complexity) with the fragment counts of encode_complexity
+    '''
+    from .complexity import initialize_complexity
+    complexity=initialize_complexity()
+    for chrom,(keys,counts) in encoded.items():
+        keys=decode_array(keys,'q')
+        counts=decode_array(counts,'I')
+        if complexity['numpy']:
+            import numpy as np
+            complexity['chroms'][chrom]=[np.frombuffer(keys,dtype=np.int64).copy(),np.frombuffer(counts,dtype=np.uint32).copy(),array('q')]
+        else:
+            complexity['chroms'][chrom]=dict(zip(keys,counts))
+    return complexity
+
+
+def decode_int_keys(value):
+    '''
+    restores the integer keys (NH, read length) of the read statistics, which JSON stores as strings
+    '''
+    if isinstance(value,dict):
+        return {int(key):decode_int_keys(item) for key,item in value.items()}
+    return value
+
+
+def write_partial(outf,kind,sample,counters,checkpoint=None):
+    '''
+    writes the counters of one run (see flagstat_counters, complexity_counters) to the file name outf
+    checkpoint -- optional input position of the counters (see checkpoint.save_checkpoint)
+    the file is written under a temporary name and renamed, so outf is never left half written
+    '''
+    partial={'format':partial_format,
+             'version':partial_version,
+             'kind':kind,
+             'sample':sample,
+             'counters':counters}
+    if checkpoint is not None:
+        partial['checkpoint']=checkpoint
+    with gzip.open(outf+'.tmp','wt') as out:
+        json.dump(partial,out,separators=(',',':'))
+    os.replace(outf+'.tmp',outf)
+
+
+def read_partial(partial_file):
+    '''
+    returns the contents of a partial-result file, raises ValueError if it is not a partial file of this version
+    '''
+    with gzip.open(partial_file,'rt') as f:
+        partial=json.load(f)
+    if not isinstance(partial,dict) or partial.get('format')!=partial_format:
+        raise ValueError(partial_file+" is not a SAMstats partial-result file")
+    if partial.get('version')!=partial_version:
+        raise ValueError(partial_file+" has partial-result version "+str(partial.get('version'))+", expected "+str(partial_version))
+    return partial
+
+
+def flagstat_counters(global_mask_counts,alignment_counts=None,group_counts=None,unfiltered_mask_counts=None,filtered_mask_counts=None):
+    '''
+    returns the counters of a SAMstats run to save with write_partial (the optional counters are omitted when None)
+    '''
+    counters={'mask_counts':encode_mask_counts(global_mask_counts)}
+    if alignment_counts is not None:
+        counters['alignment_counts']=sparse_counts(alignment_counts)
+    if group_counts is not None:
+        counters['groups']=[[group,encode_mask_counts(mask_counts)] for group,mask_counts in group_counts.items()]
+    if unfiltered_mask_counts is not None:
+        counters['unfiltered']=encode_mask_counts(unfiltered_mask_counts)
+        counters['filtered']=encode_mask_counts(filtered_mask_counts)
+    return counters
+
+
+def merge_flagstat_counters(partials):
+    '''
+    returns {'mask_counts', 'alignment_counts', 'groups', 'unfiltered', 'filtered'} summed over the flagstat partials (None for the counters they do not have)
+    '''
+    sections=set(partials[0]['counters'])
+    for partial in partials[1:]:
+        if set(partial['counters'])!=sections:
+            raise ValueError("the partial-result files were written with different options: "+", ".join(sorted(sections^set(partial['counters']))))
+    merged={'mask_counts':initialize_mask_counts(),
+            'alignment_counts':initialize_alignment_counts() if 'alignment_counts' in sections else None,
+            'groups':dict() if 'groups' in sections else None}
+    for name in flagstat_mask_sections:
+        merged[name]=initialize_mask_counts() if name in sections else None
+    for partial in partials:
+        counters=partial['counters']
+        add_encoded_mask_counts(merged['mask_counts'],counters['mask_counts'])
+        if merged['alignment_counts'] is not None:
+            add_sparse_counts(merged['alignment_counts'],counters['alignment_counts'])
+        if merged['groups'] is not None:
+            #groups are kept in order of first appearance across the partial files
+            for group,encoded in counters['groups']:
+                if group not in merged['groups']:
+                    merged['groups'][group]=initialize_mask_counts()
+                add_encoded_mask_counts(merged['groups'][group],encoded)
+        for name in flagstat_mask_sections:
+            if merged[name] is not None:
+                add_encoded_mask_counts(merged[name],counters[name])
+    return merged
+
+
+def complexity_counters(read_stats,complexity):
+    '''
+    returns the counters of a SAMstatsComplexity or SAMstatsCoordinateComplexity run to save with write_partial
+    '''
+    return {'read_stats':read_stats,'fragments':encode_complexity(complexity)}
+
+
+def merge_complexity_counters(partials,merge_stats):
+    '''
+    merge_stats -- complexity.merge_read_stats or coordinate_complexity.merge_coordinate_stats
+    returns (read statistics, complexity counters) summed over the partials
+    '''
+    from .complexity import merge_complexity
+    read_stats=None
+    complexity=None
+    for partial in partials:
+        cur_stats={name:decode_int_keys(value) for name,value in partial['counters']['read_stats'].items()}
+        cur_complexity=decode_complexity(partial['counters']['fragments'])
+        if read_stats is None:
+            read_stats,complexity=cur_stats,cur_complexity
+        else:
+            merge_stats(read_stats,cur_stats)
+            merge_complexity(complexity,cur_complexity)
+    return read_stats,complexity
+
+
+def merge_main(argv):
+    '''
+    SAMstats merge: reads the partial files, adds them up and writes the reports of the tool that wrote them
+    '''
+    args=parse_merge_args(argv)
+    partials=[read_partial(partial_file) for partial_file in args.partial_files]
+    kinds=set([partial['kind'] for partial in partials])
+    if len(kinds)>1:
+        raise ValueError("partial-result files of different tools can not be merged: "+", ".join(sorted(kinds)))
+    kind=partials[0]['kind']
+    sample=args.sample_name
+    if sample is None:
+        samples=set([partial['sample'] for partial in partials])
+        sample=samples.pop() if len(samples)==1 else "merged"
+    if kind=="flagstat":
+        from . import write_flagstat_reports
+        merged=merge_flagstat_counters(partials)
+        if merged['groups'] is not None and args.group_outf is None and args.outf is not None:
+            args.group_outf=args.outf+'.groups.txt'
+        if args.partial_outf is not None:
+            write_partial(args.partial_outf,kind,sample,flagstat_counters(merged['mask_counts'],
+                                                                         merged['alignment_counts'],
+                                                                         merged['groups'],
+                                                                         merged['unfiltered'],
+                                                                         merged['filtered']))
+        write_flagstat_reports(args,
+                               sample,
+                               merged['mask_counts'],
+                               merged['alignment_counts'],
+                               merged['groups'],
+                               merged['unfiltered'],
+                               merged['filtered'])
+    elif kind=="complexity":
+        from .complexity import merge_read_stats, write_report
+        read_stats,complexity=merge_complexity_counters(partials,merge_read_stats)
+        if args.partial_outf is not None:
+            write_partial(args.partial_outf,kind,sample,complexity_counters(read_stats,complexity))
+        write_report(args.outf,read_stats,complexity)
+    elif kind=="coordinate_complexity":
+        from .coordinate_complexity import merge_coordinate_stats, write_report
+        stats,complexity=merge_complexity_counters(partials,merge_coordinate_stats)
+        if args.partial_outf is not None:
+            write_partial(args.partial_outf,kind,sample,complexity_counters(stats,complexity))
+        write_report(args.outf,stats,complexity)
+    else:
+        raise ValueError("unknown partial-result kind: "+str(kind))
@@ -0,0 +1,109 @@
+## Read-ahead for slow (i.e. network) filesystems: a background thread reads the input into a small ring of large byte buffers while the
+## main thread parses the previous ones, so the time spent waiting on read calls overlaps with the parsing. File reads release the GIL, so a
+## thread is enough, no process is needed.
+##    read_ahead_mb -- total size of the buffers; it is split into buffers of at most prefetch_buffer_size bytes, at least two (double buffering)
+## Every buffer is allocated once: the thread fills a free buffer with readinto and queues it, the parser copies it out and hands it back, so the
+## read-ahead never holds more than read_ahead_mb of input. The prefetched input is exposed as a regular binary file handle (see ChunkedInput), so the
+## engines read it with readlines/read/readinto as before. The prefetched handles can not seek.
+import io
+import queue
+import threading
+
+#largest single read of the background thread
+prefetch_buffer_size=4<<20
+
+
+def prefetch_buffers(read_ahead_mb):
+    '''
+    returns (number of buffers, buffer size in bytes) for a read-ahead of read_ahead_mb MB
+    '''
+    read_ahead=max(int(read_ahead_mb*(1<<20)),2)
+    buffer_size=min(prefetch_buffer_size,read_ahead//2)
+    return max(read_ahead//buffer_size,2),buffer_size
+
+
+def fill_buffers(f,free_buffers,filled_buffers):
+    '''
+    background thread: reads f into the free buffers and queues (buffer, number of bytes) until the end of the file, then (None, 0)
+    an exception is queued as (exception, 0) and raised again in the parser thread
+    '''
+    try:
+        while True:
+            buf=free_buffers.get()
+            if buf is None:
+                #the prefetched input was closed before its end
+                return
+            num_bytes=f.readinto(buf)
+            if not num_bytes:
+                filled_buffers.put((None,0))
+                return
+            filled_buffers.put((buf,num_bytes))
+    except Exception as e:
+        filled_buffers.put((e,0))
+
+
+def prefetched_chunks(f,num_buffers,buffer_size):
+    '''
+    starts the background thread and yields the filled part of each buffer, in order
+    num_buffers, buffer_size -- ring of buffers the thread reads into (see prefetch_buffers)
+    a buffer is handed back to the thread when the next one is requested, so every chunk must be used (or copied) before that
+    '''
+    free_buffers=queue.Queue()
+    filled_buffers=queue.Queue()
+    for i in range(num_buffers):
+        free_buffers.put(bytearray(buffer_size))
+    threading.Thread(target=fill_buffers,args=(f,free_buffers,filled_buffers),daemon=True).start()
+    try:
+        while True:
+            buf,num_bytes=filled_buffers.get()
+            if isinstance(buf,Exception):
+                raise buf
+            if buf is None:
+                return
+            yield memoryview(buf)[:num_bytes]
+            #the parser is done with this buffer, it can be filled again
+            free_buffers.put(buf)
+    finally:
+        #stops the background thread if it is still running
+        free_buffers.put(None)
+
+
+class ChunkedInput(io.RawIOBase):
+    '''
+    raw binary stream over an iterator of bytes-like chunks (i.e. prefetched_chunks or bgzf.decompressed_chunks), to be wrapped in an
+    io.BufferedReader
+    '''
+    def __init__(self,chunks):
+        self.chunks=chunks
+        self.chunk=memoryview(b'')
+        self.offset=0
+
+    def readable(self):
+        return True
+
+    def readinto(self,b):
+        while self.offset==len(self.chunk):
+            chunk=next(self.chunks,None)
+            if chunk is None:
+                return 0
+            self.chunk=memoryview(chunk)
+            self.offset=0
+        num_bytes=min(len(b),len(self.chunk)-self.offset)
+        b[:num_bytes]=self.chunk[self.offset:self.offset+num_bytes]
+        self.offset+=num_bytes
+        return num_bytes
+
+    def close(self):
+        if hasattr(self.chunks,'close'):
+            self.chunks.close()
+        super().close()
+
+
+def open_prefetched(f,read_ahead_mb):
+    '''
+    f -- binary file handle (i.e. open(sam_file,'rb') or sys.stdin.buffer)
+    read_ahead_mb -- size of the read-ahead in MB
+    returns a binary file handle that reads f through the background thread
+    '''
+    num_buffers,buffer_size=prefetch_buffers(read_ahead_mb)
+    return io.BufferedReader(ChunkedInput(prefetched_chunks(f,num_buffers,buffer_size)),buffer_size=min(buffer_size,1<<20))
@@ -0,0 +1,174 @@
+## Per-stage timing for --profile runs.
+## A profile is a dictionary of stage -> [seconds, calls] accumulated with time.perf_counter around the stages of the counting loops:
+##    read      -- reading lines/chunks from the input
+##    parse     -- splitting lines and converting FLAG/MAPQ
+##    classify  -- per-alignment flagstat logic (the mask lookup of add_read_stats)
+##    reduce    -- per-read reduction into the global counts (update_flagstat_for_readname)
+##    output    -- expanding the counts and writing the reports
+##    queue_wait-- (SAMstatsParallel) time blocked on a full or empty queue; the reader thread times read+parse as one stage
+## Every thread keeps its own profile, so no locking is needed; they are printed side by side at the end.
+## The per-line stages are only timed in the instrumented copy of the loop used with --profile, so normal runs are unchanged.
+## The timer calls themselves take time, which is estimated from the number of timed intervals and reported on its own line.
+## --profile_dump additionally runs cProfile (one profiler per thread) and writes the combined pstats file.
+import sys
+import time
+
+#stages of the SAMstats counting loop, in report order
+default_stages=['read','parse','classify','reduce','output']
+
+
+def initialize_profile(stages=default_stages):
+    '''
+    returns the profile state: {'stages': stage -> [seconds, calls], 'order': stage names, 'start': perf_counter at creation}
+    '''
+    return {'stages':{stage:[0.0,0] for stage in stages},
+            'order':list(stages),
+            'start':time.perf_counter(),
+            'end':None}
+
+
+def add_time(profile,stage,seconds,calls=1):
+    '''
+    adds seconds (and calls) to stage, creating it if needed
+    '''
+    if stage not in profile['stages']:
+        profile['stages'][stage]=[0.0,0]
+        #the output stage stays last
+        if 'output' in profile['order']:
+            profile['order'].insert(profile['order'].index('output'),stage)
+        else:
+            profile['order'].append(stage)
+    timing=profile['stages'][stage]
+    timing[0]+=seconds
+    timing[1]+=calls
+
+
+def finish_profile(profile):
+    profile['end']=time.perf_counter()
+    return profile
+
+
+def timer_cost(samples=100000):
+    '''
+    returns the average cost in seconds of one perf_counter call
+    '''
+    clock=time.perf_counter
+    start=clock()
+    for i in range(samples):
+        clock()
+    return (clock()-start)/samples
+
+
+def profile_lines(name,profile,cost=None):
+    '''
+    returns the report lines of one profile: seconds, % of the wall time, calls and time per call of every stage
+    cost -- cost of one timer call (see timer_cost), used to estimate the timer overhead (about one timer call per timed interval)
+    '''
+    end=profile['end'] if profile['end'] is not None else time.perf_counter()
+    wall=max(end-profile['start'],1e-9)
+    lines=[name+": wall time %.3f s" % wall]
+    timed=0.0
+    intervals=0
+    for stage in profile['order']:
+        seconds,calls=profile['stages'][stage]
+        if calls==0:
+            continue
+        timed+=seconds
+        intervals+=calls
+        lines.append("  %-12s %10.3f s %6.1f%% %12d calls %10.3f us/call" % (stage,seconds,100*seconds/wall,calls,1e6*seconds/calls))
+    lines.append("  %-12s %10.3f s %6.1f%%" % ('other',max(wall-timed,0),100*max(wall-timed,0)/wall))
+    if cost is not None:
+        lines.append("  (timer overhead included above: about %.3f s)" % (intervals*cost))
+    return lines
+
+
+def write_profiles(profiles,outf=None):
+    '''
+    profiles -- list of (name, profile), i.e. one per thread
+    writes the timing breakdown to outf (stderr if None)
+    '''
+    cost=timer_cost()
+    lines=["profile (stage, seconds, % of wall time, calls, time per call):"]
+    for name,profile in profiles:
+        lines+=profile_lines(name,profile,cost)
+    out=sys.stderr if outf is None else open(outf,'w')
+    out.write('\n'.join(lines)+'\n')
+    if outf is not None:
+        out.close()
+
+
+def profiled_call(profilers,function,*args):
+    '''
+    runs function(*args) under a new cProfile profiler, which is appended to profilers (one profiler per thread)
+    '''
+    import cProfile
+    profiler=cProfile.Profile()
+    profilers.append(profiler)
+    return profiler.runcall(function,*args)
+
+
+def dump_profilers(profilers,dump_file):
+    '''
+    writes the combined statistics of the cProfile profilers to dump_file (read it with pstats or snakeviz)
+    '''
+    import pstats
+    if len(profilers)==0:
+        return
+    stats=pstats.Stats(profilers[0])
+    for profiler in profilers[1:]:
+        stats.add(profiler)
+    stats.dump_stats(dump_file)
+
+
+def profiled_count_read_masks(sam,chunk_size,profile,alignment_counts=None,progress=None):
+    '''
+    instrumented copy of count_read_masks that accumulates the read, parse, classify and reduce stages in profile
+    returns the number of reads with each flagstat mask (see flagmask.initialize_mask_counts)
+    '''
+    from . import initialize_read_masks, update_flagstat_for_readname
+    from .flagmask import mask_table, initialize_mask_counts
+    from .progress import update_progress
+    clock=time.perf_counter
+    read=profile['stages']['read']
+    parse=profile['stages']['parse']
+    classify=profile['stages']['classify']
+    reduce=profile['stages']['reduce']
+    global_mask_counts=initialize_mask_counts()
+    cur_seq_id=None
+    cur_masks=initialize_read_masks()
+    while True:
+        start=clock()
+        cur_lines=sam.readlines(chunk_size)
+        read[0]+=clock()-start
+        read[1]+=1
+        if len(cur_lines)==0:
+            break
+        if progress is not None:
+            update_progress(progress,len(cur_lines),sum(map(len,cur_lines)),global_mask_counts)
+        for line in cur_lines:
+            start=clock()
+            if line[0]==64:
+                continue
+            tokens=line.split(b'\t',7)
+            flag=int(tokens[1])
+            mapq=int(tokens[4])
+            parsed=clock()
+            parse[0]+=parsed-start
+            parse[1]+=1
+            if tokens[0]!=cur_seq_id:
+                update_flagstat_for_readname(global_mask_counts,cur_masks)
+                cur_seq_id=tokens[0]
+                reduced=clock()
+                reduce[0]+=reduced-parsed
+                reduce[1]+=1
+                parsed=reduced
+            index=((flag & 0xfff)<<2) | ((tokens[6]!=b'=')<<1) | (mapq>=5)
+            cur_masks[((flag & 0xc0)>>5) | ((flag & 0x200)>>9)]|=mask_table[index]
+            if alignment_counts is not None:
+                alignment_counts[index]+=1
+            classify[0]+=clock()-parsed
+            classify[1]+=1
+    start=clock()
+    update_flagstat_for_readname(global_mask_counts,cur_masks)
+    add_time(profile,'reduce',clock()-start)
+    return global_mask_counts
@@ -0,0 +1,160 @@
+## Progress and throughput reporting for the counting loops.
+## The loops call update_progress once per chunk with the number of lines and bytes of the chunk, and a report is only formatted when
+## interval seconds have passed since the previous one, so the per-line loops carry no progress code. Reports go to stderr, leaving stdout
+## for the statistics:
+##    alignments, reads, bytes processed, alignments/s, reads/s, MB/s, and the % done and ETA when the input size is known (files on disk)
+## The same numbers can be written in the Prometheus text format (i.e. for the node_exporter textfile collector) to a metrics file, which is
+## rewritten under a temporary name and renamed at every report so a scraper never sees a partial file.
+import os
+import sys
+import time
+
+#default number of seconds between progress reports
+default_progress_interval=10.0
+
+
+def input_size(input_file):
+    '''
+    returns the size of input_file in bytes, or None for stdin and other inputs that are not regular files
+    '''
+    if input_file=="-" or not os.path.isfile(input_file):
+        return None
+    return os.path.getsize(input_file)
+
+
+def initialize_progress(total_bytes=None,interval=default_progress_interval,metrics_file=None,sample=None,out=None):
+    '''
+    total_bytes -- size of the input, used for the % done and the ETA (None if unknown)
+    interval -- seconds between reports, 0 or less to only report at the end
+    metrics_file -- optional file for the Prometheus text format metrics, labelled with sample
+    returns the progress state
+    '''
+    now=time.monotonic()
+    return {'start':now,
+            'next_report':now+interval if interval>0 else float('inf'),
+            'interval':interval,
+            'total_bytes':total_bytes,
+            'alignments':0,
+            'bytes':0,
+            'mask_counts':None,
+            'metrics_file':metrics_file,
+            'sample':sample,
+            'out':sys.stderr if out is None else out}
+
+
+def update_progress(progress,alignments,num_bytes,mask_counts=None):
+    '''
+    adds one chunk of alignments (SAM lines) and bytes to the totals, and reports if the interval has passed
+    mask_counts -- the per-read mask counts of the loop (see flagmask.initialize_mask_counts), only read when reporting to count the reads
+    '''
+    progress['alignments']+=alignments
+    progress['bytes']+=num_bytes
+    if mask_counts is not None:
+        progress['mask_counts']=mask_counts
+    if time.monotonic()>=progress['next_report']:
+        report_progress(progress)
+
+
+def count_reads(progress):
+    '''
+    returns the number of reads counted so far: every read (mate) adds one to one entry of the qc_passed mask counts
+    '''
+    if progress['mask_counts'] is None:
+        return None
+    return sum(progress['mask_counts'][0])
+
+
+def progress_metrics(progress,finished=False):
+    '''
+    returns the current metrics as a dictionary (rates per second, eta in seconds or None)
+    '''
+    elapsed=max(time.monotonic()-progress['start'],1e-9)
+    reads=count_reads(progress)
+    metrics={'alignments':progress['alignments'],
+             'reads':reads,
+             'bytes':progress['bytes'],
+             'elapsed':elapsed,
+             'alignments_per_second':progress['alignments']/elapsed,
+             'reads_per_second':None if reads is None else reads/elapsed,
+             'bytes_per_second':progress['bytes']/elapsed,
+             'fraction_done':1.0 if finished else None,
+             'eta':0.0 if finished else None,
+             'finished':finished}
+    total_bytes=progress['total_bytes']
+    if not finished and total_bytes and progress['bytes']>0:
+        metrics['fraction_done']=min(progress['bytes']/total_bytes,1.0)
+        metrics['eta']=max(total_bytes-progress['bytes'],0)/metrics['bytes_per_second']
+    return metrics
+
+
+def format_progress(metrics):
+    fields=[str(metrics['alignments'])+" alignments"]
+    if metrics['reads'] is not None:
+        fields.append(str(metrics['reads'])+" reads")
+    #the BAM/CRAM readers do not report bytes
+    if metrics['bytes']>0:
+        fields.append("%.1f MB" % (metrics['bytes']/1e6))
+    rates=["%.0f alignments/s" % metrics['alignments_per_second']]
+    if metrics['reads_per_second'] is not None:
+        rates.append("%.0f reads/s" % metrics['reads_per_second'])
+    if metrics['bytes']>0:
+        rates.append("%.1f MB/s" % (metrics['bytes_per_second']/1e6))
+    line=", ".join(fields)+" in %.1f s (" % metrics['elapsed']+", ".join(rates)+")"
+    if metrics['finished']:
+        return "finished: "+line
+    if metrics['fraction_done'] is not None:
+        line+=", %.1f%% done, ETA %.0f s" % (100*metrics['fraction_done'],metrics['eta'])
+    return line
+
+
+def prometheus_lines(metrics,sample=None):
+    '''
+    returns the metrics in the Prometheus text exposition format
+    '''
+    labels='' if sample is None else '{sample="'+sample.replace('\\','\\\\').replace('"','\\"')+'"}'
+    values=[('samstats_alignments_total','counter','Alignments (SAM lines) processed',metrics['alignments']),
+            ('samstats_reads_total','counter','Reads (mates counted separately) processed',metrics['reads']),
+            ('samstats_bytes_total','counter','Input bytes processed',metrics['bytes']),
+            ('samstats_elapsed_seconds','gauge','Seconds since the start of the run',metrics['elapsed']),
+            ('samstats_alignments_per_second','gauge','Average alignments per second',metrics['alignments_per_second']),
+            ('samstats_reads_per_second','gauge','Average reads per second',metrics['reads_per_second']),
+            ('samstats_bytes_per_second','gauge','Average input bytes per second',metrics['bytes_per_second']),
+            ('samstats_fraction_done','gauge','Fraction of the input processed',metrics['fraction_done']),
+            ('samstats_eta_seconds','gauge','Estimated seconds until the end of the input',metrics['eta']),
+            ('samstats_finished','gauge','1 once the whole input is processed',int(metrics['finished']))]
+    lines=[]
+    for name,metric_type,description,value in values:
+        if value is None:
+            continue
+        lines+=['# HELP '+name+' '+description,
+                '# TYPE '+name+' '+metric_type,
+                name+labels+' '+repr(value)]
+    return lines
+
+
+def write_metrics_file(metrics_file,lines):
+    with open(metrics_file+'.tmp','w') as out:
+        out.write('\n'.join(lines)+'\n')
+    os.replace(metrics_file+'.tmp',metrics_file)
+
+
+def report_progress(progress,finished=False):
+    '''
+    writes one progress line to stderr (and the metrics file), and schedules the next report
+    '''
+    metrics=progress_metrics(progress,finished)
+    progress['out'].write(format_progress(metrics)+'\n')
+    progress['out'].flush()
+    if progress['metrics_file'] is not None:
+        write_metrics_file(progress['metrics_file'],prometheus_lines(metrics,progress['sample']))
+    if progress['interval']>0:
+        progress['next_report']=time.monotonic()+progress['interval']
+
+
+def finish_progress(progress,mask_counts=None):
+    '''
+    writes the final report
+    '''
+    if mask_counts is not None:
+        progress['mask_counts']=mask_counts
+    report_progress(progress,True)
@@ -0,0 +1,86 @@
+## Machine-readable versions of the flagstat report: JSON, TSV and (with pyarrow) Parquet.
+## They are generated from the same flagstat arrays as the text report. A report is a list of sections, i.e. per_read, per_alignment and one
+## section per group (see groups.py), and every section has one row per statistic:
+##    stat, qc_passed, qc_failed, percent_qc_passed, percent_qc_failed (percentages only for mapped, properly paired and singletons, NA/null otherwise)
+## The TSV and Parquet outputs have the sample name and the section in every row, so the reports of many samples can be concatenated
+## (i.e. a directory of Parquet files read as one dataset).
+import json
+
+#version of the JSON report layout
+report_version=1
+#the statistics that have a percentage, and the index of the percentages in the (percent_mapped, percent_properly_paired, percent_singletons) tuple
+percent_stats={'mapped':0,'properly paired':1,'singletons':2}
+tsv_columns=['sample','section','stat','qc_passed','qc_failed','percent_qc_passed','percent_qc_failed']
+
+
+def flagstat_rows(stats,flagstat,percents):
+    '''
+    stats -- names of the statistics, in the order of the flagstat arrays
+    flagstat -- [qc_passed, qc_failed] flagstat arrays
+    percents -- (percent_mapped, percent_properly_paired, percent_singletons), each a (qc_passed, qc_failed) pair (see calculate_percent)
+    returns one dictionary per statistic
+    '''
+    rows=[]
+    for i in range(len(stats)):
+        percent=("NA","NA")
+        if stats[i] in percent_stats:
+            percent=percents[percent_stats[stats[i]]]
+        rows.append({'stat':stats[i],
+                     'qc_passed':int(flagstat[0][i]),
+                     'qc_failed':int(flagstat[1][i]),
+                     'percent_qc_passed':percent[0],
+                     'percent_qc_failed':percent[1]})
+    return rows
+
+
+def json_value(value):
+    return None if value=="NA" else value
+
+
+def write_json_report(outf,sample,sections):
+    '''
+    sections -- list of (section name, rows) (see flagstat_rows)
+    writes {"version", "sample", "sections": {section: [rows]}} to the file name outf; NA percentages are null
+    '''
+    report={'version':report_version,
+            'sample':sample,
+            'sections':{section:[{key:json_value(value) for key,value in row.items()} for row in rows] for section,rows in sections}}
+    with open(outf,'w') as out:
+        json.dump(report,out,indent=1)
+        out.write('\n')
+
+
+def write_tsv_report(outf,sample,sections):
+    '''
+    writes one line per section and statistic, with a header line (see tsv_columns)
+    '''
+    lines=['\t'.join(tsv_columns)]
+    for section,rows in sections:
+        for row in rows:
+            lines.append('\t'.join([sample,section]+[str(row[column]) for column in tsv_columns[2:]]))
+    with open(outf,'w') as out:
+        out.write('\n'.join(lines)+'\n')
+
+
+def write_parquet_report(outf,sample,sections):
+    '''
+    writes the rows of the TSV report as a Parquet table (requires pyarrow); NA percentages are null
+    '''
+    #pyarrow is only needed for Parquet output
+    import pyarrow
+    import pyarrow.parquet
+    columns={column:[] for column in tsv_columns}
+    for section,rows in sections:
+        for row in rows:
+            columns['sample'].append(sample)
+            columns['section'].append(section)
+            for column in tsv_columns[2:]:
+                columns[column].append(json_value(row[column]))
+    schema=pyarrow.schema([('sample',pyarrow.string()),
+                           ('section',pyarrow.string()),
+                           ('stat',pyarrow.string()),
+                           ('qc_passed',pyarrow.int64()),
+                           ('qc_failed',pyarrow.int64()),
+                           ('percent_qc_passed',pyarrow.float64()),
+                           ('percent_qc_failed',pyarrow.float64())])
+    pyarrow.parquet.write_table(pyarrow.Table.from_pydict(columns,schema=schema),outf)
@@ -0,0 +1,246 @@
+## Single-pass replacement for SAMstats.sort.stat.filter.sh.
+## The shell script counts every statistic with its own samtools view -f/-F [-q5] | cut -f1 | sort | uniq | wc -l pipeline,
+## i.e. the number of distinct read names with at least one alignment passing the flag filter.
+## Here the same filters are applied to every alignment through a lookup table (one bit per pipeline), the bits are combined with a
+## bitwise or for all alignments of a read name, and each read name is counted once per bit, in a single streaming pass over a name-sorted file.
+## The report reproduces the script output exactly, including its quirks:
+##    the read1 "with mate mapped to a different chr" counts use the read2 filter (-f 0x80), so they repeat the read2 counts
+##    the QC-failed read2 count prints the QC-failed read1 count
+##    the "mapQ>=5" row does not require the 0x1 bit or exclude the 0x8 bit
+##    percentages are formatted like bc -l (20 truncated decimals, no leading zero)
+import sys
+import argparse
+from .flagmask import mask_index
+
+#name, required flag bits (-f), excluded flag bits (-F), MAPQ>=5 required (-q5), RNEXT!="=" required (awk '$7 != "="')
+#one entry per samtools pipeline of SAMstats.sort.stat.filter.sh, in the same order
+pipelines=[('qcPassed_read2',0x80,0x200,False,False),
+           ('qcFailed_read2',0x200|0x80,0,False,False),
+           ('qcPassed_read1',0,0x200|0x80,False,False),
+           ('qcFailed_read1',0x200,0x80,False,False),
+           ('secondary_qcPassed_read2',0x100|0x80,0x200,False,False),
+           ('secondary_qcFailed_read2',0x200|0x100|0x80,0,False,False),
+           ('secondary_qcPassed_read1',0x100,0x200|0x80,False,False),
+           ('secondary_qcFailed_read1',0x200|0x100,0x80,False,False),
+           ('supplementary_qcPassed_read2',0x800|0x80,0x200,False,False),
+           ('supplementary_qcFailed_read2',0x200|0x800|0x80,0,False,False),
+           ('supplementary_qcPassed_read1',0x800,0x200|0x80,False,False),
+           ('supplementary_qcFailed_read1',0x200|0x800,0x80,False,False),
+           ('primary_qcPassed_read2',0x80,0x200|0x800,False,False),
+           ('primary_qcFailed_read2',0x200|0x80,0x800,False,False),
+           ('primary_qcPassed_read1',0,0x200|0x800|0x80,False,False),
+           ('primary_qcFailed_read1',0x200,0x800|0x80,False,False),
+           ('duplicates_qcPassed_read2',0x400|0x80,0x200,False,False),
+           ('duplicates_qcFailed_read2',0x200|0x400|0x80,0,False,False),
+           ('duplicates_qcPassed_read1',0x400,0x200|0x80,False,False),
+           ('duplicates_qcFailed_read1',0x200|0x400,0x80,False,False),
+           ('mapped_qcPassed_read2',0x80,0x200|0x4,False,False),
+           ('mapped_qcFailed_read2',0x200|0x80,0x4,False,False),
+           ('mapped_qcPassed_read1',0,0x200|0x4|0x80,False,False),
+           ('mapped_qcFailed_read1',0x200,0x4|0x80,False,False),
+           ('pairedInSequencing_qcPassed_read2',0x1|0x80,0x200|0x800,False,False),
+           ('pairedInSequencing_qcFailed_read2',0x200|0x1|0x80,0x800,False,False),
+           ('pairedInSequencing_qcPassed_read1',0x1,0x200|0x800|0x80,False,False),
+           ('pairedInSequencing_qcFailed_read1',0x200|0x1,0x800|0x80,False,False),
+           ('read1_qcPassed',0x1|0x40,0x200|0x800,False,False),
+           ('read1_qcFailed',0x200|0x1|0x40,0x800,False,False),
+           ('read2_qcPassed',0x1|0x80,0x200|0x800,False,False),
+           ('read2_qcFailed',0x200|0x1|0x80,0x800,False,False),
+           ('properlyPaired_qcPassed_read2',0x1|0x2|0x80,0x200|0x4|0x800,False,False),
+           ('properlyPaired_qcFailed_read2',0x200|0x1|0x2|0x80,0x4|0x800,False,False),
+           ('properlyPaired_qcPassed_read1',0x1|0x2,0x200|0x4|0x800|0x80,False,False),
+           ('properlyPaired_qcFailed_read1',0x200|0x1|0x2,0x4|0x800|0x80,False,False),
+           ('withItselfAndMateMapped_qcPassed_read2',0x1|0x80,0x200|0x4|0x8|0x800,False,False),
+           ('withItselfAndMateMapped_qcFailed_read2',0x200|0x1|0x80,0x4|0x8|0x800,False,False),
+           ('withItselfAndMateMapped_qcPassed_read1',0x1,0x200|0x4|0x8|0x800|0x80,False,False),
+           ('withItselfAndMateMapped_qcFailed_read1',0x200|0x1,0x4|0x8|0x800|0x80,False,False),
+           ('singletons_qcPassed_read2',0x1|0x8|0x80,0x200|0x4|0x800,False,False),
+           ('singletons_qcFailed_read2',0x200|0x1|0x8|0x80,0x4|0x800,False,False),
+           ('singletons_qcPassed_read1',0x1|0x8,0x200|0x4|0x800|0x80,False,False),
+           ('singletons_qcFailed_read1',0x200|0x1|0x8,0x4|0x800|0x80,False,False),
+           #the script uses -f 0x80 for the read1 pipelines as well
+           ('withMateMappedToDiffChrom_qcPassed_read2',0x1|0x80,0x200|0x4|0x8|0x800,False,True),
+           ('withMateMappedToDiffChrom_qcFailed_read2',0x200|0x1|0x80,0x4|0x8|0x800,False,True),
+           ('withMateMappedToDiffChrom_qcPassed_read1',0x1|0x80,0x200|0x4|0x8|0x800,False,True),
+           ('withMateMappedToDiffChrom_qcFailed_read1',0x200|0x1|0x80,0x4|0x8|0x800,False,True),
+           ('withMateMappedToDiffChromQC5_qcPassed_read2',0x80,0x200|0x4|0x800,True,True),
+           ('withMateMappedToDiffChromQC5_qcFailed_read2',0x200|0x80,0x4|0x800,True,True),
+           ('withMateMappedToDiffChromQC5_qcPassed_read1',0,0x200|0x4|0x800|0x80,True,True),
+           ('withMateMappedToDiffChromQC5_qcFailed_read1',0x200,0x4|0x800|0x80,True,True)]
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Compute the statistics of SAMstats.sort.stat.filter.sh in a single pass over a SAM/BAM/CRAM file sorted by read name")
+    parser.add_argument("--sorted_sam_file",help="Input SAM/BAM/CRAM file. Use '-' if input is being piped from stdin. File must be sorted by read name.",required=True)
+    parser.add_argument("--outf",default=None,help="Output file name to store the statistics. The statistics will be printed to stdout if no file is provided")
+    parser.add_argument("--chunk_size",type=int,default=100000,help="Number of lines (number of compressed bytes for BAM input) to read at a time")
+    parser.add_argument("--input_format",choices=["auto","sam","bam","cram"],default="auto",help="Format of sorted_sam_file. auto: bam/cram based on the file extension, sam otherwise (including stdin)")
+    parser.add_argument("--reference",default=None,help="Reference FASTA file for CRAM input")
+    return parser.parse_args()
+
+
+def build_pipeline_table():
+    '''
+    returns a list with one bitmask of the pipelines that keep an alignment for every (FLAG, RNEXT!="=", MAPQ>=5) combination,
+    addressed with flagmask.mask_index; bit i is set when the alignment passes the filters of pipelines[i]
+    '''
+    pipeline_table=[]
+    for flag in range(4096):
+        for rnext_differs in (False,True):
+            for mapq_ge5 in (False,True):
+                mask=0
+                for i in range(len(pipelines)):
+                    name,required,excluded,q5,rnext_filter=pipelines[i]
+                    if flag & required!=required or flag & excluded:
+                        continue
+                    if q5 and not mapq_ge5:
+                        continue
+                    if rnext_filter and not rnext_differs:
+                        continue
+                    mask|=1<<i
+                pipeline_table.append(mask)
+    return pipeline_table
+
+
+pipeline_table=build_pipeline_table()
+
+
+def iter_sam_alignments(sam,chunk_size):
+    '''
+    sam -- text file handle for a SAM file
+    chunk_size -- number of lines to read at a time from sam
+    yields (QNAME, FLAG, MAPQ, RNEXT) for every alignment, with RNEXT set to "=" when it matches RNAME, as samtools view prints it
+    '''
+    while True:
+        cur_lines=sam.readlines(chunk_size)
+        if len(cur_lines)==0:
+            break
+        for line in cur_lines:
+            if line.startswith('@'):
+                #this is a comment, we skip
+                continue
+            tokens=line.split('\t',7)
+            rnext=tokens[6]
+            if rnext==tokens[2] and rnext!='*':
+                rnext='='
+            yield tokens[0],int(tokens[1]),int(tokens[4]),rnext
+
+
+def count_pipelines(alignments):
+    '''
+    alignments -- iterator of (QNAME, FLAG, MAPQ, RNEXT) tuples for a file sorted by read name
+    returns a dictionary of pipeline name -> number of distinct read names with an alignment kept by the pipeline
+    '''
+    #number of read names with each combination of pipeline bits; there are few distinct combinations, so they are expanded at the end
+    mask_counts=dict()
+    cur_seq_id=None
+    cur_mask=0
+    for qname,flag,mapq,rnext in alignments:
+        if qname!=cur_seq_id:
+            if cur_mask:
+                mask_counts[cur_mask]=mask_counts.get(cur_mask,0)+1
+            cur_seq_id=qname
+            cur_mask=0
+        cur_mask|=pipeline_table[mask_index(flag,mapq,rnext)]
+    if cur_mask:
+        mask_counts[cur_mask]=mask_counts.get(cur_mask,0)+1
+    counts=dict()
+    for i in range(len(pipelines)):
+        counts[pipelines[i][0]]=sum([count for mask,count in mask_counts.items() if mask>>i & 1])
+    return counts
+
+
+def bc_percent(numerator,denominator):
+    '''
+    formats 100*numerator/denominator like `echo 100*numerator/denominator | bc -l`
+    '''
+    if denominator==0:
+        #bc prints a divide by zero error to stderr and nothing to stdout
+        return ""
+    value=100*numerator
+    integer_part=value//denominator
+    if value==0:
+        return "0"
+    fraction=str((value % denominator)*10**20//denominator).zfill(20)
+    if integer_part==0:
+        return "."+fraction
+    return str(integer_part)+"."+fraction
+
+
+def write_report(outf,counts):
+    '''
+    writes the statistics in the format of SAMstats.sort.stat.filter.sh
+    '''
+    totals=dict()
+    for stat in ['qcPassed','qcFailed']:
+        totals[stat]=counts[stat+'_read2']+counts[stat+'_read1']
+    for stat in ['secondary','supplementary','primary','duplicates','mapped','pairedInSequencing','properlyPaired',
+                 'withItselfAndMateMapped','singletons','withMateMappedToDiffChrom','withMateMappedToDiffChromQC5']:
+        for qc in ['qcPassed','qcFailed']:
+            totals[stat+'_'+qc]=counts[stat+'_'+qc+'_read2']+counts[stat+'_'+qc+'_read1']
+    percent=dict()
+    for qc in ['qcPassed','qcFailed']:
+        if totals[qc]==0:
+            for stat in ['mapped','properlyPaired','singletons']:
+                percent[stat+'_'+qc]="NaN"
+        else:
+            percent['mapped_'+qc]=bc_percent(totals['mapped_'+qc],totals[qc])
+            percent['properlyPaired_'+qc]=bc_percent(totals['properlyPaired_'+qc],totals['primary_'+qc])
+            percent['singletons_'+qc]=bc_percent(totals['singletons_'+qc],totals['primary_'+qc])
+    lines=[str(totals['qcPassed'])+" + "+str(totals['qcFailed'])+" in total (QC-passed reads + QC-failed reads)",
+           str(totals['secondary_qcPassed'])+" + "+str(totals['secondary_qcFailed'])+" secondary",
+           str(totals['supplementary_qcPassed'])+" + "+str(totals['supplementary_qcFailed'])+" supplementary",
+           str(totals['duplicates_qcPassed'])+" + "+str(totals['duplicates_qcFailed'])+" duplicates",
+           str(totals['mapped_qcPassed'])+" + "+str(totals['mapped_qcFailed'])+" mapped ("+percent['mapped_qcPassed']+" % : "+percent['mapped_qcFailed']+" % )",
+           str(totals['pairedInSequencing_qcPassed'])+" + "+str(totals['pairedInSequencing_qcFailed'])+" paired in sequencing",
+           str(counts['read1_qcPassed'])+" + "+str(counts['read1_qcFailed'])+" read1",
+           #the script prints the QC-failed read1 count on the read2 line
+           str(counts['read2_qcPassed'])+" + "+str(counts['read1_qcFailed'])+" read2",
+           str(totals['properlyPaired_qcPassed'])+" + "+str(totals['properlyPaired_qcFailed'])+" properly paired ("+percent['properlyPaired_qcPassed']+" % : "+percent['properlyPaired_qcFailed']+" % )",
+           str(totals['withItselfAndMateMapped_qcPassed'])+" + "+str(totals['withItselfAndMateMapped_qcFailed'])+" with itself and mate mapped",
+           str(totals['singletons_qcPassed'])+" + "+str(totals['singletons_qcFailed'])+" singletons ( "+percent['singletons_qcPassed']+" % : "+percent['singletons_qcFailed']+" % )",
+           str(totals['withMateMappedToDiffChrom_qcPassed'])+" + "+str(totals['withMateMappedToDiffChrom_qcFailed'])+" with mate mapped to a different chr",
+           str(totals['withMateMappedToDiffChromQC5_qcPassed'])+" + "+str(totals['withMateMappedToDiffChromQC5_qcFailed'])+" with mate mapped to a different chr (mapQ>=5)"]
+    if outf==None:
+        for line in lines:
+            print(line)
+    else:
+        outf=open(outf,'w')
+        for line in lines:
+            outf.write(line+'\n')
+        outf.close()
+
+
+def sort_stat_filter(sorted_sam_file,outf=None,input_format="auto",reference=None,chunk_size=100000):
+    '''
+    computes the statistics of SAMstats.sort.stat.filter.sh for a SAM/BAM/CRAM file sorted by read name and writes them to outf (stdout if None)
+    returns the dictionary of pipeline name -> count (see count_pipelines)
+    '''
+    from . import get_input_format
+    input_format=get_input_format(sorted_sam_file,input_format)
+    if input_format=="bam":
+        from .bam import iter_bam_alignments
+        if sorted_sam_file=="-":
+            bam=sys.stdin.buffer
+        else:
+            bam=open(sorted_sam_file,'rb')
+        alignments=iter_bam_alignments(bam,chunk_size)
+    elif input_format=="cram":
+        from .bam import iter_cram_alignments
+        alignments=iter_cram_alignments(sorted_sam_file,reference)
+    else:
+        from . import open_input
+        sam=open_input(sorted_sam_file,False,decompress=True)
+        alignments=iter_sam_alignments(sam,chunk_size)
+    counts=count_pipelines(alignments)
+    write_report(outf,counts)
+    return counts
+
+
+def main():
+    args=parse_args()
+    sort_stat_filter(args.sorted_sam_file,args.outf,args.input_format,args.reference,args.chunk_size)
+
+
+if __name__=="__main__":
+    main()
@@ -2,9 +2,16 @@
 ## (i.e. reads with multiple alignments are counted once)
 
 import sys 
+import time 
 import argparse 
 import multiprocess as mp
 import threading
+from SAMstats import get_input_format
+from SAMstats.bam import iter_bam_alignments, iter_cram_alignments
+from SAMstats.flagmask import mask_table, mask_index, mask_counts_to_flagstat
+from SAMstats.profiling import initialize_profile, add_time, finish_profile, write_profiles, profiled_call, dump_profilers
+from .bam_blocks import parallel_bam_flagstat
+from .sam_ranges import parallel_sam_flagstat
 #from multiprocessing.pool import ThreadPool
 
 #13 stats that flagstats reports
@@ -26,11 +33,25 @@ stats=['total',
 
 def parse_args(): 
     parser=argparse.ArgumentParser(description="Compute SAM file mapping statistics for a SAM file sorted by read name")
-    parser.add_argument("--sorted_sam_file",help="Input SAM file. Use '-' if input is being piped from stdin. File must be sorted by read name.",required=True)
+    parser.add_argument("--sorted_sam_file",help="Input SAM/BAM/CRAM file. Use '-' if input is being piped from stdin. File must be sorted by read name.",required=True)
     parser.add_argument("--outf",default=None,help="Output file name to store alignment statistics. The statistics will be printed to stdout if no file is provided") 
     parser.add_argument("--chunk_size",type=int,default=100000,help="Number of lines to read a time from sortedSamFile")
     parser.add_argument("--threads",type=int,default=1,help="number of threads to use. Note: the default is ")
-    return parser.parse_args()
+    parser.add_argument("--batch_size",type=int,default=10000,help="Number of read groups sent to a worker thread at a time")
+    parser.add_argument("--max_queued_batches",type=int,default=None,help="Maximum number of batches waiting for a worker thread; the reader blocks when the queue is full (default: 2 x threads)")
+    parser.add_argument("--input_format",choices=["auto","sam","bam","cram"],default="auto",help="Format of sorted_sam_file. auto: bam/cram based on the file extension, sam otherwise (including stdin)")
+    parser.add_argument("--reference",default=None,help="FASTA reference for CRAM input (requires pysam)")
+    parser.add_argument("--engine",choices=["threads","processes"],default="threads",help="threads: worker threads fed with read groups by a single reader; processes: split a BAM file at BGZF block boundaries, or a SAM file at read name boundaries, and process each part in a separate process (--threads sets the number of processes)")
+    parser.add_argument("--profile",action="store_true",default=False,help="Time the reader, worker and aggregator threads (read/parse, classify, reduce, output and queue wait; see SAMstats/profiling.py) and write the breakdown to stderr")
+    parser.add_argument("--profile_outf",default=None,help="With --profile, write the timing breakdown to this file instead of stderr")
+    parser.add_argument("--profile_dump",default=None,help="Also run cProfile in every thread and write the combined pstats file to this file")
+    args=parser.parse_args()
+    args.input_format=get_input_format(args.sorted_sam_file,args.input_format)
+    if args.max_queued_batches is None: 
+        args.max_queued_batches=2*args.threads
+    if args.engine=="processes" and (args.input_format not in ("sam","bam") or args.sorted_sam_file=="-"):
+        parser.error("--engine processes requires a SAM or BAM file on disk")
+    return args
 
 
 
@@ -91,35 +112,9 @@ def add_read_stats(flag,mapq,rnext,cur_flagstat):
     '''
     implements flagstat logic from http://www.htslib.org/doc/samtools.html to calculate each of the 13 flags
     also keep track of number of primary reads for calculating fraction of mapped reads in the global summary stats 
+    the per-alignment logic is precomputed in SAMstats.flagmask.mask_table, so cur_flagstat is a [qc_passed, qc_failed] pair of 14-bit masks 
     '''
-    temp_flagstat=[]
-    qc_passed=flag & 0x200 == 0
-    temp_flagstat.append(qc_passed) #qc_passed
-    temp_flagstat.append(flag & 0x100 == 0x100) #secondary 
-    temp_flagstat.append(flag & 0x800 == 0x800) #supplementary 
-    temp_flagstat.append(flag & 0x400 == 0x400) #duplicates
-    temp_flagstat.append(flag & 0x4 == 0) #mapped
-
-    #note: it is not stated in the samtools documentation, but the paired read statistics are *only* computed for primary reads, so we add a check that primary==1 for all remaining stats
-    primary= flag & 0x800 ==0  #primary
-    paired_in_sequencing= (flag & 0x1 == 0x1) & (primary==1)
-    temp_flagstat.append(paired_in_sequencing) #paired_in_sequencing 
-    temp_flagstat.append(paired_in_sequencing & (flag & 0x40 == 0x40)) #read1
-    temp_flagstat.append(paired_in_sequencing & (flag & 0x80 == 0x80)) #read2
-    temp_flagstat.append(paired_in_sequencing & (flag & 0x2==0x2) & (flag & 0x4==0)) #properly aligned 
-    with_itself_and_mate_mapped=(paired_in_sequencing & (flag & 0x4==0) & (flag & 0x8==0)) #with_itself_and_mate_mapped
-    temp_flagstat.append(with_itself_and_mate_mapped)
-    temp_flagstat.append(paired_in_sequencing & (flag & 0x8==0x8) & (flag & 0x4==0)) #singleton
-    with_mate_mapped_to_different_chrom=(with_itself_and_mate_mapped & (rnext !="="))
-    temp_flagstat.append(with_mate_mapped_to_different_chrom) #with_mate_mapped_to_different_chrom
-    temp_flagstat.append(with_mate_mapped_to_different_chrom & (mapq>=5)) #with_mate_mapped_to_different_chrom_q5
-    temp_flagstat.append(primary)
-    #compute bitwise or of cur_flagstat and temp_flagstat to see if a flag is set for any of the alignments for the given read 
-    #the first entry in cur_flagstat is the numpy array with stats for reads that pass qc; the second entry is the numpy array with stats for reads that fail qc 
-    if qc_passed==True:
-        cur_flagstat[0]=[i|j for i,j in zip(cur_flagstat[0],temp_flagstat)]
-    else:
-        cur_flagstat[1]=[i|j for i,j in zip(cur_flagstat[1],temp_flagstat)]
+    cur_flagstat[(flag & 0x200)>>9]|=mask_table[mask_index(flag,mapq,rnext)]
     return cur_flagstat
 
 
@@ -147,84 +142,96 @@ def update_flagstat_for_readname(global_flagstat, cur_flagstat):
     return global_flagstat
 
 
-def read_group_stats(input_q,output_q,i):
+def read_group_stats(input_q,output_q,i,profile=None):
     '''
-    pulls a read group from input_q with same seq_id, calculates flagstat for reads in the group, 
-    flagstat statistics are added to output_q
+    pulls a batch of read groups from input_q (each group holds the alignments with the same seq_id and segment), calculates flagstat for reads in the batch, 
+    the flagstat statistics summed over the batch are added to output_q
+    an exception is added to output_q instead (see aggregate_read_groups), and the remaining batches are discarded so that the reader never blocks on input_q 
+    profile -- optional profile (see SAMstats.profiling.initialize_profile), the time blocked on input_q and the time spent on each batch are added to it 
     '''
     print(i)
-    while True:
-        seqs=input_q.get()
-        if seqs is None:
-            return 
-        else:            
-            cur_flagstat=initialize_flagstat(stats)
-            for seq in seqs:
-                flag=seq[0]
-                mapq=seq[1]
-                rnext=seq[2]
-                cur_flagstat=add_read_stats(flag,mapq,rnext,cur_flagstat)
-            output_q.put(cur_flagstat)
+    try:
+        while True:
+            start=time.perf_counter()
+            batch=input_q.get()
+            if profile is not None: 
+                add_time(profile,'queue_wait',time.perf_counter()-start)
+                start=time.perf_counter()
+            if batch is None:
+                return 
+            else:            
+                #count the reads in the batch per flagstat mask, and only expand the masks that were seen 
+                batch_mask_counts=[dict(),dict()]
+                for seqs in batch:
+                    cur_flagstat=[0,0]
+                    for flag,mapq,rnext in seqs:
+                        cur_flagstat=add_read_stats(flag,mapq,rnext,cur_flagstat)
+                    for qc in range(2):
+                        batch_mask_counts[qc][cur_flagstat[qc]]=batch_mask_counts[qc].get(cur_flagstat[qc],0)+1
+                output_q.put(mask_counts_to_flagstat(batch_mask_counts))
+                if profile is not None: 
+                    add_time(profile,'classify',time.perf_counter()-start)
+    except Exception as e:
+        output_q.put(e)
+        while input_q.get() is not None:
+            pass
 
 
-def aggregate_read_groups(output_q,outf):
+def summarize_flagstat(outf,global_flagstat): 
+    '''
+    calculates the percentages and writes the output file for the final global_flagstat 
+    '''
+    #calculate % mapped, properly paired, singletons from total primary reads 
+    #note: 4, 8, 10 are the numpy array indices in global_flagstat where the counts for these fields are stored 
+    print("finished parsing lines, summarizing...") 
+    percent_mapped=calculate_percent(4,global_flagstat)
+    percent_properly_paired=calculate_percent(8,global_flagstat) 
+    percent_singletons=calculate_percent(10,global_flagstat) 
+
+    #write the output file 
+    write_output_file(outf,
+                      stats,
+                      global_flagstat,
+                      percent_mapped,
+                      percent_properly_paired,
+                      percent_singletons)
+
+
+def aggregate_read_groups(output_q,outf,errors,profile=None):
     '''
     aggregates flag stats for unique reads to a single list 
     writes output file 
+    errors -- list the exceptions found in output_q are added to; no output file is written if there are any 
+    profile -- optional profile, the time blocked on output_q, the reduction and the output are added to it 
     '''
     global_flagstat=initialize_flagstat(stats)
     while True:
+        start=time.perf_counter()
         cur_flagstat=output_q.get()
-        if cur_flagstat is None:                
-            #calculate % mapped, properly paired, singletons from total primary reads 
-            #note: 4, 8, 10 are the numpy array indices in global_flagstat where the counts for these fields are stored 
-            print("finished parsing lines, summarizing...") 
-            percent_mapped=calculate_percent(4,global_flagstat)
-            percent_properly_paired=calculate_percent(8,global_flagstat) 
-            percent_singletons=calculate_percent(10,global_flagstat) 
-    
-            #write the output file 
-            write_output_file(outf,
-                              stats,
-                              global_flagstat,
-                              percent_mapped,
-                              percent_properly_paired,
-                              percent_singletons)
+        if profile is not None: 
+            add_time(profile,'queue_wait',time.perf_counter()-start)
+            start=time.perf_counter()
+        if isinstance(cur_flagstat,Exception):
+            #a worker (or the reader) failed, the statistics are incomplete 
+            errors.append(cur_flagstat)
+        elif cur_flagstat is None:                
+            if len(errors)>0:
+                return 
+            summarize_flagstat(outf,global_flagstat)
+            if profile is not None: 
+                add_time(profile,'output',time.perf_counter()-start)
             return 
         else:
             #we are finished processing the readname "cur_ID", updated the global flag statistics for full dataset with statistics for this read 
             global_flagstat=update_flagstat_for_readname(global_flagstat,cur_flagstat) 
+            if profile is not None: 
+                add_time(profile,'reduce',time.perf_counter()-start)
 
 
-def main(): 
-    #read in the arguments 
-    args=parse_args() 
-    outf=args.outf
-    if args.sorted_sam_file=="-":
-        sam=sys.stdin
-    else:
-        sam=open(args.sorted_sam_file,'r') 
-    
-    #create the input/output queues for multi-threading
-    input_q=mp.Queue()
-    output_q=mp.Queue() 
-
-    #initialize the worker threads that calculate flagstat statistics for each read group (i.e. alignments with the same readname + sequence)
-    workers=[]
-    for i in range(args.threads):
-        worker=threading.Thread(target=read_group_stats,args=(input_q, output_q,i))
-        worker.start() 
-        workers.append(worker)
-        
-    #start the aggregator -- sums flagstat statistics for unique read groups 
-    aggregator=threading.Thread(target=aggregate_read_groups,args=(output_q,args.outf))
-    aggregator.start() 
-    
-    #since sorted_sam_file is sorted with SO=queryname, we keep track of statistics for a given read name and merge with the larger dict when no further reads 
-    #with that name are encountered
-    cur_seq_id=None
-    cur_seq_tokens=dict() 
-    
+def iter_sam_alignments(sam,chunk_size): 
+    '''
+    yields (QNAME, FLAG, MAPQ, RNEXT) for every alignment line of the text SAM file handle sam 
+    '''
     #we read the input SAM file in chunks of size chunksize, iterating one line at a time 
     #skip comment lines in the header that start with @ 
     # use columns : 
@@ -233,17 +240,16 @@ def main():
     #    4 = MAPQ, 
     #    6 = RNEXT (reference name of the mate/next read) 
     # ignore all other columns 
-    print("starting flag calculation...") 
     line_number=0
     while True:
         #read in a user-specified batch size of reads at a time 
-        cur_lines=sam.readlines(args.chunk_size)
+        cur_lines=sam.readlines(chunk_size)
         if len(cur_lines)==0:
             #we're at the end of the file 
             break        
         for line in cur_lines:
             #update the log indicating how many lines have been processed 
-            if line_number % args.chunk_size==0:
+            if line_number % chunk_size==0:
                 print(line_number)
             line_number+=1
 
@@ -253,39 +259,163 @@ def main():
             
             #get the fields of interest from the current read
             tokens=line.split()
-            flag=int(tokens[1]) 
-            mapq=int(tokens[4])
-            rnext=tokens[6]
-            new_seq_id=tokens[0] 
-            read2=str(flag & 0x80==0x80) #check to see if this is the 2nd read in a pair, append 0/1 to the QNAME to
-            #generate unique name for read1 & read2 
-            new_seq_id_expanded=tokens[0]+read2    
+            yield tokens[0],int(tokens[1]),int(tokens[4]),tokens[6]
+
+
+def thread_target(function,profilers): 
+    '''
+    returns function, run under its own cProfile profiler if profilers is not None (see SAMstats.profiling.profiled_call) 
+    '''
+    if profilers is None: 
+        return function
+    return lambda *args: profiled_call(profilers,function,*args)
+
+
+def main(): 
+    #read in the arguments 
+    args=parse_args() 
+    #one cProfile profiler per thread with --profile_dump 
+    profilers=None
+    if args.profile_dump is not None: 
+        profilers=[]
+    profiles=None
+    if args.profile: 
+        profiles=[]
+    thread_target(run,profilers)(args,profilers,profiles) 
+    if profiles is not None: 
+        write_profiles([(name,finish_profile(profile)) for name,profile in profiles],args.profile_outf) 
+    if profilers is not None: 
+        dump_profilers(profilers,args.profile_dump) 
+
+
+def run(args,profilers=None,profiles=None): 
+    '''
+    computes and writes the statistics for the parsed arguments of main 
+    profilers -- list the cProfile profilers of the worker and aggregator threads are added to (None to not run cProfile) 
+    profiles -- list the (name, stage profile) of every thread are added to (None to not time the stages) 
+    '''
+    outf=args.outf
+    if args.engine=="processes": 
+        print("starting flag calculation...") 
+        start=time.perf_counter()
+        if args.input_format=="bam": 
+            global_flagstat=parallel_bam_flagstat(args.sorted_sam_file,args.threads,args.chunk_size)
+        else: 
+            global_flagstat=parallel_sam_flagstat(args.sorted_sam_file,args.threads,args.chunk_size)
+        count_end=time.perf_counter()
+        summarize_flagstat(outf,global_flagstat)
+        if profiles is not None: 
+            #the worker processes are timed as a whole 
+            profile=initialize_profile([])
+            profile['start']=start
+            add_time(profile,'count',count_end-start)
+            add_time(profile,'output',time.perf_counter()-count_end)
+            profiles.append(('main',profile))
+        return 
+    reader_profile=None
+    if profiles is not None: 
+        reader_profile=initialize_profile([])
+        profiles.append(('reader',reader_profile))
+    if args.input_format=="bam": 
+        if args.sorted_sam_file=="-":
+            bam=sys.stdin.buffer
+        else:
+            bam=open(args.sorted_sam_file,'rb') 
+        alignments=iter_bam_alignments(bam,args.chunk_size)
+    elif args.input_format=="cram": 
+        alignments=iter_cram_alignments(args.sorted_sam_file,args.reference)
+    else: 
+        if args.sorted_sam_file=="-":
+            sam=sys.stdin
+        else:
+            sam=open(args.sorted_sam_file,'r') 
+        alignments=iter_sam_alignments(sam,args.chunk_size)
+    
+    #create the input/output queues for multi-threading
+    #read groups are sent to the workers in batches of batch_size groups, and the input queue is bounded so that the reader blocks 
+    #(rather than buffering the file in memory) when it gets ahead of the workers 
+    input_q=mp.Queue(maxsize=args.max_queued_batches)
+    output_q=mp.Queue() 
+
+    #initialize the worker threads that calculate flagstat statistics for each read group (i.e. alignments with the same readname + sequence)
+    workers=[]
+    for i in range(args.threads):
+        worker_profile=None
+        if profiles is not None: 
+            worker_profile=initialize_profile([])
+            profiles.append(('worker '+str(i),worker_profile))
+        worker=threading.Thread(target=thread_target(read_group_stats,profilers),args=(input_q, output_q,i,worker_profile))
+        worker.start() 
+        workers.append(worker)
+        
+    #start the aggregator -- sums flagstat statistics for unique read groups 
+    errors=[]
+    aggregator_profile=None
+    if profiles is not None: 
+        aggregator_profile=initialize_profile([])
+        profiles.append(('aggregator',aggregator_profile))
+    aggregator=threading.Thread(target=thread_target(aggregate_read_groups,profilers),args=(output_q,args.outf,errors,aggregator_profile))
+    aggregator.start() 
+    
+    #since sorted_sam_file is sorted with SO=queryname, we keep track of statistics for a given read name and merge with the larger dict when no further reads 
+    #with that name are encountered
+    cur_seq_id=None
+    #alignments of the current read name per segment (unpaired, read1, read2, middle; FLAG & 0xc0, see SAMstats.flagmask.read_slot) 
+    cur_seq_tokens=[None,None,None,None] 
+    batch=[]
+    
+    print("starting flag calculation...") 
+    #the workers and the aggregator are always stopped, even if reading the input fails 
+    try:
+        for new_seq_id,flag,mapq,rnext in alignments:
             if new_seq_id!=cur_seq_id:
-                #We have seen all the reads with a given name, we now process the flags for that read group, separating by read pair (each read in pair is key) 
-                for key in cur_seq_tokens: 
-                    input_q.put(cur_seq_tokens[key])
+                #We have seen all the reads with a given name, we now process the flags for that read group, one group per segment that has alignments 
+                batch.extend([seqs for seqs in cur_seq_tokens if seqs is not None])
+                if len(batch)>=args.batch_size: 
+                    if reader_profile is not None: 
+                        start=time.perf_counter()
+                        input_q.put(batch)
+                        add_time(reader_profile,'queue_wait',time.perf_counter()-start)
+                    else: 
+                        input_q.put(batch)
+                    batch=[]
                 #reinitialize token list for the new seq_id 
-                cur_seq_tokens=dict() 
-            if new_seq_id_expanded not in cur_seq_tokens:
-                cur_seq_tokens[new_seq_id_expanded]=[[flag,mapq,rnext]]
+                cur_seq_tokens=[None,None,None,None] 
+            #the segment bits select the read: single-end and paired-end alignments that share a QNAME are separate reads 
+            segment=(flag & 0xc0)>>6
+            if cur_seq_tokens[segment] is None:
+                cur_seq_tokens[segment]=[(flag,mapq,rnext)]
             else:
-                cur_seq_tokens[new_seq_id_expanded].append([flag,mapq,rnext])
+                cur_seq_tokens[segment].append((flag,mapq,rnext))
             #update cur_seq_id to reflect the new_seq_id we have observed 
             cur_seq_id=new_seq_id
-            
-    #don't forget to process the final read group!
-    for key in cur_seq_tokens:
-        input_q.put(cur_seq_tokens[key])
-    
-    # When the worker sees None in the queue, it knows to terminate
-    for i in range(args.threads): 
-        input_q.put(None)
         
-    #we are finished, join the worker and aggregator processes
-    for worker in workers: 
-        worker.join()
-    output_q.put(None) 
-    aggregator.join()
+        #don't forget to process the final read group and the last partial batch!
+        batch.extend([seqs for seqs in cur_seq_tokens if seqs is not None])
+        if len(batch)>0: 
+            input_q.put(batch)
+    except BaseException as e:
+        #the aggregator does not write a report for incomplete statistics 
+        output_q.put(e)
+        raise
+    finally:
+        # When the worker sees None in the queue, it knows to terminate
+        for i in range(args.threads): 
+            input_q.put(None)
+        if reader_profile is not None: 
+            #the reader time that is not spent waiting on the queue goes to reading, parsing and grouping the alignments 
+            reader_end=time.perf_counter()
+            add_time(reader_profile,'read+parse',reader_end-reader_profile['start']-reader_profile['stages'].get('queue_wait',[0.0])[0])
+            reader_profile['end']=reader_end
+
+        #we are finished, join the worker and aggregator processes
+        for worker in workers: 
+            worker.join()
+        output_q.put(None) 
+        aggregator.join()
+    if len(errors)>0: 
+        #a worker failed, its exception is raised in the main thread 
+        raise errors[0]
 
 
 if __name__=="__main__": 
@@ -0,0 +1,317 @@
+## Process-parallel flagstat calculation for a BAM file sorted by read name.
+## The compressed file is split at BGZF block boundaries into byte ranges, and each range is handled by a separate worker process:
+##  * the worker inflates its blocks and re-aligns to the first BAM record that starts in its first block,
+##  * it computes the flagstat masks for every read name it sees completely, and sums them into a partial 2x14 flagstat array,
+##  * the first and last read names of the range may continue in the neighbouring ranges, so their masks are returned separately
+##    and merged by the parent process.
+## The parent checks that each worker started exactly where the previous worker stopped; if the record re-alignment guessed
+## wrong, the range is recomputed from the exact position, so the output is always identical to SAMstats.
+import os
+import struct
+import multiprocess as mp
+from SAMstats.bgzf import gzip_header, block_size_from_header, read_block, decompress_block
+from SAMstats import initialize_read_masks, update_flagstat_for_readname
+from SAMstats.flagmask import mask_table, num_read_slots, initialize_mask_counts, mask_counts_to_flagstat
+
+#block_size, refID, pos, l_read_name, mapq, bin, n_cigar_op, flag, l_seq, next_refID, next_pos, tlen
+bam_record_core=struct.Struct('<iiiBBHHHiiii')
+#BGZF magic: ID1, ID2, CM and FLG with FEXTRA set
+bgzf_magic=b'\x1f\x8b\x08\x04'
+#characters allowed in a QNAME by the SAM specification
+qname_characters=bytes(c for c in range(0x21,0x7f) if c!=0x40)
+#number of consecutive plausible records required when re-aligning to a record boundary
+resync_chain=4
+#number of decompressed bytes to inspect when re-aligning to a record boundary
+resync_window=1<<18
+
+
+def find_block_start(f,offset,file_size):
+    '''
+    returns the compressed offset of the first BGZF block that starts at or after offset, or None if there is none
+    a candidate is accepted when its header is valid and the next block (or the end of the file) follows it
+    '''
+    window=1<<17
+    while offset<file_size:
+        f.seek(offset)
+        data=f.read(window+gzip_header.size+256)
+        pos=data.find(bgzf_magic)
+        while pos!=-1 and pos<window:
+            candidate=offset+pos
+            try:
+                f.seek(candidate)
+                header=f.read(gzip_header.size)
+                extra=f.read(gzip_header.unpack(header)[-1])
+                block_size=block_size_from_header(header,extra)
+            except (ValueError,struct.error):
+                block_size=None
+            if block_size is not None:
+                next_block=candidate+block_size
+                if next_block==file_size:
+                    return candidate
+                f.seek(next_block)
+                if f.read(4)==bgzf_magic:
+                    return candidate
+            pos=data.find(bgzf_magic,pos+1)
+        offset+=window
+    return None
+
+
+def read_header_length(bam_file):
+    '''
+    returns (number of decompressed bytes in the BAM header, number of reference sequences)
+    '''
+    f=open(bam_file,'rb')
+    buf=b''
+    def ensure(size):
+        data=buf
+        while len(data)<size:
+            block=read_block(f)
+            if block is None:
+                raise ValueError("truncated BAM header")
+            data+=decompress_block(block)
+        return data
+    buf=ensure(8)
+    if buf[:4]!=b'BAM\1':
+        raise ValueError("input is not a BAM file")
+    l_text=struct.unpack_from('<i',buf,4)[0]
+    buf=ensure(12+l_text)
+    n_ref=struct.unpack_from('<i',buf,8+l_text)[0]
+    offset=12+l_text
+    for i in range(n_ref):
+        buf=ensure(offset+4)
+        l_name=struct.unpack_from('<i',buf,offset)[0]
+        offset+=l_name+8
+    f.close()
+    return offset,n_ref
+
+
+def record_is_plausible(buf,pos,n_ref):
+    '''
+    checks whether a BAM record could start at buf[pos], using the constraints between its fixed-length fields
+    returns the record length (block_size+4), or 0 if it cannot be a record
+    '''
+    if pos+bam_record_core.size>len(buf):
+        return 0
+    block_size,ref_id,ref_pos,l_read_name,mapq,bin_mq,n_cigar,flag,l_seq,next_ref_id,next_pos,tlen=bam_record_core.unpack_from(buf,pos)
+    if not (-1<=ref_id<n_ref and -1<=next_ref_id<n_ref):
+        return 0
+    if ref_pos<-1 or next_pos<-1 or l_read_name<2 or l_seq<0:
+        return 0
+    if block_size<32+l_read_name+4*n_cigar+(l_seq+1)//2+l_seq:
+        return 0
+    name_end=pos+bam_record_core.size+l_read_name
+    if name_end>len(buf) or buf[name_end-1]!=0:
+        return 0
+    if len(buf[pos+bam_record_core.size:name_end-1].translate(None,qname_characters))>0:
+        return 0
+    return block_size+4
+
+
+def find_first_record(buf,n_ref):
+    '''
+    returns the offset of the first position in buf where resync_chain consecutive plausible records start, or None
+    '''
+    for pos in range(len(buf)-bam_record_core.size):
+        length=record_is_plausible(buf,pos,n_ref)
+        if length==0:
+            continue
+        next_pos=pos+length
+        chain=1
+        while chain<resync_chain and next_pos+bam_record_core.size<=len(buf):
+            length=record_is_plausible(buf,next_pos,n_ref)
+            if length==0:
+                break
+            next_pos+=length
+            chain+=1
+        else:
+            return pos
+    return None
+
+
+def add_group_masks(mask_counts,group):
+    '''
+    adds the masks of a (QNAME, read slot masks) read group (see SAMstats.initialize_read_masks) to mask_counts
+    '''
+    update_flagstat_for_readname(mask_counts,group[1])
+
+
+def range_flagstat(bam_file,start,end,n_ref,first_record,chunk_size):
+    '''
+    computes flagstat statistics for the BAM records that start inside one byte range of the file
+    bam_file -- path to the BAM file
+    start -- compressed offset of the first block in the range
+    end -- compressed offset of the first block after the range (None for the end of the file)
+    first_record -- decompressed offset (from the start of the range) of the first record, or None to re-align to a record boundary
+    returns a dictionary with
+        first_record -- decompressed offset of the first record processed (None if the range holds no record start)
+        stop -- decompressed offset, relative to block end, of the first record that was not processed (None at the end of the file)
+        flagstat -- [qc_passed, qc_failed] flagstat arrays for the read names seen completely inside the range
+        head, tail -- (QNAME, masks) for the first and last read name of the range, which may continue in the neighbouring ranges
+    '''
+    f=open(bam_file,'rb')
+    f.seek(start)
+    block_offset=start
+    #buf holds the decompressed stream from position buf_start onwards
+    buf=b''
+    buf_start=0
+    end_position=None
+    eof=False
+
+    def read_more(buf,buf_start,consumed,block_offset,end_position):
+        #drops the consumed bytes and decompresses about chunk_size more compressed bytes
+        parts=[buf[consumed:]]
+        stream_end=buf_start+len(buf)
+        buf_start+=consumed
+        compressed_size=0
+        eof=False
+        while compressed_size<chunk_size:
+            if block_offset==end:
+                end_position=stream_end
+            block=read_block(f)
+            if block is None:
+                eof=True
+                break
+            data=decompress_block(block)
+            parts.append(data)
+            stream_end+=len(data)
+            block_offset+=len(block)
+            compressed_size+=len(block)
+        return b''.join(parts),buf_start,block_offset,end_position,eof
+
+    misaligned={'first_record':None,'stop':None,'flagstat':None,'head':None,'tail':None}
+    guessed=first_record is None
+    if guessed:
+        while len(buf)<resync_window and not eof:
+            buf,buf_start,block_offset,end_position,eof=read_more(buf,buf_start,0,block_offset,end_position)
+        first_record=find_first_record(buf,n_ref)
+        if first_record is None:
+            f.close()
+            return misaligned
+    position=first_record
+
+    mask_counts=initialize_mask_counts()
+    head=None
+    cur_seq_id=None
+    cur_masks=initialize_read_masks()
+    stop=None
+    unpack_from=bam_record_core.unpack_from
+    while True:
+        offset=position-buf_start
+        if offset+bam_record_core.size>len(buf) or offset+4+struct.unpack_from('<i',buf,offset)[0]>len(buf):
+            if eof:
+                break
+            consumed=min(offset,len(buf))
+            buf,buf_start,block_offset,end_position,eof=read_more(buf,buf_start,consumed,block_offset,end_position)
+            continue
+        if end_position is not None and position>=end_position:
+            stop=position-end_position
+            break
+        block_size,ref_id,ref_pos,l_read_name,mapq,bin_mq,n_cigar,flag,l_seq,next_ref_id,next_pos,tlen=unpack_from(buf,offset)
+        if block_size<32+l_read_name or l_read_name<1:
+            f.close()
+            if guessed:
+                #the re-alignment picked a position that is not a record boundary, the parent recomputes this range
+                return misaligned
+            raise ValueError("corrupt BAM record at decompressed offset "+str(position))
+        new_seq_id=buf[offset+36:offset+35+l_read_name]
+        if new_seq_id!=cur_seq_id:
+            if cur_seq_id is not None:
+                if head is None:
+                    #the first read name keeps its masks, it may continue in the previous range
+                    head=(cur_seq_id,cur_masks)
+                    cur_masks=initialize_read_masks()
+                else:
+                    update_flagstat_for_readname(mask_counts,cur_masks)
+            cur_seq_id=new_seq_id
+        mate_on_different_chrom=next_ref_id!=ref_id or next_ref_id<0
+        cur_masks[((flag & 0xc0)>>5) | ((flag & 0x200)>>9)]|=mask_table[((flag & 0xfff)<<2) | (mate_on_different_chrom<<1) | (mapq>=5)]
+        position+=4+block_size
+    f.close()
+    tail=None
+    if cur_seq_id is not None:
+        if head is None:
+            head=(cur_seq_id,cur_masks)
+        else:
+            tail=(cur_seq_id,cur_masks)
+    return {'first_record':first_record if head is not None else None,
+            'stop':stop,
+            'flagstat':mask_counts_to_flagstat(mask_counts),
+            'head':head,
+            'tail':tail}
+
+
+def split_bam(bam_file,num_ranges,first_record):
+    '''
+    splits the compressed BAM file into at most num_ranges byte ranges that start at BGZF block boundaries
+    the first range starts at the beginning of the file; later ranges start after the block holding the first record
+    returns a list of (start, end) compressed offsets, with end=None for the last range
+    '''
+    file_size=os.path.getsize(bam_file)
+    f=open(bam_file,'rb')
+    #find the block holding the first record, no other range may start at or before it
+    header_end=0
+    stream_position=0
+    while True:
+        block=read_block(f)
+        if block is None:
+            break
+        stream_position+=len(decompress_block(block))
+        if stream_position>first_record:
+            break
+        header_end+=len(block)
+    starts=[0]
+    for i in range(1,num_ranges):
+        start=find_block_start(f,max(file_size*i//num_ranges,header_end+1),file_size)
+        if start is not None and start>starts[-1]:
+            starts.append(start)
+    f.close()
+    return [(starts[i],starts[i+1] if i+1<len(starts) else None) for i in range(len(starts))]
+
+
+def parallel_bam_flagstat(bam_file,processes,chunk_size):
+    '''
+    computes the [qc_passed, qc_failed] flagstat arrays for a name-sorted BAM file with a pool of worker processes
+    '''
+    first_record,n_ref=read_header_length(bam_file)
+    #use several ranges per process so that the work stays balanced
+    ranges=split_bam(bam_file,processes*4,first_record)
+    tasks=[(bam_file,start,end,n_ref,first_record if i==0 else None,chunk_size) for i,(start,end) in enumerate(ranges)]
+    pool=mp.Pool(processes)
+    results=pool.starmap(range_flagstat,tasks)
+    pool.close()
+    pool.join()
+
+    global_flagstat=[[0]*14,[0]*14]
+    edge_mask_counts=initialize_mask_counts()
+    pending=None
+    for i in range(len(results)):
+        if i>0:
+            #the range must start exactly where the previous range stopped
+            expected=results[i-1]['stop']
+            if expected is None:
+                results[i]={'first_record':None,'stop':None,'flagstat':None,'head':None,'tail':None}
+            elif results[i]['first_record']!=expected:
+                results[i]=range_flagstat(*(tasks[i][:4]+(expected,chunk_size)))
+        result=results[i]
+        if result['head'] is None:
+            continue
+        global_flagstat[0]=[a+b for a,b in zip(global_flagstat[0],result['flagstat'][0])]
+        global_flagstat[1]=[a+b for a,b in zip(global_flagstat[1],result['flagstat'][1])]
+        head=result['head']
+        if pending is not None and pending[0]==head[0]:
+            #the read name continues from the previous range, combine the masks of each read slot
+            for slot in range(num_read_slots):
+                pending[1][slot]|=head[1][slot]
+        else:
+            if pending is not None:
+                add_group_masks(edge_mask_counts,pending)
+            pending=head
+        if result['tail'] is not None:
+            add_group_masks(edge_mask_counts,pending)
+            pending=result['tail']
+    if pending is not None:
+        add_group_masks(edge_mask_counts,pending)
+    edge_flagstat=mask_counts_to_flagstat(edge_mask_counts)
+    global_flagstat[0]=[a+b for a,b in zip(global_flagstat[0],edge_flagstat[0])]
+    global_flagstat[1]=[a+b for a,b in zip(global_flagstat[1],edge_flagstat[1])]
+    return global_flagstat
@@ -0,0 +1,32 @@
+## Process-parallel flagstat for name-sorted SAM files on local disk.
+## The file is cut into byte ranges that start at QNAME boundaries (see SAMstats.scanner.split_sam_ranges), so every read name
+## falls in exactly one range and the per-range results can simply be added up. Each worker memory-maps the file and scans
+## its own range in place.
+import multiprocess as mp
+from SAMstats.scanner import split_sam_ranges, mmap_mask_counts
+from SAMstats.flagmask import mask_counts_to_flagstat
+
+
+def range_flagstat(sam_file,start,end,chunk_size):
+    '''
+    returns the [qc_passed, qc_failed] flagstat arrays for the reads in the byte range [start, end) of sam_file
+    '''
+    return mask_counts_to_flagstat(mmap_mask_counts(sam_file,chunk_size,start,end))
+
+
+def parallel_sam_flagstat(sam_file,processes,chunk_size):
+    '''
+    computes the [qc_passed, qc_failed] flagstat arrays for a name-sorted SAM file with a pool of worker processes
+    '''
+    #use several ranges per process so that the work stays balanced
+    ranges=split_sam_ranges(sam_file,processes*4)
+    tasks=[(sam_file,start,end,chunk_size) for start,end in ranges]
+    pool=mp.Pool(processes)
+    results=pool.starmap(range_flagstat,tasks)
+    pool.close()
+    pool.join()
+    global_flagstat=[[0]*14,[0]*14]
+    for result in results:
+        global_flagstat[0]=[a+b for a,b in zip(global_flagstat[0],result[0])]
+        global_flagstat[1]=[a+b for a,b in zip(global_flagstat[1],result[1])]
+    return global_flagstat
@@ -0,0 +1,180 @@
+## Generates a reproducible synthetic SAM/BAM file sorted by read name (SO:queryname) for benchmarking SAMstats.
+## The fraction of paired-end reads, multimappers (reads with secondary alignments), reads with supplementary alignments,
+## QC-failed reads, duplicates and unmapped reads is configurable; the same seed always produces the same file.
+## NH and SA tags are filled in consistently with the alignments of each read, so the file can also be coordinate sorted
+## and used with SAMstats --coordinate_sorted.
+## BAM output requires pysam.
+import argparse
+import random
+import sys
+
+chroms=['chr1','chr2','chr3','chrX','chrM']
+chrom_length=10000000
+
+
+def parse_args(argv=None):
+    parser=argparse.ArgumentParser(description="Generate a synthetic name-sorted SAM/BAM file for SAMstats benchmarks")
+    parser.add_argument("--outf",required=True,help="Output file, '-' for stdout (SAM only)")
+    parser.add_argument("--format",choices=["sam","bam"],default="sam")
+    parser.add_argument("--num_reads",type=int,default=100000,help="Number of read names (templates) to generate")
+    parser.add_argument("--seed",type=int,default=1)
+    parser.add_argument("--paired_fraction",type=float,default=0.8,help="Fraction of paired-end templates")
+    parser.add_argument("--multimapper_fraction",type=float,default=0.1,help="Fraction of reads with secondary alignments")
+    parser.add_argument("--max_secondary",type=int,default=4,help="Maximum number of secondary alignments of a multimapper")
+    parser.add_argument("--supplementary_fraction",type=float,default=0.05,help="Fraction of reads with supplementary alignments")
+    parser.add_argument("--qc_fail_fraction",type=float,default=0.02,help="Fraction of templates failing QC")
+    parser.add_argument("--duplicate_fraction",type=float,default=0.1,help="Fraction of templates marked as duplicates")
+    parser.add_argument("--unmapped_fraction",type=float,default=0.05,help="Fraction of unmapped reads")
+    parser.add_argument("--read_length",type=int,default=100)
+    return parser.parse_args(argv)
+
+
+def random_alignment(r,args):
+    '''
+    returns (RNAME, POS, MAPQ) for a mapped alignment
+    '''
+    return r.choice(chroms),r.randint(1,chrom_length-args.read_length),r.choice([0,1,3,5,20,40,60,60,60])
+
+
+def sam_line(name,flag,chrom,pos,mapq,rnext,pnext,seq,qual,tags):
+    '''
+    returns the SAM line of an alignment; unmapped reads are placed at the position of their mate
+    '''
+    if flag & 0x4:
+        chrom,pos,mapq,cigar=rnext,pnext,0,'*'
+    else:
+        cigar=str(len(seq))+'M'
+    if rnext!='*' and rnext==chrom:
+        rnext='='
+    return '\t'.join([name,str(flag),chrom,str(pos),str(mapq),cigar,rnext,str(pnext),'0',seq,qual]+tags)+'\n'
+
+
+def sa_tag(alignments,read_length):
+    '''
+    returns the SA tag listing the (RNAME, POS, MAPQ) alignments
+    '''
+    return 'SA:Z:'+''.join([','.join([chrom,str(pos),'+',str(read_length)+'M',str(mapq),'0'])+';' for chrom,pos,mapq in alignments])
+
+
+def generate_template(r,args,name):
+    '''
+    returns the SAM lines of all alignments for the read name
+    '''
+    paired=r.random()<args.paired_fraction
+    template_flag=0
+    if r.random()<args.qc_fail_fraction:
+        template_flag|=0x200
+    if r.random()<args.duplicate_fraction:
+        template_flag|=0x400
+    mates=[0x41,0x81] if paired else [0]
+    #primary alignment of each mate: (unmapped, RNAME, POS, MAPQ, reverse strand)
+    primaries=[]
+    for mate in mates:
+        unmapped=r.random()<args.unmapped_fraction
+        chrom,pos,mapq=random_alignment(r,args)
+        reverse=r.random()<0.5
+        if len(primaries)>0 and r.random()<0.9:
+            #most mates map close to each other on opposite strands
+            chrom=primaries[0][1]
+            pos=max(1,primaries[0][2]+r.randint(-500,500))
+            reverse=not primaries[0][4]
+        primaries.append((unmapped,chrom,pos,mapq,reverse))
+    lines=[]
+    seq=''.join(r.choice('ACGT') for i in range(args.read_length))
+    qual='I'*args.read_length
+    for i in range(len(mates)):
+        unmapped,chrom,pos,mapq,reverse=primaries[i]
+        num_secondary=0
+        num_supplementary=0
+        if not unmapped:
+            if r.random()<args.multimapper_fraction:
+                num_secondary=r.randint(1,args.max_secondary)
+            if r.random()<args.supplementary_fraction:
+                num_supplementary=r.randint(1,2)
+        supplementary=[random_alignment(r,args) for j in range(num_supplementary)]
+        mate_flag=0
+        rnext='*'
+        pnext=0
+        if paired:
+            mate_unmapped,mate_chrom,mate_pos,mate_mapq,mate_reverse=primaries[1-i]
+            if mate_unmapped:
+                mate_flag|=0x8
+            else:
+                if mate_reverse:
+                    mate_flag|=0x20
+                rnext=mate_chrom
+                pnext=mate_pos
+            if not unmapped and not mate_unmapped and chrom==mate_chrom and reverse!=mate_reverse and r.random()<0.9:
+                mate_flag|=0x2
+        flag=mates[i] | template_flag | mate_flag
+        if unmapped:
+            flag|=0x4
+        if reverse:
+            flag|=0x10
+        nh_tag='NH:i:'+str(1+num_secondary)
+        tags=[nh_tag]
+        if num_supplementary>0:
+            tags.append(sa_tag(supplementary,args.read_length))
+        lines.append(sam_line(name,flag,chrom,pos,mapq,rnext,pnext,seq,qual,tags))
+        for j in range(num_secondary):
+            sec_chrom,sec_pos,sec_mapq=random_alignment(r,args)
+            lines.append(sam_line(name,flag | 0x100,sec_chrom,sec_pos,0,rnext,pnext,seq,qual,[nh_tag]))
+        for j in range(num_supplementary):
+            sup_chrom,sup_pos,sup_mapq=supplementary[j]
+            #SA of a supplementary alignment lists the primary and the other supplementary alignments
+            others=[(chrom,pos,mapq)]+supplementary[:j]+supplementary[j+1:]
+            lines.append(sam_line(name,flag | 0x800,sup_chrom,sup_pos,sup_mapq,rnext,pnext,seq,qual,[sa_tag(others,args.read_length)]))
+    return lines
+
+
+def write_sam(args,out):
+    '''
+    writes the header and the alignments of args.num_reads read names to the text file handle out
+    returns the number of alignments written
+    '''
+    r=random.Random(args.seed)
+    out.write('@HD\tVN:1.6\tSO:queryname\n')
+    for chrom in chroms:
+        out.write('@SQ\tSN:'+chrom+'\tLN:'+str(chrom_length)+'\n')
+    out.write('@PG\tID:generate_sam\tPN:generate_sam\n')
+    num_alignments=0
+    #zero padded names keep the file sorted by read name
+    width=len(str(args.num_reads))
+    for i in range(args.num_reads):
+        lines=generate_template(r,args,'read'+str(i).zfill(width))
+        out.writelines(lines)
+        num_alignments+=len(lines)
+    return num_alignments
+
+
+def generate(args):
+    '''
+    writes the file described by the parsed arguments
+    returns the number of alignments written
+    '''
+    if args.format=="bam":
+        #pysam is only needed for BAM output
+        import pysam
+        import tempfile
+        if args.outf=="-":
+            raise ValueError("BAM output can not be written to stdout")
+        with tempfile.NamedTemporaryFile('w',suffix='.sam') as sam:
+            num_alignments=write_sam(args,sam)
+            sam.flush()
+            pysam.view('-b','-o',args.outf,sam.name,catch_stdout=False)
+    elif args.outf=="-":
+        num_alignments=write_sam(args,sys.stdout)
+    else:
+        with open(args.outf,'w') as out:
+            num_alignments=write_sam(args,out)
+    return num_alignments
+
+
+def main():
+    args=parse_args()
+    num_alignments=generate(args)
+    sys.stderr.write("wrote "+str(num_alignments)+" alignments for "+str(args.num_reads)+" read names\n")
+
+
+if __name__=="__main__":
+    main()
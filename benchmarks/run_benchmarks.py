@@ -0,0 +1,195 @@
+## Throughput and memory benchmarks for the SAMstats and SAMstatsParallel engines.
+## Generates a synthetic name-sorted SAM file (and BAM / coordinate-sorted BAM copies when pysam is available, see generate_sam.py),
+## runs every benchmark case on it as a separate process and reports alignments/sec, MB/s, peak RSS and the speedup per number of
+## threads as JSON, so the results of two commits can be compared.
+## The packages are imported from this checkout, not from the installed version.
+## New engines are benchmarked by adding an entry to the cases list.
+import argparse
+import json
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import time
+import generate_sam
+
+repo_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+#name -- identifies the case in the results
+#tool -- SAMstats or SAMstatsParallel
+#input -- sam, bam or coordinate_bam
+#args -- extra command line arguments
+#threads -- the case is run once per --threads value
+#requires -- optional module that must be importable
+cases=[{'name':'SAMstats-python','tool':'SAMstats','input':'sam','args':[]},
+       {'name':'SAMstats-bytes','tool':'SAMstats','input':'sam','args':['--engine','bytes','--chunk_size','4000000']},
+       {'name':'SAMstats-mmap','tool':'SAMstats','input':'sam','args':['--engine','bytes','--mmap','--chunk_size','4000000']},
+       {'name':'SAMstats-numpy','tool':'SAMstats','input':'sam','args':['--engine','numpy','--chunk_size','8000000'],'requires':'numpy'},
+       {'name':'SAMstats-bam','tool':'SAMstats','input':'bam','args':[]},
+       {'name':'SAMstats-coordinate-bam','tool':'SAMstats','input':'coordinate_bam','args':['--coordinate_sorted']},
+       {'name':'SAMstatsParallel-threads','tool':'SAMstatsParallel','input':'sam','args':[],'threads':True},
+       {'name':'SAMstatsParallel-processes-sam','tool':'SAMstatsParallel','input':'sam','args':['--engine','processes','--chunk_size','4000000'],'threads':True},
+       {'name':'SAMstatsParallel-processes-bam','tool':'SAMstatsParallel','input':'bam','args':['--engine','processes'],'threads':True}]
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Benchmark the SAMstats engines on a synthetic SAM/BAM file")
+    parser.add_argument("--workdir",default="benchmark_data",help="Directory for the generated input files and the SAMstats outputs")
+    parser.add_argument("--outf",default=None,help="JSON file to store the results. The results will be printed to stdout if no file is provided")
+    parser.add_argument("--generator_args",default="--num_reads 200000",help="Arguments passed to generate_sam.py (quoted), i.e. \"--num_reads 1000000 --multimapper_fraction 0.3\"")
+    parser.add_argument("--threads",default="1,2,4",help="Comma separated numbers of threads/processes for the SAMstatsParallel cases")
+    parser.add_argument("--cases",default=None,help="Comma separated names of the cases to run (all by default): "+",".join([case['name'] for case in cases]))
+    parser.add_argument("--repeat",type=int,default=1,help="Number of runs of each case; the fastest run is reported")
+    return parser.parse_args()
+
+
+def module_available(module):
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+def prepare_inputs(args):
+    '''
+    generates the input files in args.workdir (reused if the generator arguments did not change)
+    returns (dictionary of input name -> path, number of alignments, generator arguments)
+    '''
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+    gen_args=generate_sam.parse_args(['--outf',os.path.join(args.workdir,'input.sam')]+shlex.split(args.generator_args))
+    params=dict(vars(gen_args))
+    del params['outf']
+    del params['format']
+    params_file=os.path.join(args.workdir,'input.json')
+    inputs={'sam':gen_args.outf}
+    if os.path.exists(params_file) and json.load(open(params_file))['params']==params:
+        num_alignments=json.load(open(params_file))['alignments']
+    else:
+        print("generating "+gen_args.outf)
+        num_alignments=generate_sam.generate(gen_args)
+        if module_available('pysam'):
+            import pysam
+            pysam.view('-b','-o',os.path.join(args.workdir,'input.bam'),gen_args.outf,catch_stdout=False)
+            pysam.sort('-o',os.path.join(args.workdir,'input.coordinate.bam'),os.path.join(args.workdir,'input.bam'),catch_stdout=False)
+        json.dump({'params':params,'alignments':num_alignments},open(params_file,'w'))
+    for name,path in [('bam','input.bam'),('coordinate_bam','input.coordinate.bam')]:
+        if os.path.exists(os.path.join(args.workdir,path)):
+            inputs[name]=os.path.join(args.workdir,path)
+    return inputs,num_alignments,params
+
+
+#runs the tool and stores its peak RSS in KB in the file named by SAMSTATS_BENCHMARK_RSS
+#VmHWM is reset by exec, unlike the ru_maxrss returned by wait4, which would include the RSS of this process at fork time
+child_code='''
+import os, sys, resource
+sys.argv[0]="{tool}"
+from {tool} import main
+try:
+    main()
+finally:
+    peak_rss=0
+    if os.path.exists('/proc/self/status'):
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                peak_rss=int(line.split()[1])
+    else:
+        peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #worker processes
+    peak_rss=max(peak_rss,resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    open(os.environ['SAMSTATS_BENCHMARK_RSS'],'w').write(str(peak_rss))
+'''
+
+
+def run_case(tool,arguments,workdir):
+    '''
+    runs the tool from this checkout in a separate process
+    returns (exit code, wall clock seconds, peak resident set size in MB of the process or of its largest worker process)
+    '''
+    rss_file=os.path.join(workdir,'peak_rss.txt')
+    env=dict(os.environ)
+    env['PYTHONPATH']=repo_dir+os.pathsep+env.get('PYTHONPATH','')
+    env['SAMSTATS_BENCHMARK_RSS']=rss_file
+    start=time.time()
+    exit_code=subprocess.call([sys.executable,'-c',child_code.format(tool=tool)]+arguments,stdout=subprocess.DEVNULL,env=env)
+    seconds=time.time()-start
+    #ru_maxrss and VmHWM are in KB on Linux
+    peak_rss=int(open(rss_file).read())/1024.0
+    os.remove(rss_file)
+    return exit_code,seconds,peak_rss
+
+
+def main():
+    args=parse_args()
+    inputs,num_alignments,params=prepare_inputs(args)
+    thread_counts=[int(threads) for threads in args.threads.split(',')]
+    selected=cases
+    if args.cases is not None:
+        names=args.cases.split(',')
+        selected=[case for case in cases if case['name'] in names]
+    #the output of the first case that runs is the reference for the other cases
+    reference_case=None
+    reference_output=None
+    results=[]
+    for case in selected:
+        skipped=None
+        if case['input'] not in inputs:
+            skipped="input "+case['input']+" not available (requires pysam)"
+        elif 'requires' in case and not module_available(case['requires']):
+            skipped="requires "+case['requires']
+        if skipped is not None:
+            results.append({'case':case['name'],'skipped':skipped})
+            continue
+        input_file=inputs[case['input']]
+        input_bytes=os.path.getsize(input_file)
+        case_results=[]
+        for threads in (thread_counts if case.get('threads') else [None]):
+            outf=os.path.join(args.workdir,case['name']+('' if threads is None else '.'+str(threads))+'.txt')
+            arguments=['--sorted_sam_file',input_file,'--outf',outf]+case['args']
+            if threads is not None:
+                arguments+=['--threads',str(threads)]
+            runs=[run_case(case['tool'],arguments,args.workdir) for i in range(args.repeat)]
+            exit_code=max([run[0] for run in runs])
+            seconds=min([run[1] for run in runs])
+            peak_rss=max([run[2] for run in runs])
+            output=open(outf).read() if exit_code==0 else None
+            if reference_output is None and output is not None:
+                reference_case=case['name']
+                reference_output=output
+            result={'case':case['name'],
+                    'tool':case['tool'],
+                    'input':case['input'],
+                    'args':case['args'],
+                    'threads':threads,
+                    'exit_code':exit_code,
+                    'seconds':round(seconds,3),
+                    'alignments_per_sec':round(num_alignments/seconds,1),
+                    'mb_per_sec':round(input_bytes/1e6/seconds,3),
+                    'peak_rss_mb':round(peak_rss,1),
+                    'output_matches_reference':output is not None and output==reference_output}
+            print(json.dumps(result))
+            case_results.append(result)
+        single_thread=[result for result in case_results if result['threads']==1]
+        for result in case_results:
+            if result['threads'] is not None and len(single_thread)>0:
+                result['speedup_vs_1_thread']=round(single_thread[0]['seconds']/result['seconds'],3)
+        results+=case_results
+    report={'timestamp':time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python':platform.python_version(),
+            'platform':platform.platform(),
+            'cpu_count':os.cpu_count(),
+            'generator':params,
+            'alignments':num_alignments,
+            'input_bytes':{name:os.path.getsize(path) for name,path in inputs.items()},
+            'reference_case':reference_case,
+            'results':results}
+    if args.outf is None:
+        print(json.dumps(report,indent=2))
+    else:
+        json.dump(report,open(args.outf,'w'),indent=2)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,18 @@
+#!/bin/bash
+#compatibility check: SAMstats and SAMstatsParallel must give identical reports for a SAM file and a BAM file of the same reads
+#the reads are generated with benchmarks/generate_sam.py; the default of 200 read names makes a BAM smaller than one --chunk_size
+#usage: compare_sam_bam.sh [NumReads] [OutputPrefix]
+num_reads=${1:-200}
+prefix=${2:-sam_bam_parity}
+script_dir=$(dirname $0)
+
+python $script_dir/../benchmarks/generate_sam.py --outf $prefix.sam --format sam --num_reads $num_reads > /dev/null
+python $script_dir/../benchmarks/generate_sam.py --outf $prefix.bam --format bam --num_reads $num_reads > /dev/null
+status=0
+SAMstats --sorted_sam_file $prefix.sam --outf $prefix.sam.txt --quiet
+SAMstats --sorted_sam_file $prefix.bam --outf $prefix.bam.txt --quiet
+diff $prefix.sam.txt $prefix.bam.txt && echo "SAMstats reports are identical" || status=1
+SAMstatsParallel --sorted_sam_file $prefix.sam --outf $prefix.parallel.sam.txt > /dev/null
+SAMstatsParallel --sorted_sam_file $prefix.bam --outf $prefix.parallel.bam.txt > /dev/null
+diff $prefix.sam.txt $prefix.parallel.sam.txt && diff $prefix.sam.txt $prefix.parallel.bam.txt && echo "SAMstatsParallel reports are identical" || status=1
+exit $status
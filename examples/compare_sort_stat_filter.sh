@@ -0,0 +1,14 @@
+#!/bin/bash
+#compatibility check: the single-pass SAMstatsSortStatFilter report must be identical to the SAMstats.sort.stat.filter.sh report 
+#usage: compare_sort_stat_filter.sh InputBamFile (defaults to the small example file) 
+inputf=${1:-wgs_bam_NA12878_20k_b37_NA12878.bam}
+script_dir=$(dirname $0)
+
+bash $script_dir/../SAMstats.sort.stat.filter.sh $inputf $inputf.sort.stat.filter.txt 1 > /dev/null
+sorted_bam=$inputf
+if [ -e $inputf.sorted ]
+then 
+    sorted_bam=$inputf.sorted
+fi
+SAMstatsSortStatFilter --sorted_sam_file $sorted_bam --outf $inputf.single.pass.txt 
+diff $inputf.sort.stat.filter.txt $inputf.single.pass.txt && echo "reports are identical"
@@ -0,0 +1,99 @@
+## Allocation check for the per-read state of count_alignment_masks: the alignments of a name-sorted file are parsed up front, then fed to
+## count_alignment_masks one at a time while the number of live memory blocks (sys.getallocatedblocks) is sampled at every alignment boundary.
+## Per-read dicts, lists or keys that are freed when the read ends never raise the peak memory, but they are alive at the boundaries inside the
+## read, so they show up here as blocks above the level of the first alignment. A second pass under tracemalloc compares snapshots taken at the
+## first and the last alignment and lists the lines of SAMstats that still hold blocks.
+## Temporary objects created and freed within the handling of a single alignment (i.e. the int results of the FLAG arithmetic) are not counted.
+## usage: python count_allocations.py [--sam_file name-sorted SAM file] [--num_reads N] [--package_dir checkout to measure]
+import argparse
+import io
+import os
+import sys
+import tracemalloc
+from array import array
+
+repo_dir=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_args():
+    parser=argparse.ArgumentParser(description="Count the memory blocks held per alignment and per read by SAMstats count_alignment_masks")
+    parser.add_argument("--sam_file",default=None,help="Name-sorted SAM file to read the alignments from. A synthetic file is generated with benchmarks/generate_sam.py by default")
+    parser.add_argument("--num_reads",type=int,default=100000,help="Number of read names to generate when no --sam_file is given")
+    parser.add_argument("--package_dir",default=repo_dir,help="Checkout the SAMstats package is imported from, i.e. an older commit to compare with")
+    return parser.parse_args()
+
+
+def read_alignments(args):
+    '''
+    returns the (QNAME, FLAG, MAPQ, RNEXT) tuples of the input, with QNAME as bytes like the BAM reader
+    '''
+    if args.sam_file is None:
+        sys.path.insert(0,os.path.join(repo_dir,'benchmarks'))
+        import generate_sam
+        sam=io.StringIO()
+        generate_sam.write_sam(generate_sam.parse_args(['--outf','-','--num_reads',str(args.num_reads)]),sam)
+        lines=sam.getvalue().splitlines()
+    else:
+        lines=open(args.sam_file).read().splitlines()
+    alignments=[]
+    for line in lines:
+        if line.startswith('@'):
+            continue
+        tokens=line.split('\t',7)
+        alignments.append((tokens[0].encode(),int(tokens[1]),int(tokens[4]),tokens[6]))
+    return alignments
+
+
+def sampled_alignments(alignments,samples):
+    '''
+    yields the alignments, storing the number of live memory blocks before each one in the preallocated array samples
+    '''
+    i=0
+    for alignment in alignments:
+        samples[i]=sys.getallocatedblocks()
+        i+=1
+        yield alignment
+    samples[i]=sys.getallocatedblocks()
+
+
+def snapshot_alignments(alignments,snapshots):
+    '''
+    yields the alignments, taking a tracemalloc snapshot before the first one and after the last one
+    '''
+    snapshots.append(tracemalloc.take_snapshot())
+    for alignment in alignments:
+        yield alignment
+    snapshots.append(tracemalloc.take_snapshot())
+
+
+def main():
+    args=parse_args()
+    sys.path.insert(0,args.package_dir)
+    import SAMstats
+    from SAMstats import count_alignment_masks
+    alignments=read_alignments(args)
+    num_reads=len(set([alignment[0] for alignment in alignments]))
+    print("SAMstats from "+os.path.dirname(os.path.dirname(os.path.abspath(SAMstats.__file__))))
+    print("alignments: "+str(len(alignments))+", read names: "+str(num_reads))
+
+    samples=array('q',bytes(8*(len(alignments)+1)))
+    count_alignment_masks(sampled_alignments(alignments,samples))
+    #the first alignment is the reference level, the state of the first read is set up after it
+    excess=[blocks-samples[0] for blocks in samples]
+    print("live blocks above the first alignment, at any alignment boundary: max "+str(max(excess))+", mean "+'%.3f' % (sum(excess)/len(excess)))
+    print("live blocks added per alignment over the run: "+'%.6f' % (excess[-1]/len(alignments)))
+
+    tracemalloc.start()
+    snapshots=[]
+    count_alignment_masks(snapshot_alignments(alignments,snapshots))
+    tracemalloc.stop()
+    package_filter=[tracemalloc.Filter(True,os.path.join(os.path.abspath(args.package_dir),'SAMstats','*'))]
+    diff=snapshots[1].filter_traces(package_filter).compare_to(snapshots[0].filter_traces(package_filter),'lineno')
+    held=[stat for stat in diff if stat.count_diff!=0]
+    print("tracemalloc: blocks held by SAMstats after the last alignment that were not held before the first: "+str(sum([stat.count_diff for stat in held])))
+    for stat in held[:10]:
+        print("    "+str(stat))
+
+
+if __name__=="__main__":
+    main()
@@ -7,10 +7,16 @@ config = {
     'packages': ['SAMstats','SAMstatsParallel'],
     'setup_requires': ['multiprocess'],
     'install_requires': ['multiprocess'],
+    'extras_require': {'numpy': ['numpy'],
+                       'cram': ['pysam'],
+                       'parquet': ['pyarrow']},
     'dependency_links': ['multiprocess'],
     'scripts': [],
     'entry_points': {'console_scripts': ['SAMstats = SAMstats.__init__:main',
-                                         'SAMstatsParallel= SAMstatsParallel.__init__:main']},
+                                         'SAMstatsParallel= SAMstatsParallel.__init__:main',
+                                         'SAMstatsSortStatFilter = SAMstats.sortstatfilter:main',
+                                         'SAMstatsComplexity = SAMstats.complexity:main',
+                                         'SAMstatsCoordinateComplexity = SAMstats.coordinate_complexity:main']},
     'name': 'SAMstats'
 }
 